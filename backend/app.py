@@ -1,47 +1,102 @@
 import os
-import threading
+import json
 import httpx
 import psycopg2
 from psycopg2.extras import RealDictCursor, Json
 from datetime import datetime, timezone, timedelta
 from dateutil.parser import parse as date_parse
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, g
 from flask_cors import CORS
-from user_agents import parse
 import pycountry
 import jwt
+import ipaddress
+import math
 import time
-from functools import wraps
+from functools import lru_cache, wraps
 from sites_config import get_sites_list, get_site_url
-from auth_config import verify_gcp_token, extract_user_info, GCP_CLIENT_ID, JWT_SECRET_KEY
+from auth_config import verify_gcp_token, decode_app_token, extract_user_info, GCP_CLIENT_ID, JWT_SECRET_KEY
+from live_stats import LiveStats
+from compression import compress_response
+from static_files import build_manifest, serve_entry
+from upstream import UpstreamPool, normalize_date, select_users
+from heavy_hitters import SpaceSaving, SketchBuffer, HEAVY_HITTER_DIMENSIONS, load_merged
+import metrics
+from slow_queries import SlowQueryRecorder
+from db_routing import ReplicaSet, parse_hosts
+from compactor import SessionCompactor
+from bot_filter import BotClassifier, BotCounter, DEFAULT_BOT_PATTERNS, parse_networks
+from rate_limit import TokenBuckets, LoadShedder
+from dimensions import DimensionCache, KEY_COLUMNS, KEY_VALUES
+from geoip import GeoDatabase
+from quantiles import DDSketch, load_sketches, record_session_times
+from shards import DEFAULT_SHARD, ShardRouter, merge_payloads, columnar as columnar_payload
+from snapshot import SnapshotStore
 
 load_dotenv()
 
-# Serve static files from 'static_frontend' folder (which will contain the Next.js export)
-app = Flask(__name__, static_folder='static_frontend', static_url_path='')
-CORS(app, origins="*", allow_headers=["Content-Type", "Authorization"], methods=["GET", "POST", "OPTIONS"])
+# The Next.js export lives in 'static_frontend'.  Flask's own static route is
+# disabled: files are served from a manifest built once at startup (see
+# static_files.py) so SPA fallbacks and caching headers are handled in one place.
+app = Flask(__name__, static_folder=None)
+STATIC_DIR = os.path.join(app.root_path, 'static_frontend')
+static_manifest = build_manifest(STATIC_DIR)
+CORS(app, origins="*", allow_headers=["Content-Type", "Authorization"], methods=["GET", "POST", "DELETE", "OPTIONS"])
 
-# ensure SQL definitions are applied once the app starts handling
-# requests.  this keeps the Docker init script from being the only place
-# the function gets updated.
-# NOTE: @app.before_first_request was removed in Flask 3.x – use a flag instead.
-_db_init_done = threading.Event()
+@app.after_request
+def _compress(response):
+    # negotiated brotli/gzip for JSON and other text responses
+    return compress_response(response, request)
 
 @app.before_request
-def _init_db_once():
-    if not _db_init_done.is_set():
-        ensure_db_functions()
-        _db_init_done.set()
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    # registered after _compress, so it runs first (Flask reverses the order)
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.observe_request(
+            request.method,
+            request.url_rule.rule if request.url_rule else None,
+            response.status_code,
+            time.perf_counter() - started,
+        )
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus scrape endpoint, aggregated across gunicorn workers."""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+# Sliding-window counters for the live view, fed by /track; every worker adds
+# its per-minute deltas to public.live_* in the background and reads them back
+# merged, so /api/live is answered from memory.  Each open stream holds one of
+# the worker's request threads, hence the cap.
+live_stats = LiveStats(
+    tick_seconds=float(os.environ.get("LIVE_TICK_SECONDS", "2")),
+    connect=lambda: get_db_connection(),
+    flush_seconds=float(os.environ.get("LIVE_FLUSH_SECONDS", "2")),
+    max_streams=int(os.environ.get("LIVE_MAX_STREAMS", "2")),
+    logger=app.logger,
+)
+
+def _serve_frontend(path):
+    entry = static_manifest.get(path)
+    if entry is None:
+        return '', 404
+    return serve_entry(entry, request)
 
 @app.route('/')
 def serve_index():
-    return send_from_directory(app.static_folder, 'index.html')
+    return _serve_frontend('index.html')
 
 @app.route('/login')
 def serve_login():
     """Serve login page"""
-    return send_from_directory(app.static_folder, 'index.html')
+    return _serve_frontend('index.html')
 
 # Catch-all for SPA routing - must be last
 @app.route('/<path:path>')
@@ -49,14 +104,12 @@ def serve_static(path):
     # Skip API routes and auth routes - let them be handled by their specific handlers
     if path.startswith('api/') or path.startswith('track') or path.startswith('log/'):
         return '', 404
-    
-    # If file exists as a static file, serve it
-    full_path = os.path.join(app.root_path, app.static_folder, path)
-    if os.path.exists(full_path) and os.path.isfile(full_path):
-        return send_from_directory(app.static_folder, path)
-    
-    # Otherwise fallback to index.html for SPA routing (Next.js handles client-side routing)
-    return send_from_directory(app.static_folder, 'index.html')
+
+    # Exported file → serve it; anything else falls back to index.html for
+    # SPA routing (Next.js handles client-side routing)
+    if path in static_manifest:
+        return _serve_frontend(path)
+    return _serve_frontend('index.html')
 
 # Database connection parameters
 DB_HOST = os.environ.get("DB_HOST", "localhost")
@@ -68,12 +121,9 @@ DB_PORT = os.environ.get("DB_PORT", "5432")
 def get_db_connection():
     """Return a new connection to the analytics database.
 
-    We don't automatically load the SQL schema here because the Flask
-    application may be started in environments where the database is
-    already initialised.  The helper below (``ensure_db_functions``) takes
-    care of applying the latest version of the stored procedure on first
-    request, which means deployments don't have to remember to re‑run the
-    SQL file manually every time it changes.
+    The schema (tables, indexes, stored function) is not touched here; it is
+    applied once per deploy by ``migrations.py`` (run from gunicorn's
+    ``on_starting`` hook), so request handling never pays for DDL.
     """
     conn = psycopg2.connect(
         host=DB_HOST,
@@ -84,6 +134,204 @@ def get_db_connection():
     )
     return conn
 
+# Read replicas for dashboard queries: DB_READ_HOSTS="replica1:5432,replica2"
+# (same database and credentials as the primary unless DB_READ_* say otherwise)
+read_replicas = ReplicaSet(
+    [
+        {
+            'host': host,
+            'port': port,
+            'database': os.environ.get("DB_READ_NAME", DB_NAME),
+            'user': os.environ.get("DB_READ_USER", DB_USER),
+            'password': os.environ.get("DB_READ_PASS", DB_PASS),
+        }
+        for host, port in parse_hosts(os.environ.get("DB_READ_HOSTS"), DB_PORT)
+    ],
+    max_lag_seconds=float(os.environ.get("DB_REPLICA_MAX_LAG_SECONDS", "30")),
+    check_seconds=float(os.environ.get("DB_REPLICA_CHECK_SECONDS", "10")),
+    logger=app.logger,
+)
+
+def get_read_connection():
+    """Connection for dashboard reads: a healthy replica, else the primary.
+
+    Never use it for writes – replicas are read-only.
+    """
+    return read_replicas.connection() or get_db_connection()
+
+# Per-site shards (SHARD_DSN_<SHARD>, see shards.py); ``default`` is the main
+# database above, with its replicas
+shard_router = ShardRouter.from_environ(
+    default_connect=lambda: get_db_connection(),
+    default_read_connect=lambda: get_read_connection(),
+    max_idle=int(os.environ.get("SHARD_POOL_SIZE", "8")),
+)
+
+# Top-K summaries per hour bucket, flushed to public.sketch_buckets
+heavy_hitters = SketchBuffer(
+    connect=lambda: get_db_connection(),
+    factory=SpaceSaving,
+    kind=SpaceSaving.kind,
+    flush_seconds=float(os.environ.get("SKETCH_FLUSH_SECONDS", "30")),
+    logger=app.logger,
+)
+
+# Time-on-page DDSketches per hour bucket (kind 'ddsketch'), fed by the compactor
+time_sketches = SketchBuffer(
+    connect=lambda: get_db_connection(),
+    factory=DDSketch,
+    kind=DDSketch.kind,
+    flush_seconds=float(os.environ.get("SKETCH_FLUSH_SECONDS", "30")),
+    logger=app.logger,
+)
+
+def _record_compaction(inserted, updated, timed):
+    metrics.INGEST_ROWS.labels('visitors', 'compact').inc(inserted + updated + timed)
+    metrics.UPSERT_CONFLICTS.labels('visitors').inc(updated)
+
+# Derives public.visitors session rows from the page_views event log, one
+# compactor per shard database
+def _session_compactor(shard):
+    return SessionCompactor(
+        connect=lambda: shard_router.connect(shard),
+        interval_seconds=float(os.environ.get("COMPACT_INTERVAL_SECONDS", "5")),
+        on_compacted=_record_compaction,
+        on_session_times=lambda changes: record_session_times(time_sketches, changes),
+        logger=app.logger,
+    )
+
+compactor = _session_compactor(DEFAULT_SHARD)
+shard_compactors = {shard: _session_compactor(shard) for shard in shard_router.names[1:]}
+
+def _compactor(shard):
+    return compactor if shard == DEFAULT_SHARD else shard_compactors[shard]
+
+# Bot filtering at /track: 'count' tallies bot hits in public.bot_hits,
+# 'drop' discards them, 'off' stores them like any other hit
+BOT_FILTER_MODE = os.environ.get("BOT_FILTER_MODE", "count").lower()
+
+def _bot_networks():
+    ranges = os.environ.get("BOT_IP_RANGES", "").split(',')
+    path = os.environ.get("BOT_IP_RANGES_FILE")
+    if path:
+        with open(path, encoding='utf-8') as f:
+            ranges += f.read().splitlines()
+    return parse_networks(ranges)
+
+bot_classifier = BotClassifier(
+    patterns=DEFAULT_BOT_PATTERNS + tuple(
+        p.strip() for p in os.environ.get("BOT_UA_PATTERNS", "").split(',') if p.strip()
+    ),
+    networks=_bot_networks(),
+)
+bot_counter = BotCounter(
+    connect=lambda: get_db_connection(),
+    flush_seconds=float(os.environ.get("SKETCH_FLUSH_SECONDS", "30")),
+    logger=app.logger,
+)
+
+# Per-client token buckets for /track and /log/time, and an adaptive cap on
+# concurrent ingest DB work (per worker)
+ip_buckets = TokenBuckets(
+    rate=float(os.environ.get("RATE_LIMIT_IP_PER_SECOND", "50")),
+    burst=float(os.environ.get("RATE_LIMIT_IP_BURST", "200")),
+)
+session_buckets = TokenBuckets(
+    rate=float(os.environ.get("RATE_LIMIT_SESSION_PER_SECOND", "2")),
+    burst=float(os.environ.get("RATE_LIMIT_SESSION_BURST", "20")),
+)
+db_shedder = LoadShedder(
+    max_in_flight=int(os.environ.get("INGEST_MAX_IN_FLIGHT", "16")),
+    target_seconds=float(os.environ.get("INGEST_TARGET_LATENCY_MS", "100")) / 1000,
+)
+# Number of reverse proxies in front of the app that append to
+# X-Forwarded-For (0: use the connection address).  TRUST_FORWARDED_FOR=true
+# is the older spelling of one hop.
+TRUSTED_PROXY_HOPS = int(os.environ.get(
+    "TRUSTED_PROXY_HOPS",
+    "1" if os.environ.get("TRUST_FORWARDED_FOR", "False").lower() == "true" else "0",
+))
+
+def _client_ip():
+    """The visitor's address as seen by the outermost trusted proxy.
+
+    Each proxy appends the address it received from, so with N trusted hops
+    the client is the N-th X-Forwarded-For entry from the right; anything
+    further left was sent by the client and is ignored.
+    """
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [
+            hop.strip()
+            for header in request.headers.getlist('X-Forwarded-For')
+            for hop in header.split(',') if hop.strip()
+        ]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr
+
+def _rejected(reason, status, retry_after):
+    metrics.INGEST_REJECTED.labels(reason).inc()
+    retry_after = max(1, math.ceil(retry_after))
+    message = 'Too many requests' if status == 429 else 'Server busy, retry later'
+    resp = jsonify({"error": message, "retry_after": retry_after})
+    resp.headers['Retry-After'] = str(retry_after)
+    return resp, status
+
+def _rate_limited(key, buckets, reason):
+    """A 429 response if ``key`` has run out of tokens, else None."""
+    allowed, retry_after = buckets.take(key)
+    if allowed:
+        return None
+    return _rejected(reason, 429, retry_after)
+
+# Local IP → country / city / isp database (CSV ranges or .mmdb); when set,
+# /track takes geo fields from it instead of from the client
+GEOIP_DATABASE = os.environ.get("GEOIP_DATABASE")
+geo_db = GeoDatabase(
+    GEOIP_DATABASE,
+    check_seconds=float(os.environ.get("GEOIP_CHECK_SECONDS", "60")),
+    cache_size=int(os.environ.get("GEOIP_CACHE_SIZE", "50000")),
+    logger=app.logger,
+) if GEOIP_DATABASE else None
+
+# (dimension, value) → public.dimensions key for /track inserts; keys are
+# per database, so each shard has its own cache
+dimension_keys = DimensionCache(
+    max_entries=int(os.environ.get("DIMENSION_CACHE_SIZE", "50000")),
+)
+shard_dimension_keys = {
+    shard: DimensionCache(max_entries=int(os.environ.get("DIMENSION_CACHE_SIZE", "50000")))
+    for shard in shard_router.names[1:]
+}
+
+def _dimension_keys(shard):
+    return dimension_keys if shard == DEFAULT_SHARD else shard_dimension_keys[shard]
+
+# Optional in-process engine for /api/analytics over the columnar snapshot
+# that ``python snapshot.py --every N`` exports to SNAPSHOT_DIR.
+# ANALYTICS_ENGINE=snapshot makes it the default (``engine=sql|snapshot``
+# overrides per request); SQL answers whenever no fresh snapshot is loaded.
+ANALYTICS_ENGINE = os.environ.get("ANALYTICS_ENGINE", "sql").lower()
+SNAPSHOT_MAX_AGE_SECONDS = float(os.environ.get("SNAPSHOT_MAX_AGE_SECONDS", "900"))
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR")
+snapshot_store = SnapshotStore(
+    SNAPSHOT_DIR,
+    check_seconds=float(os.environ.get("SNAPSHOT_CHECK_SECONDS", "30")),
+    logger=app.logger,
+) if SNAPSHOT_DIR else None
+
+# Sampled EXPLAIN (ANALYZE, BUFFERS) of slow analytics queries, for
+# /api/admin/slow-queries
+slow_queries = SlowQueryRecorder(
+    connect=lambda: get_read_connection(),
+    threshold_seconds=float(os.environ.get("SLOW_QUERY_MS", "1000")) / 1000,
+    sample_rate=float(os.environ.get("SLOW_QUERY_SAMPLE_RATE", "0.1")),
+    capacity=int(os.environ.get("SLOW_QUERY_BUFFER", "50")),
+    max_shapes=int(os.environ.get("SLOW_QUERY_SHAPES", "200")),
+    logger=app.logger,
+)
+
+@lru_cache(maxsize=1024)
 def get_country_code(country_name):
     if not country_name or country_name.lower() == 'unknown':
         return None
@@ -99,30 +347,6 @@ def get_country_code(country_name):
     return None
 
 
-def ensure_db_functions():
-    """Load/refresh database-side SQL (visitors table & analytics function).
-
-    This is safe to call multiple times because the SQL uses
-    "CREATE OR REPLACE".  We invoke it from ``before_first_request`` so that
-    the stored procedure is always up‑to‑date with whatever version is checked
-    into source control.
-    """
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        sql_path = os.path.join(os.path.dirname(__file__), 'supabase_analytics_function.sql')
-        with open(sql_path, 'r', encoding='utf-8') as f:
-            cur.execute(f.read())
-        conn.commit()
-        app.logger.info("Database functions ensured/up-to-date.")
-    except Exception as e:
-        app.logger.error(f"Error ensuring DB functions: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-
 def token_required(f):
     """Decorator to verify JWT token"""
     @wraps(f)
@@ -137,7 +361,7 @@ def token_required(f):
             return jsonify({'message': 'Unauthorized: No token provided'}), 401
         
         try:
-            data = jwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
+            data = decode_app_token(token)
             request.user = data  # Attach user info to request
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Unauthorized: Token expired'}), 401
@@ -223,6 +447,37 @@ def verify_token():
     }), 200
 
 
+@app.route('/api/admin/slow-queries', methods=['GET', 'DELETE', 'OPTIONS'])
+@token_required
+def admin_slow_queries():
+    """Slow analytics queries seen by this worker, with sampled EXPLAIN plans.
+
+    DELETE empties the buffer (e.g. after adding an index).
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    if request.method == 'DELETE':
+        slow_queries.clear()
+    return jsonify(slow_queries.snapshot())
+
+
+@app.route('/api/admin/db', methods=['GET', 'OPTIONS'])
+@token_required
+def admin_db():
+    """Read-replica routing, shards, ingest load-shedding, GeoIP and snapshot state of this worker."""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    return jsonify({
+        'replicas': read_replicas.status(),
+        'ingest_admission': db_shedder.status(),
+        'geoip': geo_db.status() if geo_db else None,
+        'shards': shard_router.status(),
+        'snapshot': snapshot_store.status() if snapshot_store else None,
+    })
+
+
 @app.route('/api/sites', methods=['GET', 'OPTIONS'])
 def get_sites():
     """Return list of available sites for the dropdown"""
@@ -336,34 +591,31 @@ def get_analytics():
             if not params.get(k):
                 params[k] = None
 
+        # ip_filter is an address or a CIDR block ("203.0.113.0/24")
+        if params['ip_filter']:
+            try:
+                params['ip_filter'] = str(ipaddress.ip_network(params['ip_filter'].strip(), strict=False))
+            except ValueError:
+                return jsonify({"error": "ip_filter must be an IP address or CIDR range"}), 400
+
         params['granularity'] = granularity
         
         # Debug logging
         app.logger.info(f"Final params - start: {params['start_date_filter']}, end: {params['end_date_filter']}, granularity: {granularity}")
         
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Check raw visitor count
-        cur.execute("SELECT COUNT(*) as cnt FROM public.visitors WHERE first_seen IS NOT NULL")
-        visitor_check = cur.fetchone()
-        app.logger.info(f"Total visitors with first_seen: {visitor_check['cnt'] if visitor_check else 0}")
-        
-        # Check visitors in the date range
-        if params['start_date_filter'] and params['end_date_filter']:
-            cur.execute(
-                "SELECT COUNT(*) as cnt FROM public.visitors WHERE first_seen >= %s AND first_seen <= %s",
-                (params['start_date_filter'], params['end_date_filter'])
-            )
-            range_check = cur.fetchone()
-            app.logger.info(f"Visitors in date range ({params['start_date_filter']} to {params['end_date_filter']}): {range_check['cnt'] if range_check else 0}")
-        
-        # Call the stored function
-        cur.execute("""
-            SELECT get_filtered_analytics_visual(
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-            ) as data
-        """, (
+        # Optional columnar encoding of chart series (parallel arrays)
+        columnar = request.args.get('format') == 'columnar'
+
+        # Delta refresh: ``since`` is the watermark of an earlier response
+        # (``?since=`` is the same as no watermark)
+        since = request.args.get('since') or None
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return jsonify({"error": "since must be an integer watermark"}), 400
+
+        args = (
             params['country_filter'],
             params['start_date_filter'],
             params['end_date_filter'],
@@ -374,22 +626,69 @@ def get_analytics():
             params['ip_filter'],
             params['isp_filter'],
             params['granularity']
-        ))
-        
-        result = cur.fetchone()
-        data = result['data'] if result else {}
-        
-        app.logger.info(f"Result data keys: {list(data.keys()) if data else 'Empty'}")
-        app.logger.info(f"Stats: {data.get('stats', {}) if data else 'No stats'}")
+        )
+
+        # A site's own view reads its shard only; "all" reads every shard
+        shard = shard_router.for_site(site_filter) if site_url else None
+
+        # The snapshot covers the main database; delta refreshes stay in SQL
+        engine = (request.args.get('engine') or ANALYTICS_ENGINE).lower()
+        snapshot = None
+        if (engine == 'snapshot' and snapshot_store and since is None
+                and (shard or DEFAULT_SHARD) == DEFAULT_SHARD
+                and not (shard is None and shard_router.sharded)):
+            snapshot = snapshot_store.current(SNAPSHOT_MAX_AGE_SECONDS)
+        if snapshot is not None:
+            with metrics.db_timer('analytics_snapshot'):
+                payload = snapshot.analytics(*args)
+            response = jsonify(columnar_payload(payload) if columnar else payload)
+            response.headers['X-Analytics-Snapshot'] = snapshot.created_at.isoformat()
+            return response
+
+        if shard is None and shard_router.sharded:
+            payload = _sharded_analytics(args)
+            app.logger.info(f"Analytics merged from {len(shard_router.names)} shards")
+            return jsonify(columnar_payload(payload) if columnar else payload)
+
+        conn = shard_router.read_connect(shard or DEFAULT_SHARD)
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        # The payload is built as JSON inside Postgres (repeated_visitors
+        # included) and fetched as text, so it goes out without a Python
+        # decode/encode round trip.
+        analytics_call = """
+            get_filtered_analytics_visual(
+                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+            )
+        """
+        if since is not None:
+            # only what changed after the watermark (see get_analytics_delta)
+            analytics_call = """
+                get_analytics_delta(
+                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                )
+            """
+        if columnar:
+            sql = f"SELECT public.analytics_columnar({analytics_call}::jsonb)::text AS data"
+        else:
+            sql = f"SELECT {analytics_call}::text AS data"
+        statement = 'analytics'
+        if since is not None:
+            args = (since,) + args
+            statement = 'analytics_delta'
+        started = time.perf_counter()
+        with metrics.db_timer(statement):
+            cur.execute(sql, args)
+        slow_queries.observe(statement, sql, args, params, time.perf_counter() - started)
 
-        if 'stats' in data:
-            stats = data['stats']
-            total = stats.get('total_visitors', 0)
-            unique = stats.get('unique_visitors', 0)
-            stats['repeated_visitors'] = max(0, total - unique)
-            data['stats'] = stats
+        result = cur.fetchone()
+        body = result['data'] if result and result['data'] else '{}'
+        app.logger.info(
+            f"Analytics payload: {len(body)} bytes"
+            f"{' (columnar)' if columnar else ''}{f' (since {since})' if since is not None else ''}"
+        )
 
-        return jsonify(data)
+        return Response(body, mimetype='application/json')
 
     except Exception as e:
         app.logger.error(f"Error in /api/analytics: {e}", exc_info=True)
@@ -398,36 +697,243 @@ def get_analytics():
         if conn:
             conn.close()
 
+def _sharded_analytics(args):
+    """Full analytics payload of every shard, queried in parallel and merged.
+
+    An address can have visits on several shards, so the visits of every
+    address are first added up over all of them (public.ip_visit_counts)
+    and each shard is told how many its addresses have elsewhere.  The
+    unique / repeated filter and ``unique_visitors`` then count an address
+    once, wherever its visits were stored.
+
+    Always the full payload: ``since`` watermarks are per shard, so the merged
+    view carries none and the dashboard refreshes it in full.
+    """
+    sql = """
+        SELECT get_filtered_analytics_visual(
+            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s::jsonb
+        )::text AS data
+    """
+
+    def ip_visits(shard):
+        conn = shard_router.read_connect(shard)
+        try:
+            cur = conn.cursor()
+            with metrics.db_timer('analytics_shard_ips'):
+                cur.execute("""
+                    SELECT public_ip::text, visits FROM public.ip_visit_counts()
+                    WHERE public_ip IS NOT NULL
+                """)
+            return dict(cur.fetchall())
+        finally:
+            conn.close()
+
+    visits = shard_router.map(ip_visits)
+    totals = {}
+    for counts in visits.values():
+        for ip, n in counts.items():
+            totals[ip] = totals.get(ip, 0) + n
+
+    def fetch(shard):
+        elsewhere = {ip: totals[ip] - n for ip, n in visits[shard].items() if totals[ip] != n}
+        conn = shard_router.read_connect(shard)
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            with metrics.db_timer('analytics_shard'):
+                cur.execute(sql, args + (json.dumps(elsewhere),))
+            row = cur.fetchone()
+            return json.loads(row['data']) if row and row['data'] else None
+        finally:
+            conn.close()
+
+    return merge_payloads(shard_router.map(fetch))
+
+def _date_range_args():
+    """``(start, end)`` from ``start_date_filter``/``end_date_filter``, parsed like /api/analytics.
+
+    Missing values are None; a date-only end covers the whole day.  Raises
+    ValueError for anything that is not a date, so callers can return 400
+    instead of letting Postgres reject the cast.
+    """
+    bounds = []
+    for name in ('start_date_filter', 'end_date_filter'):
+        raw = (request.args.get(name) or '').strip()
+        if not raw:
+            bounds.append(None)
+            continue
+        try:
+            dt = date_parse(raw)
+        except (ValueError, OverflowError):
+            raise ValueError(f'{name} must be an ISO date or timestamp')
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        if name == 'end_date_filter' and len(raw) <= 10:
+            dt = dt.replace(hour=23, minute=59, second=59, microsecond=999999)
+        bounds.append(dt.isoformat())
+    return tuple(bounds)
+
+@app.route('/api/top', methods=['GET', 'OPTIONS'])
+def get_top():
+    """Approximate top-N values for one dimension from stored Space-Saving summaries.
+
+    Query parameters
+    ----------------
+    dimension         : page | city | isp | ip | browser (default: page)
+    limit             : number of items to return (default: 10)
+    start_date_filter : ISO timestamp, inclusive (optional)
+    end_date_filter   : ISO timestamp, inclusive (optional)
+
+    Counts are hits seen by /track.  Each item carries ``error``, the most its
+    count can be overestimated by; ``max_error`` bounds it for every item.
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    dimension = request.args.get('dimension', 'page')
+    if dimension not in HEAVY_HITTER_DIMENSIONS:
+        return jsonify({'error': f'Unknown dimension: {dimension}'}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 100))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    try:
+        start, end = _date_range_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    conn = None
+    try:
+        conn = get_read_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with metrics.db_timer('top'):
+            merged = load_merged(cur, SpaceSaving.kind, dimension, start, end, SpaceSaving)
+        return jsonify({
+            'dimension': dimension,
+            'total': merged.total,
+            'max_error': merged.max_error,
+            'items': [
+                {'value': item, 'count': count, 'error': error}
+                for item, count, error in merged.top(limit)
+            ],
+        })
+    except Exception as e:
+        app.logger.error(f"Error in /api/top: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
+@app.route('/api/time-on-page', methods=['GET', 'OPTIONS'])
+def get_time_on_page():
+    """Time-on-page percentiles from stored DDSketch summaries.
+
+    Query parameters
+    ----------------
+    page              : only sessions whose page_visited is this URL (optional)
+    site_filter       : only sessions on this site's pages (optional)
+    by                : page | site – also return the ``limit`` busiest pages /
+                        sites with their own percentiles (optional)
+    limit             : number of items for ``by`` (default: 10)
+    start_date_filter : ISO timestamp, inclusive (optional)
+    end_date_filter   : ISO timestamp, inclusive (optional)
+
+    Sessions count in the hour bucket of their first_seen.  Every reported
+    value is within ``relative_accuracy`` of the exact percentile.
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    page = request.args.get('page')
+    site = request.args.get('site_filter')
+    scope = f'page:{page}' if page else f'site:{site}' if site else 'all'
+    by = request.args.get('by')
+    if by not in (None, 'page', 'site'):
+        return jsonify({'error': f'Unknown by: {by}'}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 100))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    try:
+        start, end = _date_range_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    conn = None
+    try:
+        conn = get_read_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with metrics.db_timer('time_on_page'):
+            sketch = load_merged(cur, DDSketch.kind, scope, start, end, DDSketch)
+            items = load_sketches(cur, f'{by}:', start, end) if by else None
+        result = {'scope': scope, 'relative_accuracy': sketch.relative_accuracy, **sketch.summary()}
+        if items is not None:
+            busiest = sorted(items.items(), key=lambda kv: kv[1].count, reverse=True)[:limit]
+            result['items'] = [
+                {'value': dimension.split(':', 1)[1], **merged.summary()}
+                for dimension, merged in busiest
+            ]
+        return jsonify(result)
+    except Exception as e:
+        app.logger.error(f"Error in /api/time-on-page: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
 @app.route('/track', methods=['POST', 'OPTIONS'])
 def track():
     if request.method == 'OPTIONS':
         return '', 200
 
+    limited = _rate_limited(_client_ip(), ip_buckets, 'ip_rate')
+    if limited:
+        return limited
+
     conn = None
     try:
         data = request.get_json(force=True)
         session_id = data.get("sessionId")
         if not session_id:
             return jsonify({"error": "Missing sessionId"}), 400
+        limited = _rate_limited(str(session_id), session_buckets, 'session_rate')
+        if limited:
+            return limited
 
         def norm(val):
             return None if not val or str(val).lower() == 'unknown' else val
 
         ua_string = data.get("userAgent", "")
-        ua = parse(ua_string)
-
-        if ua.is_mobile:
-            device_type = "Mobile"
-        elif ua.is_tablet:
-            device_type = "Tablet"
-        else:
-            device_type = "Desktop"
-
-        country = norm(data.get("country"))
-        city = norm(data.get("city"))
-        isp = norm(data.get("isp"))
         public_ip = norm(data.get("publicIp"))
-        country_code = data.get("countryCode") or get_country_code(country)
+        if public_ip:
+            # stored as inet: drop anything that isn't an address instead of
+            # failing the insert
+            try:
+                public_ip = str(ipaddress.ip_address(str(public_ip).strip()))
+            except ValueError:
+                public_ip = None
+
+        # Bots are only counted: no parsing beyond the cached UA lookup and
+        # no page_views row, live counter or top-K entry.  The connection
+        # address is always checked: publicIp is whatever the client sent.
+        client_ip = _client_ip()
+        ua, bot_reason = bot_classifier.classify(ua_string, client_ip, public_ip)
+        if bot_reason and BOT_FILTER_MODE != 'off':
+            metrics.BOT_HITS.labels(bot_reason, BOT_FILTER_MODE).inc()
+            if BOT_FILTER_MODE == 'count':
+                bot_counter.record(bot_reason)
+            return jsonify({"success": True, "ignored": "bot"}), 202
+        device_type = ua.device_type
+
+        geo = geo_db.lookup(public_ip or client_ip) if geo_db else None
+        if geo:
+            # one consistent source for every geo field, no network call
+            country, city, isp = geo.country, geo.city, geo.isp
+            country_code = geo.country_code or get_country_code(country)
+        else:
+            country = norm(data.get("country"))
+            city = norm(data.get("city"))
+            isp = norm(data.get("isp"))
+            country_code = data.get("countryCode") or get_country_code(country)
 
         # Parse timestamp
         first_seen_raw = data.get("timestamp")
@@ -460,42 +966,60 @@ def track():
             ts = max(0, min(ts, 86400))
             time_spent_seconds = ts
 
-        # SQL Upsert
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        query = """
-            INSERT INTO public.visitors (
-                session_id, public_ip, country, country_code, city, isp, 
-                page_visited, user_agent, device_type, browser, operating_system, 
-                first_seen, time_spent_seconds
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, 
-                %s, %s, %s, %s, %s, 
-                %s, %s
-            ) 
-            ON CONFLICT (session_id) DO UPDATE SET
-                public_ip = EXCLUDED.public_ip,
-                country = EXCLUDED.country,
-                country_code = EXCLUDED.country_code,
-                city = EXCLUDED.city,
-                isp = EXCLUDED.isp,
-                page_visited = EXCLUDED.page_visited,
-                user_agent = EXCLUDED.user_agent,
-                device_type = EXCLUDED.device_type,
-                browser = EXCLUDED.browser,
-                operating_system = EXCLUDED.operating_system,
-                first_seen = COALESCE(visitors.first_seen, EXCLUDED.first_seen),
-                time_spent_seconds = COALESCE(EXCLUDED.time_spent_seconds, visitors.time_spent_seconds)
-        """
-        
-        cur.execute(query, (
-            session_id, public_ip, country, country_code, city, isp,
-            data.get("pageVisited"), ua_string, device_type, ua.browser.family, ua.os.family,
-            first_seen, time_spent_seconds
-        ))
-        
-        conn.commit()
+        # Shed load before opening a connection the database can't serve
+        slot = db_shedder.try_acquire()
+        if slot is None:
+            return _rejected('overload', 503, db_shedder.retry_after())
+        shard = shard_router.for_page(data.get("pageVisited"))
+        keys_cache = _dimension_keys(shard)
+        try:
+            # Append-only: the visitors row is derived later by the compactor,
+            # so hits on the same session never contend for a row lock
+            conn = shard_router.connect(shard)
+            cur = conn.cursor()
+
+            # text dimensions go in as public.dimensions keys (cached per
+            # worker; misses are resolved inside the insert)
+            dimension_values = {
+                'country': country,
+                'city': city,
+                'isp': isp,
+                'device_type': device_type,
+                'browser': ua.browser,
+                'operating_system': ua.operating_system,
+                'user_agent': ua_string or None,
+            }
+            with metrics.db_timer('track_insert'):
+                cur.execute(f"""
+                    INSERT INTO public.page_views (
+                        session_id, public_ip, country_code, page_visited,
+                        viewed_at, time_spent_seconds, {KEY_COLUMNS}
+                    ) VALUES (
+                        %s, %s, %s, %s,
+                        %s, %s, {KEY_VALUES}
+                    )
+                    RETURNING {KEY_COLUMNS}
+                """, [
+                    session_id, public_ip, country_code, data.get("pageVisited"),
+                    first_seen, time_spent_seconds,
+                ] + keys_cache.params(dimension_values))
+                keys = cur.fetchone()
+                conn.commit()
+            keys_cache.remember(dimension_values, keys)
+        finally:
+            db_shedder.release(slot)
+
+        metrics.INGEST_ROWS.labels('page_views', 'insert').inc()
+        _compactor(shard).ensure_running()
+
+        live_stats.record(session_id, data.get("pageVisited"), country)
+        heavy_hitters.record({
+            'page': data.get("pageVisited"),
+            'city': city,
+            'isp': isp,
+            'ip': public_ip,
+            'browser': ua.browser,
+        })
 
         return jsonify({"success": True}), 201
 
@@ -511,27 +1035,47 @@ def log_time():
     if request.method == 'OPTIONS':
         return '', 200
 
+    limited = _rate_limited(_client_ip(), ip_buckets, 'ip_rate')
+    if limited:
+        return limited
+
     conn = None
     try:
         data = request.get_json(force=True)
         session_id = data.get("sessionId")
         if not session_id:
             return jsonify({"error": "Missing sessionId"}), 400
+        limited = _rate_limited(str(session_id), session_buckets, 'session_rate')
+        if limited:
+            return limited
 
         time_spent_seconds = data.get("timeSpentSeconds", 0)
         if time_spent_seconds is not None:
             time_spent_seconds = max(0, min(int(time_spent_seconds), 86400))
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            UPDATE public.visitors 
-            SET time_spent_seconds = %s 
-            WHERE session_id = %s
-        """, (time_spent_seconds, session_id))
-        
-        conn.commit()
+        # the session's shard, from the page (or site) the report is for
+        shard = shard_router.for_time_report(data.get("pageVisited"), data.get("siteId"))
+        if shard is None:
+            return jsonify({"error": "pageVisited or siteId is required"}), 400
+        slot = db_shedder.try_acquire()
+        if slot is None:
+            return _rejected('overload', 503, db_shedder.retry_after())
+        try:
+            conn = shard_router.connect(shard)
+            cur = conn.cursor()
+
+            # recorded as a 'time' event; the compactor applies it to visitors
+            with metrics.db_timer('log_time'):
+                cur.execute("""
+                    INSERT INTO public.page_views (session_id, event_type, time_spent_seconds)
+                    VALUES (%s, 'time', %s)
+                """, (session_id, time_spent_seconds))
+                conn.commit()
+        finally:
+            db_shedder.release(slot)
+
+        metrics.INGEST_ROWS.labels('page_views', 'insert').inc()
+        _compactor(shard).ensure_running()
 
         return jsonify({"success": True, "time_logged": time_spent_seconds}), 200
 
@@ -543,6 +1087,49 @@ def log_time():
             conn.close()
 
 
+@app.route('/api/live', methods=['GET', 'OPTIONS'])
+def get_live():
+    """Current live counters as plain JSON: the merged counters of every
+    worker from the last few seconds, or this worker's own when none are."""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        return jsonify(live_stats.latest())
+    except Exception as e:
+        app.logger.error(f"Error in /api/live: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/live/stream', methods=['GET'])
+def stream_live():
+    """Server-Sent Events stream of live counters.
+
+    Every connected dashboard receives the same snapshot, computed once per
+    tick by the worker's broadcaster.  Over LIVE_MAX_STREAMS open streams
+    the worker answers 503, so viewers can't take every ingest thread.
+    """
+    q = live_stats.subscribe()
+    if q is None:
+        retry_after = max(1, math.ceil(live_stats.tick_seconds * 5))
+        resp = jsonify({"error": "Too many live streams, retry later", "retry_after": retry_after})
+        resp.headers['Retry-After'] = str(retry_after)
+        return resp, 503
+    resp = Response(
+        stream_with_context(live_stats.stream(q)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # stop nginx-style proxies from buffering the event stream
+            'X-Accel-Buffering': 'no',
+        },
+    )
+    # the stream unsubscribes when it ends; this covers a client gone
+    # before it started
+    resp.call_on_close(lambda: live_stats.unsubscribe(q))
+    return resp
+
+
 # ---------------------------------------------------------------------------
 # App-specific user-detail endpoints (proxied to external FSA service)
 # ---------------------------------------------------------------------------
@@ -555,6 +1142,40 @@ APP_USER_ENDPOINTS = {
     # add more app entries here: 'myapp': 'https://...',
 }
 
+# Long-lived keep-alive clients + response cache shared by all requests
+upstream_pool = UpstreamPool(
+    APP_USER_ENDPOINTS,
+    timeout=float(os.environ.get("UPSTREAM_TIMEOUT", "30")),
+    fresh_seconds=float(os.environ.get("UPSTREAM_CACHE_FRESH_SECONDS", "60")),
+    stale_seconds=float(os.environ.get("UPSTREAM_CACHE_STALE_SECONDS", "600")),
+    max_bytes=int(float(os.environ.get("UPSTREAM_CACHE_MAX_MB", "64")) * 2**20),
+    logger=app.logger,
+    observe=metrics.observe_upstream,
+)
+# Per-upstream deadline when several apps are queried at once (app=all)
+UPSTREAM_FANOUT_DEADLINE = float(os.environ.get("UPSTREAM_FANOUT_DEADLINE", "20"))
+
+
+def _user_selection(options):
+    """Read district/role/fields/page/page_size from request args or a JSON body."""
+    fields = options.get('fields') or None
+    if isinstance(fields, str):
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+    try:
+        page = int(options.get('page') or 1)
+        page_size = int(options.get('page_size') or 0) or None
+    except (TypeError, ValueError):
+        raise ValueError('page and page_size must be integers')
+    if page_size is not None:
+        page_size = max(1, min(page_size, 1000))
+    return {
+        'district': options.get('district') or None,
+        'role': options.get('role') or None,
+        'fields': fields,
+        'page': page,
+        'page_size': page_size,
+    }
+
 
 @app.route('/api/app-users', methods=['GET', 'POST', 'OPTIONS'])
 def get_app_users():
@@ -564,10 +1185,19 @@ def get_app_users():
 
     Parameters (both methods)
     --------------------------------
-    app        : app slug (default: fps)
+    app        : app slug, ``all``, or a comma-separated list of slugs
+                 (default: fps).  Several apps are queried concurrently and
+                 the response adds per-upstream ``upstreams`` status/timing.
     period     : day | week | month | all (default: day)
-    start_date : ISO date string – overrides period-based calculation
-    end_date   : ISO date string – overrides period-based calculation
+    start_date : YYYY-MM-DD – overrides period-based calculation
+    end_date   : YYYY-MM-DD – overrides period-based calculation
+    deadline   : seconds each upstream gets in multi-app mode
+                 (default: UPSTREAM_FANOUT_DEADLINE)
+    district   : only users in this district (case-insensitive)
+    role       : only users with this role (case-insensitive)
+    fields     : comma-separated list of user fields to return
+    page       : 1-based page number (with page_size)
+    page_size  : rows per page, at most 1000 (default: all rows)
     """
     if request.method == 'OPTIONS':
         return '', 200
@@ -577,71 +1207,60 @@ def get_app_users():
         app_slug = str(data.get('app', 'fps')).lower()
         start_date = data.get('start_date', '') or ''
         end_date = data.get('end_date', '') or ''
+        deadline = data.get('deadline')
+        options = data
     else:
         # GET
         app_slug = request.args.get('app', 'fps').lower()
         # start_date and end_date may be supplied by the client; default to empty strings
         start_date = request.args.get('start_date', '') or ''
         end_date = request.args.get('end_date', '') or ''
+        deadline = request.args.get('deadline')
+        options = request.args
+
+    try:
+        selection = _user_selection(options)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'users': []}), 400
+    try:
+        # canonical dates, so equivalent spellings share one cache entry
+        start_date, end_date = normalize_date(start_date), normalize_date(end_date)
+    except ValueError:
+        return jsonify({'error': 'start_date and end_date must be YYYY-MM-DD dates', 'users': []}), 400
 
     # We used to convert period into specific start/end dates, but the
     # upstream service handles empty strings itself.  Sending computed dates
     # caused "data/time field value out of range" errors when the range
     # included the current day.  Leaving the values empty avoids the problem
     # and keeps the behaviour consistent with the curl example.
+    if app_slug == 'all' or ',' in app_slug:
+        if app_slug == 'all':
+            slugs = list(APP_USER_ENDPOINTS)
+        else:
+            slugs = [s.strip() for s in app_slug.split(',') if s.strip()]
+        unknown = [s for s in slugs if s not in APP_USER_ENDPOINTS]
+        if unknown or not slugs:
+            return jsonify({'error': f"Unknown app: {', '.join(unknown) or app_slug}", 'users': []}), 400
+        try:
+            deadline = float(deadline) if deadline else UPSTREAM_FANOUT_DEADLINE
+        except (TypeError, ValueError):
+            return jsonify({'error': 'deadline must be a number of seconds', 'users': []}), 400
+
+        app.logger.info(f"app-users fan-out → {slugs}  start={start_date!r} end={end_date!r}")
+        combined = upstream_pool.fetch_many(slugs, start_date, end_date, deadline=deadline)
+        return jsonify(select_users(combined, **selection)), 200
+
     upstream_url = APP_USER_ENDPOINTS.get(app_slug)
     if not upstream_url:
         return jsonify({'error': f'Unknown app: {app_slug}', 'users': []}), 400
 
-    body_data = {'start_date': start_date, 'end_date': end_date}
     app.logger.info(f"app-users → {upstream_url}  start={start_date!r} end={end_date!r}")
 
     try:
-        # verify=False: many internal/institutional servers use self-signed certs;
-        # disabling verification prevents SSL handshake timeouts on the proxy side.
-        with httpx.Client(verify=False, timeout=30) as client:
-            resp = client.post(
-                upstream_url,
-                json=body_data,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Accept': '*/*',
-                    'User-Agent': (
-                        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                        'AppleWebKit/537.36 (KHTML, like Gecko) '
-                        'Chrome/144.0.0.0 Safari/537.36'
-                    ),
-                },
-            )
-        resp.raise_for_status()
-        upstream = resp.json()
-        app.logger.info(f"Upstream OK ({len(resp.content)} bytes)")
-
-        # Normalise upstream response into a `users` array the frontend can consume
-        users = []
-        if isinstance(upstream, dict):
-            if isinstance(upstream.get('details'), list):
-                for d in upstream['details']:
-                    users.append({
-                        'userid':         d.get('userid'),
-                        'user_name':      d.get('rep_name') or d.get('name') or d.get('username') or '',
-                        'user_role':      d.get('user_role') or d.get('role'),
-                        'district':       d.get('district_name') or d.get('district'),
-                        'police_station': d.get('police_station') or d.get('ps') or None,
-                        'last_login':     d.get('last_login'),
-                        'phone':          d.get('phone_no'),
-                    })
-                return jsonify({'users': users}), 200
-
-            for key in ('users', 'data', 'results'):
-                if isinstance(upstream.get(key), list):
-                    return jsonify({'users': upstream[key]}), 200
-
-        if isinstance(upstream, list):
-            return jsonify({'users': upstream}), 200
-
-        # Fallback: wrap whatever came back
-        return jsonify({'users': [], 'raw': upstream}), 200
+        payload, cache_status = upstream_pool.fetch(app_slug, start_date, end_date)
+        resp = jsonify(select_users(payload, **selection))
+        resp.headers['X-Cache'] = cache_status
+        return resp, 200
 
     except httpx.HTTPStatusError as e:
         app.logger.error(f'Upstream HTTP {e.response.status_code} for {app_slug}: {e.response.text[:200]}')
@@ -655,5 +1274,16 @@ def get_app_users():
 
 
 if __name__ == '__main__':
+    # the dev server has no gunicorn hook; bring the schema up to date here
+    from migrations import apply_migrations
+    try:
+        _conn = get_db_connection()
+        try:
+            apply_migrations(_conn, log=app.logger.info)
+        finally:
+            _conn.close()
+    except Exception as e:
+        app.logger.error(f"Error applying migrations: {e}")
+
     debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
     app.run(debug=debug_mode, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
@@ -1,6 +1,14 @@
 # GCP OAuth2 Configuration
+import hashlib
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
 from google.oauth2 import id_token
+from google.auth import transport
 from google.auth.transport import requests as google_requests
 
 # GCP OAuth2 Configuration - Hardcoded Client ID
@@ -10,23 +18,144 @@ JWT_SECRET_KEY = "super-long-and-secure-secret-key"  # Change in production
 # Note: Email domain whitelisting is configured in GCP Console
 # OAuth consent screen → User verification → Allowed domains
 
+# Google's signing certificates and accepted issuers for ID tokens
+GCP_CERTS_URL = os.environ.get("GCP_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs")
+GCP_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class TokenCache:
+    """Verified token claims keyed by SHA-256 of the token, kept until ``exp``.
+
+    Only tokens that passed full verification are stored, and an entry is
+    never served after the token's own expiry, so a hit is exactly as
+    trustworthy as re-verifying – minus the signature check.
+    """
+
+    def __init__(self, max_entries=4096, clock=time.time):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _key(token):
+        if isinstance(token, str):
+            token = token.encode("utf-8")
+        return hashlib.sha256(token).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            claims, expires_at = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, token, claims):
+        expires_at = claims.get("exp") if isinstance(claims, dict) else None
+        if not expires_at:
+            # no expiry → nothing bounds the entry; don't cache it
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (claims, float(expires_at))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CachingRequest(transport.Request):
+    """google-auth transport that reuses one HTTP session and caches cert GETs.
+
+    Responses to GET requests are kept for as long as their
+    ``Cache-Control: max-age`` allows (Google serves its certs with a
+    multi-hour max-age), so verifying an ID token normally needs no network
+    round trip at all.
+    """
+
+    def __init__(self, request=None, clock=time.time):
+        self._request = request or google_requests.Request()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if method != "GET":
+            return self._request(url, method=method, body=body, headers=headers,
+                                 timeout=timeout, **kwargs)
+        now = self._clock()
+        with self._lock:
+            cached = self._cache.get(url)
+            if cached and cached[1] > now:
+                return cached[0]
+
+        response = self._request(url, method=method, body=body, headers=headers,
+                                 timeout=timeout, **kwargs)
+        if response.status == 200:
+            cache_control = (response.headers or {}).get("cache-control", "")
+            match = _MAX_AGE_RE.search(cache_control)
+            if match and "no-store" not in cache_control:
+                with self._lock:
+                    self._cache[url] = (response, now + int(match.group(1)))
+        return response
+
+
+# Shared across requests: one keep-alive session + cert cache, and the
+# claims of tokens that already passed verification
+_cert_request = CachingRequest()
+_gcp_token_cache = TokenCache()
+_app_token_cache = TokenCache()
+
+
 # Token verification
-def verify_gcp_token(token):
+def verify_gcp_token(token, request=None, certs_url=None):
     """
     Verify GCP ID token and return user info
     """
+    cached = _gcp_token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
-        idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), GCP_CLIENT_ID)
-        
+        idinfo = id_token.verify_token(
+            token,
+            request or _cert_request,
+            audience=GCP_CLIENT_ID,
+            certs_url=certs_url or GCP_CERTS_URL,
+        )
+        if idinfo.get('iss') not in GCP_ISSUERS:
+            raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+
         # Verify token hasn't expired
-        if idinfo['exp'] < __import__('time').time():
+        if idinfo['exp'] < time.time():
             raise ValueError('Token expired')
-        
+
+        _gcp_token_cache.put(token, idinfo)
         return idinfo
     except Exception as e:
         print(f"Token verification failed: {str(e)}")
         return None
 
+
+def decode_app_token(token):
+    """
+    Decode and verify one of our own HS256 JWTs, reusing earlier verifications.
+
+    Raises the same ``jwt`` exceptions as ``jwt.decode``.
+    """
+    claims = _app_token_cache.get(token)
+    if claims is not None:
+        return claims
+    claims = jwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
+    _app_token_cache.put(token, claims)
+    return claims
+
 def extract_user_info(idinfo):
     """
     Extract user information from ID token
@@ -0,0 +1,189 @@
+# Ingest-time bot and crawler filtering
+#
+# /track asks ``BotClassifier`` about every hit before touching the database.
+# A hit is a bot when any of these match:
+#
+#   * ``user_agents`` flags the UA string as a bot (``is_bot``);
+#   * the UA matches one of the configured patterns (case-insensitive
+#     regexes – monitors, headless browsers, HTTP libraries, ...);
+#   * the client IP falls inside one of the configured networks.
+#
+# Results are cached per UA string and per IP.  The UA cache also keeps the
+# parsed device / browser / OS, so real visitors with a common UA skip the
+# (comparatively slow) user-agent parse as well.
+#
+# Bot hits are not written to page_views.  ``BotCounter`` tallies them in
+# memory per (day, reason) and flushes the totals to ``public.bot_hits``
+# every ``flush_seconds``, so a crawler burst costs a few upserts per flush.
+
+import ipaddress
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+from user_agents import parse
+
+DEFAULT_BOT_PATTERNS = (
+    r'bot[/;-]', r'\bbot\b', r'crawl', r'spider', r'slurp', r'archiver',
+    r'headless', r'phantomjs', r'lighthouse', r'pagespeed',
+    r'pingdom', r'uptimerobot', r'statuscake', r'site24x7', r'monitor',
+    r'curl/', r'wget/', r'python-requests', r'python-httpx', r'aiohttp',
+    r'go-http-client', r'okhttp', r'java/', r'libwww', r'scrapy',
+    r'facebookexternalhit', r'embedly', r'preview',
+)
+
+# Parsed UA fields stored with each hit, plus the bot verdict for the UA
+UserAgentInfo = namedtuple('UserAgentInfo', 'device_type browser operating_system bot_reason')
+
+
+def parse_networks(values):
+    """CIDR strings (blank lines and ``#`` comments ignored) → networks."""
+    networks = []
+    for value in values:
+        value = value.split('#', 1)[0].strip()
+        if value:
+            networks.append(ipaddress.ip_network(value, strict=False))
+    return networks
+
+
+class _LRU:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = compute(key)
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+
+class BotClassifier:
+    """Cached bot verdicts per user-agent string and per client IP."""
+
+    def __init__(self, patterns=DEFAULT_BOT_PATTERNS, networks=(), max_entries=10000):
+        self._pattern = re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE) if patterns else None
+        self._networks = list(networks)
+        self._user_agents = _LRU(max_entries)
+        self._ips = _LRU(max_entries)
+
+    def _parse_user_agent(self, ua_string):
+        ua = parse(ua_string)
+        if ua.is_mobile:
+            device_type = 'Mobile'
+        elif ua.is_tablet:
+            device_type = 'Tablet'
+        else:
+            device_type = 'Desktop'
+        if ua.is_bot:
+            reason = 'user_agent'
+        elif self._pattern is not None and self._pattern.search(ua_string):
+            reason = 'pattern'
+        else:
+            reason = None
+        return UserAgentInfo(device_type, ua.browser.family, ua.os.family, reason)
+
+    def _ip_reason(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        for network in self._networks:
+            if address.version == network.version and address in network:
+                return 'ip_range'
+        return None
+
+    def user_agent(self, ua_string):
+        return self._user_agents.get(ua_string or '', self._parse_user_agent)
+
+    def classify(self, ua_string, *ips):
+        """Return ``(UserAgentInfo, reason)``; ``reason`` is None for humans.
+
+        Any of ``ips`` inside a bot range makes the hit a bot (empty ones are
+        skipped).
+        """
+        info = self.user_agent(ua_string)
+        reason = info.bot_reason
+        if reason is None and self._networks:
+            for ip in dict.fromkeys(ip for ip in ips if ip):
+                reason = self._ips.get(ip, self._ip_reason)
+                if reason:
+                    break
+        return info, reason
+
+
+class BotCounter:
+    """Per-day, per-reason bot hit totals, flushed to ``public.bot_hits``."""
+
+    def __init__(self, connect, flush_seconds=30.0, clock=time.time, logger=None):
+        self._connect = connect
+        self.flush_seconds = flush_seconds
+        self._clock = clock
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def record(self, reason, n=1):
+        day = datetime.fromtimestamp(self._clock(), timezone.utc).date()
+        with self._lock:
+            self._pending[(day, reason)] = self._pending.get((day, reason), 0) + n
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(
+                    target=self._flush_loop, name='bot-hits-flush', daemon=True
+                )
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f"Error flushing bot hit counters: {e}")
+            with self._lock:
+                if not self._pending:
+                    self._flusher = None
+                    return
+
+    def flush(self):
+        """Add the pending totals to the stored counters."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        conn = None
+        try:
+            conn = self._connect()
+            cur = conn.cursor()
+            for (day, reason), hits in sorted(pending.items()):
+                cur.execute("""
+                    INSERT INTO public.bot_hits (day, reason, hits)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (day, reason) DO UPDATE SET
+                        hits = bot_hits.hits + EXCLUDED.hits
+                """, (day, reason, hits))
+            conn.commit()
+            return len(pending)
+        except Exception:
+            if conn:
+                conn.rollback()
+            # keep the counts for the next flush
+            with self._lock:
+                for key, hits in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + hits
+            raise
+        finally:
+            if conn:
+                conn.close()
@@ -0,0 +1,8 @@
+-- Daily totals of /track hits classified as bots (see bot_filter.py).  Bot
+-- hits are only counted here, never written to page_views.
+CREATE TABLE IF NOT EXISTS public.bot_hits (
+  day date NOT NULL,
+  reason text NOT NULL,
+  hits bigint NOT NULL DEFAULT 0,
+  CONSTRAINT bot_hits_pkey PRIMARY KEY (day, reason)
+);
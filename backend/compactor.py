@@ -0,0 +1,230 @@
+# Sessionization: fold the page_views event log into public.visitors
+#
+# /track and /log/time only append to public.page_views.  The compactor
+# periodically takes the events received since its watermark, finds the
+# sessions they belong to and rebuilds those sessions' visitors rows from
+# their complete event history:
+#
+#   * location / device / page fields come from the session's latest view;
+#   * first_seen is its earliest view (client timestamp when sent);
+#   * time_spent_seconds is the latest value reported by either event type.
+#
+# A pass also reports every session whose time / page / first_seen changed,
+# old and new values side by side, so time-on-page sketches (quantiles.py)
+# can swap the old value for the new one.
+#
+# Rebuilding from the full history makes a pass idempotent, so every pass
+# also re-reads ``overlap_seconds`` before the watermark: an insert that
+# committed late (its received_at is its transaction start) is picked up by
+# the next pass instead of being lost.  Events younger than
+# ``settle_seconds`` are left for the next pass for the same reason.  Rows
+# a re-read leaves as they were are not rewritten, so the ``updated`` and
+# ``timed`` counts are real changes, not the overlap.
+#
+# Each worker runs a compactor thread; the watermark row is taken with
+# ``FOR UPDATE SKIP LOCKED`` so only one of them works at a time.
+
+import threading
+import time
+from datetime import timedelta
+
+COMPACT_SQL = """
+    WITH touched AS (
+        SELECT DISTINCT session_id FROM public.page_views
+        WHERE received_at > %(lower)s AND received_at <= %(upper)s
+    ),
+    sessions AS (
+        SELECT
+            session_id,
+            bool_or(event_type = 'view') AS has_view,
+            MIN(COALESCE(viewed_at, received_at)) FILTER (WHERE event_type = 'view') AS first_seen,
+            (array_agg(time_spent_seconds ORDER BY received_at DESC, id DESC)
+                FILTER (WHERE time_spent_seconds IS NOT NULL))[1] AS time_spent_seconds
+        FROM public.page_views
+        WHERE session_id IN (SELECT session_id FROM touched)
+          AND received_at <= %(upper)s
+        GROUP BY session_id
+    ),
+    before AS (
+        -- the statement's snapshot: visitors rows as they were before this pass
+        SELECT session_id, time_spent_seconds, page_visited, first_seen
+        FROM public.visitors
+        WHERE session_id IN (SELECT session_id FROM sessions)
+    ),
+    latest AS (
+        SELECT DISTINCT ON (session_id) *
+        FROM public.page_views
+        WHERE session_id IN (SELECT session_id FROM sessions WHERE has_view)
+          AND event_type = 'view'
+          AND received_at <= %(upper)s
+        ORDER BY session_id, received_at DESC, id DESC
+    ),
+    upserted AS (
+        INSERT INTO public.visitors AS v (
+            session_id, public_ip, country_id, country_code, city_id, isp_id,
+            page_visited, user_agent_id, device_type_id, browser_id, operating_system_id,
+            first_seen, time_spent_seconds
+        )
+        SELECT
+            -- views logged before dimensions.sql carry text instead of keys
+            l.session_id, l.public_ip, COALESCE(l.country_id, public.dimension_id('country', l.country)),
+            l.country_code, COALESCE(l.city_id, public.dimension_id('city', l.city)),
+            COALESCE(l.isp_id, public.dimension_id('isp', l.isp)), l.page_visited,
+            COALESCE(l.user_agent_id, public.dimension_id('user_agent', l.user_agent)),
+            COALESCE(l.device_type_id, public.dimension_id('device_type', l.device_type)),
+            COALESCE(l.browser_id, public.dimension_id('browser', l.browser)),
+            COALESCE(l.operating_system_id, public.dimension_id('operating_system', l.operating_system)),
+            s.first_seen, s.time_spent_seconds
+        FROM latest l
+        JOIN sessions s USING (session_id)
+        ON CONFLICT (session_id) DO UPDATE SET
+            public_ip = EXCLUDED.public_ip,
+            country_id = EXCLUDED.country_id,
+            country_code = EXCLUDED.country_code,
+            city_id = EXCLUDED.city_id,
+            isp_id = EXCLUDED.isp_id,
+            page_visited = EXCLUDED.page_visited,
+            user_agent_id = EXCLUDED.user_agent_id,
+            device_type_id = EXCLUDED.device_type_id,
+            browser_id = EXCLUDED.browser_id,
+            operating_system_id = EXCLUDED.operating_system_id,
+            -- LEAST ignores NULLs; keeps rows written before page_views existed
+            first_seen = LEAST(v.first_seen, EXCLUDED.first_seen),
+            time_spent_seconds = COALESCE(EXCLUDED.time_spent_seconds, v.time_spent_seconds)
+        -- skip sessions the overlap re-read without any change
+        WHERE (v.public_ip, v.country_id, v.country_code, v.city_id, v.isp_id, v.page_visited,
+               v.user_agent_id, v.device_type_id, v.browser_id, v.operating_system_id,
+               v.first_seen, v.time_spent_seconds)
+              IS DISTINCT FROM
+              (EXCLUDED.public_ip, EXCLUDED.country_id, EXCLUDED.country_code, EXCLUDED.city_id,
+               EXCLUDED.isp_id, EXCLUDED.page_visited, EXCLUDED.user_agent_id,
+               EXCLUDED.device_type_id, EXCLUDED.browser_id, EXCLUDED.operating_system_id,
+               LEAST(v.first_seen, EXCLUDED.first_seen),
+               COALESCE(EXCLUDED.time_spent_seconds, v.time_spent_seconds))
+        RETURNING (xmax = 0) AS inserted, session_id, time_spent_seconds, page_visited, first_seen
+    ),
+    timed AS (
+        -- time reports for sessions with no view in page_views (older rows)
+        UPDATE public.visitors v
+        SET time_spent_seconds = s.time_spent_seconds
+        FROM sessions s
+        WHERE NOT s.has_view
+          AND s.time_spent_seconds IS NOT NULL
+          AND v.session_id = s.session_id
+          AND v.time_spent_seconds IS DISTINCT FROM s.time_spent_seconds
+        RETURNING v.session_id, v.time_spent_seconds, v.page_visited, v.first_seen
+    ),
+    changed AS (
+        SELECT b.time_spent_seconds AS old_time, b.page_visited AS old_page, b.first_seen AS old_at,
+               n.time_spent_seconds AS new_time, n.page_visited AS new_page, n.first_seen AS new_at
+        FROM (
+            SELECT session_id, time_spent_seconds, page_visited, first_seen FROM upserted
+            UNION ALL
+            SELECT session_id, time_spent_seconds, page_visited, first_seen FROM timed
+        ) n
+        LEFT JOIN before b USING (session_id)
+        WHERE b.session_id IS NULL
+           OR (b.time_spent_seconds, b.page_visited, b.first_seen)
+              IS DISTINCT FROM (n.time_spent_seconds, n.page_visited, n.first_seen)
+    )
+    SELECT
+        (SELECT COUNT(*) FILTER (WHERE inserted) FROM upserted),
+        (SELECT COUNT(*) FILTER (WHERE NOT inserted) FROM upserted),
+        (SELECT COUNT(*) FROM timed),
+        (SELECT json_agg(json_build_array(
+            old_time, old_page, EXTRACT(EPOCH FROM old_at),
+            new_time, new_page, EXTRACT(EPOCH FROM new_at)))
+         FROM changed)
+"""
+
+
+class SessionCompactor:
+    """Background thread that derives visitors rows from page_views."""
+
+    def __init__(self, connect, interval_seconds=5.0, settle_seconds=2.0,
+                 overlap_seconds=30.0, batch_seconds=3600.0, on_compacted=None,
+                 on_session_times=None, logger=None):
+        self._connect = connect
+        self.interval_seconds = interval_seconds
+        self.settle_seconds = settle_seconds
+        self.overlap_seconds = overlap_seconds
+        self.batch_seconds = batch_seconds
+        # on_compacted(inserted, updated, timed) after each committed pass
+        self._on_compacted = on_compacted
+        # on_session_times(changes): [old_time, old_page, old_at, new_time,
+        # new_page, new_at] per changed session, after each committed pass
+        self._on_session_times = on_session_times
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_running(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._loop, name='page-view-compactor', daemon=True
+                )
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            try:
+                # catch up in batch_seconds steps after a backlog
+                while self.compact() == 'partial':
+                    pass
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f"Error compacting page_views: {e}")
+
+    def compact(self):
+        """Run one pass.  Returns ``'done'``, ``'partial'`` (more to do) or ``'busy'``."""
+        conn = self._connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT public.ensure_page_view_partitions()")
+            cur.execute("""
+                SELECT watermark, now() - make_interval(secs => %s)
+                FROM public.compactor_state
+                WHERE name = 'visitors'
+                FOR UPDATE SKIP LOCKED
+            """, (self.settle_seconds,))
+            row = cur.fetchone()
+            if row is None:
+                conn.rollback()
+                return 'busy'
+            watermark, cutoff = row
+            if watermark is None:
+                cur.execute("SELECT MIN(received_at) FROM public.page_views")
+                first = cur.fetchone()[0]
+                if first is None:
+                    conn.rollback()
+                    return 'done'
+                watermark = first - timedelta(microseconds=1)
+
+            upper = min(cutoff, watermark + timedelta(seconds=self.batch_seconds))
+            if upper <= watermark:
+                conn.rollback()
+                return 'done'
+            cur.execute(COMPACT_SQL, {
+                'lower': watermark - timedelta(seconds=self.overlap_seconds),
+                'upper': upper,
+            })
+            inserted, updated, timed, changes = cur.fetchone()
+            cur.execute("""
+                UPDATE public.compactor_state
+                SET watermark = %s, updated_at = now()
+                WHERE name = 'visitors'
+            """, (upper,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if self._on_compacted:
+            self._on_compacted(inserted, updated, timed)
+        if self._on_session_times:
+            self._on_session_times(changes or [])
+        return 'partial' if upper < cutoff else 'done'
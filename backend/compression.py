@@ -0,0 +1,88 @@
+# Content-coding negotiation and on-the-fly response compression
+#
+# JSON API responses (notably /api/analytics with its 100-row visitor list)
+# compress very well.  ``compress_response`` is installed as an
+# ``after_request`` hook and encodes eligible responses with brotli or gzip,
+# whichever the client prefers among those it accepts.
+
+import gzip
+
+import brotli
+
+# Preferred first when the client accepts both equally
+CODINGS = ('br', 'gzip')
+
+# Not worth the CPU below this many bytes
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/csv')
+
+
+def accepts_encoding(accept_encoding, coding):
+    """True if ``Accept-Encoding`` allows ``coding`` (explicitly or via ``*``)."""
+    return _quality(accept_encoding, coding) > 0
+
+
+def _quality(accept_encoding, coding):
+    wildcard = 0.0
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if name not in (coding, '*'):
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == coding:
+            return q
+        wildcard = q
+    return wildcard
+
+
+def negotiate(accept_encoding, available=CODINGS):
+    """Pick the best coding from ``available`` for this client, or ``None``."""
+    best, best_q = None, 0.0
+    for coding in available:
+        q = _quality(accept_encoding, coding)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(data, coding):
+    if coding == 'br':
+        # quality 5 is the usual sweet spot for dynamic content
+        return brotli.compress(data, quality=5)
+    if coding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    raise ValueError(f'Unsupported coding: {coding}')
+
+
+def compress_response(response, request):
+    """Compress ``response`` in place when the client and payload allow it."""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    coding = negotiate(request.headers.get('Accept-Encoding', ''))
+    if coding is None:
+        return response
+
+    response.set_data(compress(data, coding))
+    response.headers['Content-Encoding'] = coding
+    response.vary.add('Accept-Encoding')
+    return response
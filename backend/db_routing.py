@@ -0,0 +1,149 @@
+# Read-replica routing for dashboard queries
+#
+# Ingest (/track, /log/time, sketch flushes, migrations) always writes to the
+# primary through ``get_db_connection``.  Dashboard reads (/api/analytics,
+# /api/top and the EXPLAIN re-runs of slow analytics queries) ask a
+# ``ReplicaSet`` for a connection instead:
+#
+# * replicas are tried round-robin;
+# * a replica that refuses connections is skipped for ``retry_seconds``;
+# * every ``check_seconds`` a replica's replay lag is measured on the
+#   connection being handed out, and a replica further behind than
+#   ``max_lag_seconds``, or not streaming WAL at all, is skipped until the
+#   next check;
+# * when no replica qualifies the caller falls back to the primary.
+#
+# Health state is per worker process; each worker probes on its own.
+
+import threading
+import time
+
+import psycopg2
+
+# Seconds the replica's replayed state is behind the primary.  An idle
+# primary writes no WAL, so a replica that has replayed everything it
+# received counts as 0 rather than "time since last commit" – but only while
+# its WAL receiver is streaming: a replica cut off from the primary receives
+# nothing, so "replayed everything received" says nothing about freshness
+# and the lag is NULL (unknown).  ``status`` is only visible to roles with
+# pg_read_all_stats; for others it reads NULL and a running receiver
+# process has to do.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (
+            SELECT 1 FROM pg_stat_wal_receiver
+            WHERE pid IS NOT NULL AND (status = 'streaming' OR status IS NULL)
+        ) THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+def parse_hosts(value, default_port='5432'):
+    """``"replica1:5433, replica2"`` → ``[('replica1', '5433'), ('replica2', '5432')]``."""
+    hosts = []
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        host, _, port = part.partition(':')
+        hosts.append((host, port or default_port))
+    return hosts
+
+
+class _Replica:
+    __slots__ = ('params', 'name', 'healthy_until', 'retry_at', 'lag', 'error')
+
+    def __init__(self, params):
+        self.params = params
+        self.name = f"{params.get('host')}:{params.get('port')}"
+        self.healthy_until = 0.0
+        self.retry_at = 0.0
+        self.lag = None
+        self.error = None
+
+
+class ReplicaSet:
+    """Round-robin over read replicas with connect and lag health checks."""
+
+    def __init__(self, replicas, max_lag_seconds=30.0, check_seconds=10.0,
+                 retry_seconds=30.0, connect_timeout=3, connect=psycopg2.connect,
+                 clock=time.monotonic, logger=None):
+        self._replicas = [_Replica(dict(params)) for params in replicas]
+        self.max_lag_seconds = max_lag_seconds
+        self.check_seconds = check_seconds
+        self.retry_seconds = retry_seconds
+        self.connect_timeout = connect_timeout
+        self._connect = connect
+        self._clock = clock
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def __len__(self):
+        return len(self._replicas)
+
+    def _rotation(self):
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self._replicas)
+        return self._replicas[start:] + self._replicas[:start]
+
+    def connection(self):
+        """Return a connection to a healthy replica, or None to use the primary."""
+        if not self._replicas:
+            return None
+        for replica in self._rotation():
+            now = self._clock()
+            if now < replica.retry_at:
+                continue
+            try:
+                conn = self._connect(connect_timeout=self.connect_timeout, **replica.params)
+            except Exception as e:
+                self._mark_down(replica, now, f"connect failed: {e}")
+                continue
+            if now < replica.healthy_until:
+                return conn
+            try:
+                cur = conn.cursor()
+                cur.execute(REPLICA_LAG_SQL)
+                lag = cur.fetchone()[0]
+                conn.rollback()
+            except Exception as e:
+                conn.close()
+                self._mark_down(replica, now, f"lag check failed: {e}")
+                continue
+            replica.lag = None if lag is None else float(lag)
+            if lag is None:
+                conn.close()
+                self._mark_down(replica, now, "WAL receiver not streaming", retry=self.check_seconds)
+                continue
+            if replica.lag > self.max_lag_seconds:
+                conn.close()
+                self._mark_down(replica, now, f"lagging {replica.lag:.1f}s", retry=self.check_seconds)
+                continue
+            replica.error = None
+            replica.healthy_until = now + self.check_seconds
+            return conn
+        return None
+
+    def _mark_down(self, replica, now, reason, retry=None):
+        replica.error = reason
+        replica.healthy_until = 0.0
+        replica.retry_at = now + (self.retry_seconds if retry is None else retry)
+        if self._logger:
+            self._logger.warning(f"Read replica {replica.name} skipped: {reason}")
+
+    def status(self):
+        now = self._clock()
+        return [
+            {
+                'replica': r.name,
+                'available': now >= r.retry_at,
+                'lag_seconds': r.lag,
+                'error': r.error,
+            }
+            for r in self._replicas
+        ]
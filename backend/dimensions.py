@@ -0,0 +1,153 @@
+# Dictionary-encoded dimensions at ingest
+#
+# The repeated text fields of a hit (country, city, isp, device type,
+# browser, OS, user agent) are stored once in public.dimensions and
+# referenced by integer key (see dimensions.sql).  /track keeps the
+# ``(dimension, value) → key`` mapping in a bounded per-worker LRU and sends
+# a cached key with the insert; a miss is resolved by
+# ``public.dimension_id`` inside the same INSERT, which returns the keys it
+# used so they can be cached once the insert has committed.  A hit whose
+# values are all cached therefore costs no extra round trip or lookup.
+#
+# Keys are never reused or deleted, so a cached key stays valid for good.
+#
+# visitors rows written before dimensions.sql still carry the text; encode
+# them once with
+#
+#     python dimensions.py --backfill [--batch 5000]
+#
+# which rewrites ``--batch`` ids per transaction (the encode_dimensions
+# trigger does the work) and can be interrupted and rerun at any time.
+# Readers resolve the keys of the rows it has not reached by their text.
+
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from dotenv import load_dotenv
+
+from shards import shard_connectors
+
+DIMENSIONS = ('country', 'city', 'isp', 'device_type', 'browser', 'operating_system', 'user_agent')
+
+# ``country_id, city_id, ...`` and the matching VALUES expressions; each
+# expression takes two parameters, the cached key (or None) and the value
+KEY_COLUMNS = ', '.join(f'{dimension}_id' for dimension in DIMENSIONS)
+KEY_VALUES = ', '.join(
+    f"COALESCE(%s::integer, public.dimension_id('{dimension}', %s))" for dimension in DIMENSIONS
+)
+
+
+# visitors rows whose text has not been encoded yet
+UNENCODED = ' OR '.join(f'{dimension} IS NOT NULL' for dimension in DIMENSIONS)
+
+# Rows the compactor holds are skipped: its update runs the trigger as well
+ENCODE_BATCH_SQL = f"""
+    UPDATE public.visitors v SET country = v.country
+    FROM (
+        SELECT id FROM public.visitors
+        WHERE id >= %(lower)s AND id < %(upper)s AND ({UNENCODED})
+        FOR UPDATE SKIP LOCKED
+    ) b
+    WHERE v.id = b.id
+"""
+
+
+class DimensionCache:
+    """Bounded LRU of dimension keys."""
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()
+
+    def get(self, dimension, value):
+        if value is None:
+            return None
+        with self._lock:
+            key = self._keys.get((dimension, value))
+            if key is not None:
+                self._keys.move_to_end((dimension, value))
+            return key
+
+    def put(self, dimension, value, key):
+        if value is None or key is None:
+            return
+        with self._lock:
+            self._keys[(dimension, value)] = key
+            self._keys.move_to_end((dimension, value))
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+
+    def params(self, values):
+        """Parameters for ``KEY_VALUES`` given ``{dimension: value}``."""
+        params = []
+        for dimension in DIMENSIONS:
+            value = values.get(dimension)
+            params += [self.get(dimension, value), value]
+        return params
+
+    def remember(self, values, keys):
+        """Cache the ``keys`` (in ``DIMENSIONS`` order) an insert returned."""
+        for dimension, key in zip(DIMENSIONS, keys):
+            self.put(dimension, values.get(dimension), key)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def backfill(conn, batch_size=5000, pause=0.05, log=print):
+    """Encode the remaining text-only visitors rows, one id range per
+    transaction; returns the number of rows encoded."""
+    cur = conn.cursor()
+    cur.execute(f"SELECT MIN(id), MAX(id) FROM public.visitors WHERE {UNENCODED}")
+    lower, last = cur.fetchone()
+    conn.commit()
+    total = 0
+    while lower is not None and lower <= last:
+        cur.execute(ENCODE_BATCH_SQL, {'lower': lower, 'upper': lower + batch_size})
+        total += cur.rowcount
+        conn.commit()
+        lower += batch_size
+        log(f"Encoded {total} visitors rows (id < {lower})")
+        # let autovacuum and concurrent writers breathe between batches
+        time.sleep(pause)
+    return total
+
+
+def get_db_connection():
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        database=os.environ.get("DB_NAME", "trac_db"),
+        user=os.environ.get("DB_USER", "trac_user"),
+        password=os.environ.get("DB_PASS", "trac_password"),
+        port=os.environ.get("DB_PORT", "5432"),
+    )
+
+
+def main(argv):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Dimension dictionary maintenance.")
+    parser.add_argument('--backfill', action='store_true',
+                        help="encode visitors rows written before dimensions.sql")
+    parser.add_argument('--batch', type=int, default=5000, help="ids per transaction")
+    parser.add_argument('--pause', type=float, default=0.05, help="seconds between batches")
+    args = parser.parse_args(argv)
+    if not args.backfill:
+        parser.print_help()
+        return 1
+    for shard, connect in shard_connectors(get_db_connection):
+        conn = connect()
+        try:
+            backfill(conn, args.batch, args.pause, log=lambda message: print(f"[{shard}] {message}"))
+        finally:
+            conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
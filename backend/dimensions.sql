@@ -0,0 +1,117 @@
+-- Dictionary encoding of the repeated text dimensions (see dimensions.py).
+-- Every distinct country / city / isp / device_type / browser /
+-- operating_system / user_agent value is stored once here; page_views,
+-- visitors and visitor_daily carry only its integer key in
+-- ``<dimension>_id``.  Keys are never reused or deleted, so ingest can cache
+-- them for the life of a worker.
+CREATE TABLE IF NOT EXISTS public.dimensions (
+  id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+  kind text NOT NULL,
+  value text NOT NULL,
+  CONSTRAINT dimensions_kind_value_key UNIQUE (kind, value)
+);
+
+-- Key of (kind, value), created on first use; NULL for a NULL value
+CREATE OR REPLACE FUNCTION public.dimension_id(dim_kind text, dim_value text)
+RETURNS integer LANGUAGE plpgsql AS $$
+DECLARE
+  dim_key integer;
+BEGIN
+  IF dim_value IS NULL THEN
+    RETURN NULL;
+  END IF;
+  SELECT id INTO dim_key FROM public.dimensions WHERE kind = dim_kind AND value = dim_value;
+  IF dim_key IS NULL THEN
+    INSERT INTO public.dimensions (kind, value) VALUES (dim_kind, dim_value)
+    ON CONFLICT (kind, value) DO NOTHING
+    RETURNING id INTO dim_key;
+    IF dim_key IS NULL THEN
+      -- another transaction inserted it first
+      SELECT id INTO dim_key FROM public.dimensions WHERE kind = dim_kind AND value = dim_value;
+    END IF;
+  END IF;
+  RETURN dim_key;
+END;
+$$;
+
+-- Lookup only, for readers (and read replicas): key of (kind, value), NULL
+-- when the value has none yet
+CREATE OR REPLACE FUNCTION public.dimension_key(dim_kind text, dim_value text)
+RETURNS integer LANGUAGE sql STABLE AS $$
+  SELECT id FROM public.dimensions WHERE kind = dim_kind AND value = dim_value
+$$;
+
+ALTER TABLE public.page_views
+  ADD COLUMN IF NOT EXISTS country_id integer NULL,
+  ADD COLUMN IF NOT EXISTS city_id integer NULL,
+  ADD COLUMN IF NOT EXISTS isp_id integer NULL,
+  ADD COLUMN IF NOT EXISTS device_type_id integer NULL,
+  ADD COLUMN IF NOT EXISTS browser_id integer NULL,
+  ADD COLUMN IF NOT EXISTS operating_system_id integer NULL,
+  ADD COLUMN IF NOT EXISTS user_agent_id integer NULL;
+
+ALTER TABLE public.visitors
+  ADD COLUMN IF NOT EXISTS country_id integer NULL,
+  ADD COLUMN IF NOT EXISTS city_id integer NULL,
+  ADD COLUMN IF NOT EXISTS isp_id integer NULL,
+  ADD COLUMN IF NOT EXISTS device_type_id integer NULL,
+  ADD COLUMN IF NOT EXISTS browser_id integer NULL,
+  ADD COLUMN IF NOT EXISTS operating_system_id integer NULL,
+  ADD COLUMN IF NOT EXISTS user_agent_id integer NULL;
+
+-- Writers that still send text (seed.py, older app versions during a
+-- rollout) are encoded on the way in, so the text columns stay NULL and
+-- readers only ever need the keys.
+CREATE OR REPLACE FUNCTION public.encode_dimensions()
+RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  IF NEW.country IS NOT NULL THEN
+    NEW.country_id := public.dimension_id('country', NEW.country);
+    NEW.country := NULL;
+  END IF;
+  IF NEW.city IS NOT NULL THEN
+    NEW.city_id := public.dimension_id('city', NEW.city);
+    NEW.city := NULL;
+  END IF;
+  IF NEW.isp IS NOT NULL THEN
+    NEW.isp_id := public.dimension_id('isp', NEW.isp);
+    NEW.isp := NULL;
+  END IF;
+  IF NEW.device_type IS NOT NULL THEN
+    NEW.device_type_id := public.dimension_id('device_type', NEW.device_type);
+    NEW.device_type := NULL;
+  END IF;
+  IF NEW.browser IS NOT NULL THEN
+    NEW.browser_id := public.dimension_id('browser', NEW.browser);
+    NEW.browser := NULL;
+  END IF;
+  IF NEW.operating_system IS NOT NULL THEN
+    NEW.operating_system_id := public.dimension_id('operating_system', NEW.operating_system);
+    NEW.operating_system := NULL;
+  END IF;
+  IF NEW.user_agent IS NOT NULL THEN
+    NEW.user_agent_id := public.dimension_id('user_agent', NEW.user_agent);
+    NEW.user_agent := NULL;
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER page_views_encode_dimensions
+  BEFORE INSERT OR UPDATE ON public.page_views
+  FOR EACH ROW EXECUTE FUNCTION public.encode_dimensions();
+CREATE OR REPLACE TRIGGER visitors_encode_dimensions
+  BEFORE INSERT OR UPDATE ON public.visitors
+  FOR EACH ROW EXECUTE FUNCTION public.encode_dimensions();
+
+-- Rows written before this migration keep their text columns until
+-- ``python dimensions.py --backfill`` encodes them, a batch of ids per
+-- transaction; until then readers resolve their keys with dimension_key().
+
+-- The filter indexes follow the data from text to keys
+DROP INDEX IF EXISTS public.visitors_country_idx;
+DROP INDEX IF EXISTS public.visitors_device_type_idx;
+DROP INDEX IF EXISTS public.visitors_browser_idx;
+CREATE INDEX IF NOT EXISTS visitors_country_id_idx ON public.visitors (country_id);
+CREATE INDEX IF NOT EXISTS visitors_device_type_id_idx ON public.visitors (device_type_id);
+CREATE INDEX IF NOT EXISTS visitors_browser_id_idx ON public.visitors (browser_id);
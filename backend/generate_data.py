@@ -0,0 +1,361 @@
+"""Scalable synthetic visitor data for benchmarks.
+
+``seed.py`` inserts a few hundred hand-picked rows for demos; this script
+produces tens or hundreds of millions with realistic shape:
+
+* Zipfian page and IP popularity (a few hot pages / heavy repeat visitors,
+  a very long tail of one-off IPs);
+* a diurnal traffic curve (IST office hours) with weekday/weekend variation
+  and slow growth over a multi-year span;
+* repeat visitors, because popular IPs recur across days and sessions.
+
+Rows are generated in fixed-size chunks, each from its own RNG seeded from
+``(seed, chunk number)``, so the dataset is identical for a given seed no
+matter how many worker processes share the work.  Each worker streams its
+chunks into Postgres with ``COPY ... FROM STDIN``; nothing is buffered
+beyond one read block.
+
+The text dimensions are COPYed as their public.dimensions keys (resolved
+once per worker for the generator's small vocabulary), so the load does not
+go through dimension_id() row by row.  With shard databases configured
+(SHARD_DSN_*, see shards.py) each row goes to the shard of its page's site;
+every worker then generates its chunks once per shard and keeps that
+shard's rows.
+
+    python generate_data.py --rows 10000000 --workers 8 --seed 1
+    python generate_data.py --rows 1000 --stdout | head     # inspect rows
+"""
+import argparse
+import array
+import bisect
+import datetime
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+import uuid
+
+import psycopg2
+
+from dimensions import DIMENSIONS
+from shards import ShardRouter, shard_connectors
+from sites_config import SITES
+
+COPY_COLUMNS = (
+    'session_id', 'public_ip', 'country', 'country_code', 'city', 'isp',
+    'page_visited', 'user_agent', 'device_type', 'browser', 'operating_system',
+    'first_seen', 'created_at', 'time_spent_seconds',
+)
+# What is loaded: the dimension columns as keys
+LOAD_COLUMNS = tuple(f'{column}_id' if column in DIMENSIONS else column for column in COPY_COLUMNS)
+_KEYED = [(i, column) for i, column in enumerate(COPY_COLUMNS) if column in DIMENSIONS]
+_PAGE = COPY_COLUMNS.index('page_visited')
+
+CHUNK_ROWS = 100_000
+
+# (country, code, weight, [(city, isp), ...])
+GEO = [
+    ("India", "IN", 80, [("Chennai", "Jio"), ("Chennai", "BSNL"), ("Mumbai", "Airtel"),
+                         ("Bengaluru", "ACT Fibernet"), ("Delhi", "Jio"), ("Hyderabad", "Airtel"),
+                         ("Coimbatore", "BSNL"), ("Madurai", "Jio")]),
+    ("United States", "US", 8, [("Ashburn", "Amazon.com"), ("Austin", "Comcast"), ("Seattle", "Verizon")]),
+    ("United Kingdom", "GB", 3, [("London", "Vodafone"), ("Manchester", "BT")]),
+    ("Germany", "DE", 3, [("Frankfurt", "Deutsche Telekom"), ("Berlin", "Vodafone")]),
+    ("Singapore", "SG", 3, [("Singapore", "Singtel")]),
+    ("United Arab Emirates", "AE", 3, [("Dubai", "Etisalat")]),
+]
+
+# (user agent, device_type, browser, operating_system, weight)
+USER_AGENTS = [
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+     "Desktop", "Chrome", "Windows", 40),
+    ("Mozilla/5.0 (Linux; Android 14; SM-A546E) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Mobile Safari/537.36",
+     "Mobile", "Chrome Mobile", "Android", 30),
+    ("Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1",
+     "Mobile", "Mobile Safari", "iOS", 8),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15",
+     "Desktop", "Safari", "Mac OS X", 6),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36 Edg/124.0",
+     "Desktop", "Edge", "Windows", 8),
+    ("Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+     "Desktop", "Firefox", "Linux", 4),
+    ("Mozilla/5.0 (iPad; CPU OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1",
+     "Tablet", "Mobile Safari", "iOS", 4),
+]
+
+# Relative traffic per hour of day (UTC); peaks at 10:00–17:00 IST
+DIURNAL = [6, 8, 9, 9, 10, 10, 10, 9, 9, 9, 10, 8, 6, 5, 4, 3, 2, 1.5, 1, 1, 1, 1.5, 2, 4]
+WEEKDAY_FACTOR = [1.0, 1.0, 1.0, 1.0, 0.95, 0.45, 0.35]
+
+PAGE_PATHS = ["", "/", "/login", "/dashboard", "/reports", "/reports/daily", "/users",
+              "/settings", "/search", "/help"]
+
+
+class ZipfSampler:
+    """Draw ranks 0..n-1 with P(k) ∝ 1/(k+1)^s via a cumulative table."""
+
+    def __init__(self, n, s=1.1):
+        # array('d') keeps a multi-million entry table at 8 bytes per rank
+        self.cumulative = array.array('d', itertools.accumulate(1.0 / (k + 1) ** s for k in range(n)))
+        self.total = self.cumulative[-1]
+
+    def sample(self, rng):
+        return bisect.bisect_left(self.cumulative, rng.random() * self.total)
+
+
+class WeightedChoice:
+    def __init__(self, items, weights):
+        self.items = items
+        self.cumulative = list(itertools.accumulate(weights))
+        self.total = self.cumulative[-1]
+
+    def sample(self, rng):
+        return self.items[bisect.bisect_left(self.cumulative, rng.random() * self.total)]
+
+
+class Generator:
+    """Deterministic row factory shared by every worker."""
+
+    def __init__(self, seed, start, end, distinct_ips=2_000_000, distinct_pages=5_000):
+        self.seed = seed
+        self.start = start
+        self.end = end
+        self.ip_ranks = ZipfSampler(distinct_ips, s=1.05)
+        self.page_ranks = ZipfSampler(distinct_pages, s=1.2)
+        site_urls = [site["url"].rstrip("/") for site in SITES.values() if site.get("url")]
+        self.pages = [
+            site_urls[k % len(site_urls)] + PAGE_PATHS[(k // len(site_urls)) % len(PAGE_PATHS)]
+            + (f"/{k}" if k >= len(site_urls) * len(PAGE_PATHS) else "")
+            for k in range(distinct_pages)
+        ]
+        self.user_agents = WeightedChoice(USER_AGENTS, [ua[-1] for ua in USER_AGENTS])
+        self.geo = WeightedChoice(GEO, [g[2] for g in GEO])
+        self.days = self._day_weights()
+        self.hours = WeightedChoice(list(range(24)), DIURNAL)
+
+    def _day_weights(self):
+        days = []
+        weights = []
+        total_days = max(1, (self.end - self.start).days)
+        for i in range(total_days):
+            day = self.start + datetime.timedelta(days=i)
+            # ~40% growth per year on top of the weekly pattern
+            growth = 1.4 ** (i / 365.0)
+            days.append(day)
+            weights.append(growth * WEEKDAY_FACTOR[day.weekday()])
+        return WeightedChoice(days, weights)
+
+    def ip_for_rank(self, rank):
+        # spread ranks over the address space deterministically (multiplicative
+        # hash) so hot IPs don't all share a /24
+        x = (rank * 2654435761 + self.seed) & 0xFFFFFFFF
+        return f"{(x >> 24) % 223 + 1}.{(x >> 16) & 255}.{(x >> 8) & 255}.{x & 255}"
+
+    def ip_profile(self, rank):
+        # an IP keeps its location and (mostly) its device across visits
+        rng = random.Random(self.seed * 7919 + rank)
+        country, code, _, cities = self.geo.sample(rng)
+        city, isp = rng.choice(cities)
+        return country, code, city, isp, self.user_agents.sample(rng)
+
+    def rows(self, chunk, count):
+        """Yield ``count`` rows for chunk number ``chunk`` (tuples in COPY_COLUMNS order)."""
+        rng = random.Random(f"{self.seed}:{chunk}")
+        profiles = {}
+        for _ in range(count):
+            rank = self.ip_ranks.sample(rng)
+            profile = profiles.get(rank)
+            if profile is None:
+                profile = profiles[rank] = self.ip_profile(rank)
+            country, code, city, isp, ua = profile
+            if rng.random() < 0.1:
+                ua = self.user_agents.sample(rng)
+            day = self.days.sample(rng)
+            first_seen = datetime.datetime(
+                day.year, day.month, day.day, self.hours.sample(rng),
+                rng.randrange(60), rng.randrange(60), rng.randrange(1_000_000),
+                tzinfo=datetime.timezone.utc,
+            )
+            # log-normal dwell time, clamped like /log/time does
+            time_spent = min(86400, int(rng.lognormvariate(3.8, 1.2))) if rng.random() < 0.85 else None
+            yield (
+                uuid.UUID(int=rng.getrandbits(128), version=4), self.ip_for_rank(rank),
+                country, code, city, isp,
+                self.pages[self.page_ranks.sample(rng)], ua[0], ua[1], ua[2], ua[3],
+                first_seen, first_seen + datetime.timedelta(seconds=rng.randrange(5)), time_spent,
+            )
+
+
+def vocabulary():
+    """Every (dimension, value) pair the generator can emit."""
+    pairs = set()
+    for country, _, _, places in GEO:
+        pairs.add(('country', country))
+        for city, isp in places:
+            pairs.update((('city', city), ('isp', isp)))
+    for user_agent, device_type, browser, operating_system, _ in USER_AGENTS:
+        pairs.update((('user_agent', user_agent), ('device_type', device_type),
+                      ('browser', browser), ('operating_system', operating_system)))
+    return sorted(pairs)
+
+
+def resolve_keys(cur, pairs):
+    """``{(dimension, value): key}``, creating the keys that don't exist yet."""
+    cur.execute("""
+        SELECT kind, value, public.dimension_id(kind, value)
+        FROM unnest(%s::text[], %s::text[]) AS t(kind, value)
+    """, ([kind for kind, _ in pairs], [value for _, value in pairs]))
+    return {(kind, value): key for kind, value, key in cur.fetchall()}
+
+
+def encode_rows(rows, keys):
+    """Rows in ``COPY_COLUMNS`` order → ``LOAD_COLUMNS`` order."""
+    for row in rows:
+        row = list(row)
+        for i, column in _KEYED:
+            if row[i] is not None:
+                row[i] = keys[(column, row[i])]
+        yield row
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    # text-format COPY: escape backslash and the delimiters
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_lines(rows):
+    for row in rows:
+        yield ('\t'.join(_copy_value(v) for v in row) + '\n').encode('utf-8')
+
+
+class RowStream:
+    """File-like view of an iterator of encoded COPY lines (for ``copy_expert``)."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = b''
+
+    def read(self, size=65536):
+        while len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def chunk_plan(total_rows, chunk_rows=CHUNK_ROWS):
+    """[(chunk number, row count), ...] covering ``total_rows``."""
+    return [
+        (k, min(chunk_rows, total_rows - k * chunk_rows))
+        for k in range(math.ceil(total_rows / chunk_rows))
+    ]
+
+
+def get_db_connection():
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        database=os.environ.get("DB_NAME", "trac_db"),
+        user=os.environ.get("DB_USER", "trac_user"),
+        password=os.environ.get("DB_PASS", "trac_password"),
+        port=os.environ.get("DB_PORT", "5432"),
+    )
+
+
+def _tally(rows, counts, key):
+    for row in rows:
+        counts[key] += 1
+        yield row
+
+
+def _worker(args):
+    worker_id, chunks, generator_kwargs = args
+    generator = Generator(**generator_kwargs)
+    router = ShardRouter.from_environ(get_db_connection)
+    written = {}
+    for shard, connect in shard_connectors(get_db_connection):
+        conn = connect()
+        try:
+            cur = conn.cursor()
+            # keys are per database
+            keys = resolve_keys(cur, vocabulary())
+            conn.commit()
+            written[shard] = 0
+            for chunk, count in chunks:
+                rows = generator.rows(chunk, count)
+                if router.sharded:
+                    rows = _tally((row for row in rows if router.for_page(row[_PAGE]) == shard), written, shard)
+                else:
+                    written[shard] += count
+                cur.copy_expert(
+                    f"COPY public.visitors ({', '.join(LOAD_COLUMNS)}) FROM STDIN",
+                    RowStream(copy_lines(encode_rows(rows, keys))),
+                )
+                # commit per chunk: a failure loses at most one chunk of work
+                conn.commit()
+        finally:
+            conn.close()
+    return worker_id, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate large synthetic visitor datasets.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--years", type=float, default=3.0, help="span of first_seen values")
+    parser.add_argument("--end-date", help="last day of the span (YYYY-MM-DD, default: today)")
+    parser.add_argument("--distinct-ips", type=int, default=2_000_000)
+    parser.add_argument("--distinct-pages", type=int, default=5_000)
+    parser.add_argument("--stdout", action="store_true", help="write COPY text to stdout instead of loading")
+    args = parser.parse_args()
+
+    end = (datetime.date.fromisoformat(args.end_date) if args.end_date
+           else datetime.date.today()) + datetime.timedelta(days=1)
+    start = end - datetime.timedelta(days=max(1, int(args.years * 365)))
+    generator_kwargs = {
+        "seed": args.seed, "start": start, "end": end,
+        "distinct_ips": args.distinct_ips, "distinct_pages": args.distinct_pages,
+    }
+    plan = chunk_plan(args.rows)
+
+    if args.stdout:
+        generator = Generator(**generator_kwargs)
+        out = sys.stdout.buffer
+        for chunk, count in plan:
+            out.writelines(copy_lines(generator.rows(chunk, count)))
+        return
+
+    workers = max(1, min(args.workers, len(plan)))
+    # round-robin so every worker gets a similar share of the chunks
+    assignments = [(w, plan[w::workers], generator_kwargs) for w in range(workers)]
+    print(f"Generating {args.rows:,} rows in {len(plan)} chunks with {workers} workers "
+          f"(seed={args.seed}, {start} → {end})")
+    started = time.time()
+    with multiprocessing.Pool(workers) as pool:
+        total = 0
+        for worker_id, written in pool.imap_unordered(_worker, assignments):
+            total += sum(written.values())
+            print(f"  worker {worker_id}: " + ", ".join(f"{n:,} rows → {shard}" for shard, n in written.items()))
+    elapsed = time.time() - started
+    print(f"Loaded {total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+    for _, connect in shard_connectors(get_db_connection):
+        conn = connect()
+        try:
+            conn.autocommit = True
+            conn.cursor().execute("ANALYZE public.visitors")
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
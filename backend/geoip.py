@@ -0,0 +1,243 @@
+# Server-side IP → geo enrichment from a local range database
+#
+# /track used to store whatever country / city / isp the client sent.  With
+# GEOIP_DATABASE set, the fields come from a local file instead:
+#
+# * ``.mmdb`` (MaxMind GeoIP2 / GeoLite2 / DB-IP binary format): read with
+#   ``maxminddb`` in MODE_MMAP, so the tree is memory-mapped and shared by
+#   every worker through the page cache;
+# * ``.csv``: one range per row, with a header naming the columns —
+#   ``start_ip,end_ip`` (dotted / colon form or integers) or ``network``
+#   (CIDR), plus any of ``country_code``, ``country``, ``city``, ``isp``
+#   (MaxMind's ``country_iso_code``, ``country_name``, ``city_name`` and
+#   ``autonomous_system_organization`` are accepted too).  Ranges are
+#   sorted into parallel arrays of range starts / ends and record indexes,
+#   and looked up with a binary search: O(log n), a few bytes per range, with
+#   identical records stored once.  Ranges must not overlap, which holds for
+#   the usual datasets.
+#
+# The file's mtime is checked every ``check_seconds``; a changed file is
+# loaded on a thread started by the lookup that noticed it and swapped in
+# whole, and the lookup cache starts over.  A file that fails to load leaves
+# the previous index in place.  Lookups never touch the network.
+
+import bisect
+import csv
+import ipaddress
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+
+GeoRecord = namedtuple('GeoRecord', 'country_code country city isp')
+
+# CSV header aliases → GeoRecord field
+COLUMN_ALIASES = {
+    'country_code': 'country_code',
+    'country_iso_code': 'country_code',
+    'country': 'country',
+    'country_name': 'country',
+    'city': 'city',
+    'city_name': 'city',
+    'isp': 'isp',
+    'organization': 'isp',
+    'autonomous_system_organization': 'isp',
+}
+
+_MAX_IPV4 = 2 ** 32 - 1
+
+
+def _address(value):
+    """IP text or integer → ``(version, int)``; IPv4-mapped IPv6 counts as IPv4."""
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return (4 if number <= _MAX_IPV4 else 6), number
+    address = ipaddress.ip_address(value)
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.version, int(address)
+
+
+class RangeIndex:
+    """Sorted, non-overlapping IP ranges in parallel arrays."""
+
+    def __init__(self, ranges):
+        """``ranges``: iterable of ``(version, start, end, GeoRecord)``."""
+        records, positions = [], {}
+        rows = {4: [], 6: []}
+        for version, start, end, record in ranges:
+            position = positions.get(record)
+            if position is None:
+                position = positions[record] = len(records)
+                records.append(record)
+            rows[version].append((start, end, position))
+        self._records = records
+        self._tables = {}
+        for version, table in rows.items():
+            table.sort()
+            if version == 4:
+                starts, ends = array('L', (r[0] for r in table)), array('L', (r[1] for r in table))
+            else:
+                # 128-bit values don't fit an array type
+                starts, ends = [r[0] for r in table], [r[1] for r in table]
+            self._tables[version] = (starts, ends, array('L', (r[2] for r in table)))
+
+    def __len__(self):
+        return sum(len(starts) for starts, _, _ in self._tables.values())
+
+    def lookup(self, ip):
+        try:
+            version, number = _address(ip)
+        except ValueError:
+            return None
+        starts, ends, positions = self._tables[version]
+        i = bisect.bisect_right(starts, number) - 1
+        if i >= 0 and number <= ends[i]:
+            return self._records[positions[i]]
+        return None
+
+    @classmethod
+    def from_csv(cls, path):
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            fields = {name.strip().lower(): name for name in reader.fieldnames or ()}
+            columns = {
+                COLUMN_ALIASES[key]: name
+                for key, name in fields.items() if key in COLUMN_ALIASES
+            }
+
+            def ranges():
+                for row in reader:
+                    if 'network' in fields:
+                        network = ipaddress.ip_network(row[fields['network']].strip(), strict=False)
+                        version = network.version
+                        start, end = int(network.network_address), int(network.broadcast_address)
+                    else:
+                        version, start = _address(row[fields['start_ip']])
+                        _, end = _address(row[fields['end_ip']])
+                    yield version, start, end, GeoRecord(*(
+                        (row.get(columns[field]) or '').strip() or None if field in columns else None
+                        for field in GeoRecord._fields
+                    ))
+
+            if 'network' not in fields and not {'start_ip', 'end_ip'} <= fields.keys():
+                raise ValueError(f"{path}: need a 'network' or 'start_ip'/'end_ip' column")
+            return cls(ranges())
+
+
+class MmdbIndex:
+    """A memory-mapped MaxMind DB file."""
+
+    def __init__(self, path):
+        import maxminddb  # only needed for .mmdb files
+
+        self._reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    def lookup(self, ip):
+        try:
+            data = self._reader.get(ip)
+        except ValueError:
+            return None
+        if not data:
+            return None
+        country = data.get('country') or data.get('registered_country') or {}
+        return GeoRecord(
+            country.get('iso_code'),
+            (country.get('names') or {}).get('en'),
+            ((data.get('city') or {}).get('names') or {}).get('en'),
+            data.get('isp') or data.get('organization') or data.get('autonomous_system_organization'),
+        )
+
+
+def load_index(path):
+    if path.lower().endswith('.mmdb'):
+        return MmdbIndex(path)
+    return RangeIndex.from_csv(path)
+
+
+class GeoDatabase:
+    """IP → GeoRecord lookups with a result cache and hot reload."""
+
+    def __init__(self, path, check_seconds=60.0, cache_size=50000, load=load_index,
+                 clock=time.monotonic, logger=None):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.cache_size = cache_size
+        self._load = load
+        self._clock = clock
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._index = None
+        self._mtime = None
+        self._reloader = None
+        self._cache = OrderedDict()
+        self.reload()
+        self._checked_at = clock()
+
+    def reload(self):
+        """Load the file if it changed since the last load; True when swapped in."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self._logger:
+                self._logger.error(f"GeoIP database unavailable: {e}")
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            index = self._load(self.path)
+        except Exception as e:
+            if self._logger:
+                self._logger.error(f"Error loading GeoIP database {self.path}: {e}")
+            return False
+        with self._lock:
+            # the old index is left to the GC: lookups may still be using it
+            self._index, self._mtime = index, mtime
+            self._cache = OrderedDict()
+        if self._logger:
+            self._logger.info(f"Loaded GeoIP database {self.path}")
+        return True
+
+    def _maybe_reload(self):
+        now = self._clock()
+        with self._lock:
+            if now - self._checked_at < self.check_seconds:
+                return
+            if self._reloader is not None and self._reloader.is_alive():
+                return
+            self._checked_at = now
+            # stat / load off the request path; lookups keep using the old index
+            self._reloader = threading.Thread(target=self.reload, name='geoip-reload', daemon=True)
+            self._reloader.start()
+
+    def lookup(self, ip):
+        """GeoRecord for ``ip``, or None when unknown (or no database is loaded)."""
+        if not ip:
+            return None
+        self._maybe_reload()
+        with self._lock:
+            index, cache = self._index, self._cache
+            if ip in cache:
+                cache.move_to_end(ip)
+                return cache[ip]
+        if index is None:
+            return None
+        record = index.lookup(ip)
+        with self._lock:
+            # skip if a reload replaced the cache meanwhile
+            if cache is self._cache:
+                cache[ip] = record
+                while len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+        return record
+
+    def status(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'loaded': self._index is not None,
+                'ranges': len(self._index) if isinstance(self._index, RangeIndex) else None,
+                'cached': len(self._cache),
+            }
@@ -0,0 +1,62 @@
+# gunicorn settings (used by the Docker image: ``gunicorn -c gunicorn.conf.py app:app``)
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("GUNICORN_WORKERS", "4"))
+# Threaded workers so long-lived SSE connections (/api/live/stream) don't
+# each pin a whole worker process; LIVE_MAX_STREAMS keeps them from taking
+# every thread.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = 120
+
+# Workers write their Prometheus metrics to files here so /metrics can sum
+# them (see metrics.py).  Must be set before any worker imports the app;
+# /dev/shm keeps the files in memory when available.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                 "analytics-metrics"),
+)
+
+
+def on_starting(server):
+    """Bring the schema up to date once, in the master, before workers fork.
+
+    Cold workers then serve their first request without any DDL.  A failure
+    is logged rather than fatal so an unreachable database doesn't put the
+    container into a restart loop; run ``python migrations.py`` to retry.
+
+    Also empties the metrics directory: values left by a previous master
+    would otherwise be summed into the new counters.
+    """
+    from migrations import apply_migrations, get_db_connection
+    from shards import shard_connectors
+
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    # the main database and every shard database (shards.py)
+    for shard, connect in shard_connectors(get_db_connection):
+        try:
+            conn = connect()
+            try:
+                apply_migrations(conn, log=server.log.info)
+            finally:
+                conn.close()
+        except Exception as e:
+            server.log.error(f"Error applying migrations to shard {shard}: {e}")
+
+
+def child_exit(server, worker):
+    """Drop the exited worker's per-process gauges from /metrics.
+
+    Calls prometheus_client directly: importing metrics.py here would create
+    the master's own worker_resident_memory_bytes series.
+    """
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,227 @@
+# Streaming heavy hitters (top-K) for high-cardinality dimensions
+#
+# ``/track`` offers every hit to a Space-Saving summary per dimension and
+# per hour bucket.  Summaries are flushed to ``public.sketch_buckets`` in the
+# background and merged on read, so "top N pages/cities/ISPs/IPs" for any
+# range costs a handful of small JSON documents instead of a GROUP BY over
+# every raw row.
+#
+# Error guarantees (Metwally et al., "Efficient Computation of Frequent and
+# Top-k Elements in Data Streams"): a summary with ``capacity`` k that has
+# seen N hits reports, for every tracked item, a count c with
+#
+#     true_count <= c <= true_count + error <= true_count + N / k
+#
+# and every item whose true count exceeds N / k is guaranteed to be tracked.
+# Merging summaries (Cafaro et al.) keeps the same bound with N the combined
+# total, so a merged range is as accurate as a single summary over that range.
+# Ranges are resolved at bucket granularity (one hour).
+
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2.extras import Json
+
+# Dimensions tracked at ingest → key in the /track payload they come from
+HEAVY_HITTER_DIMENSIONS = ('page', 'city', 'isp', 'ip', 'browser')
+
+DEFAULT_CAPACITY = 200
+BUCKET_SECONDS = 3600
+
+
+class SpaceSaving:
+    """Space-Saving summary with at most ``capacity`` counters."""
+
+    kind = 'space_saving'
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.total = 0
+        # item -> [count, error]
+        self.counters = {}
+
+    def offer(self, item, n=1):
+        self.total += n
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += n
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [n, 0]
+            return
+        # evict the smallest counter; the newcomer inherits its count as
+        # potential overestimation
+        victim = min(self.counters, key=lambda k: self.counters[k][0])
+        floor = self.counters.pop(victim)[0]
+        self.counters[item] = [floor + n, floor]
+
+    def _floor(self):
+        # Upper bound for the count of any item this summary is *not* tracking
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(c[0] for c in self.counters.values())
+
+    def merge(self, other):
+        """Fold ``other`` into this summary (in place) and return ``self``."""
+        floor_a, floor_b = self._floor(), other._floor()
+        merged = {}
+        for item in self.counters.keys() | other.counters.keys():
+            count_a, err_a = self.counters.get(item, (floor_a, floor_a))
+            count_b, err_b = other.counters.get(item, (floor_b, floor_b))
+            merged[item] = [count_a + count_b, err_a + err_b]
+        capacity = max(self.capacity, other.capacity)
+        if len(merged) > capacity:
+            keep = sorted(merged, key=lambda k: merged[k][0], reverse=True)[:capacity]
+            merged = {k: merged[k] for k in keep}
+        self.capacity = capacity
+        self.total += other.total
+        self.counters = merged
+        return self
+
+    def top(self, n=10):
+        """Return ``[(item, count, error), ...]`` for the ``n`` largest counters."""
+        ranked = sorted(self.counters.items(), key=lambda kv: kv[1][0], reverse=True)
+        return [(item, count, error) for item, (count, error) in ranked[:n]]
+
+    @property
+    def max_error(self):
+        return self.total / self.capacity if self.capacity else 0
+
+    def to_dict(self):
+        return {
+            'capacity': self.capacity,
+            'total': self.total,
+            'items': [[k, c, e] for k, (c, e) in self.counters.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get('capacity', DEFAULT_CAPACITY))
+        sketch.total = data.get('total', 0)
+        sketch.counters = {k: [c, e] for k, c, e in data.get('items', [])}
+        return sketch
+
+
+def bucket_start(ts, bucket_seconds=BUCKET_SECONDS):
+    """Truncate a unix timestamp to the start of its bucket (UTC datetime)."""
+    return datetime.fromtimestamp(int(ts // bucket_seconds) * bucket_seconds, timezone.utc)
+
+
+class SketchBuffer:
+    """Accumulates sketches in memory per (dimension, bucket) and flushes them.
+
+    Flushing merges the in-memory sketch into the stored one under a row
+    lock, so several gunicorn workers can share the same bucket rows.
+    """
+
+    def __init__(self, connect, factory, kind, flush_seconds=30.0,
+                 bucket_seconds=BUCKET_SECONDS, clock=time.time, logger=None,
+                 background=True):
+        self._connect = connect
+        self._factory = factory
+        self.kind = kind
+        self.flush_seconds = flush_seconds
+        self.bucket_seconds = bucket_seconds
+        self._clock = clock
+        self._logger = logger
+        # False: only explicit flush() calls write (batch jobs)
+        self._background = background
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def record(self, values, n=1, at=None):
+        """Offer ``values`` (dimension → item) to the bucket of ``at`` (unix
+        time, default now)."""
+        bucket = bucket_start(self._clock() if at is None else at, self.bucket_seconds)
+        with self._lock:
+            for dimension, item in values.items():
+                if item is None or item == '':
+                    continue
+                key = (dimension, bucket)
+                sketch = self._pending.get(key)
+                if sketch is None:
+                    sketch = self._pending[key] = self._factory()
+                sketch.offer(item, n)
+            if self._background and self._pending and (self._flusher is None or not self._flusher.is_alive()):
+                self._flusher = threading.Thread(
+                    target=self._flush_loop, name=f'{self.kind}-flush', daemon=True
+                )
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f"Error flushing {self.kind} sketches: {e}")
+            with self._lock:
+                if not self._pending:
+                    self._flusher = None
+                    return
+
+    def flush(self):
+        """Write all pending sketches to the database."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        conn = None
+        try:
+            conn = self._connect()
+            cur = conn.cursor()
+            # a fixed order, so two workers flushing the same buckets can't
+            # deadlock on each other's row locks
+            for (dimension, bucket), sketch in sorted(pending.items(), key=lambda kv: kv[0]):
+                # create the row first: FOR UPDATE locks nothing that does not
+                # exist yet, and two workers both inserting a new bucket would
+                # otherwise overwrite each other's sketch
+                cur.execute("""
+                    INSERT INTO public.sketch_buckets (kind, dimension, bucket_start, sketch, updated_at)
+                    VALUES (%s, %s, %s, %s, now())
+                    ON CONFLICT (kind, dimension, bucket_start) DO NOTHING
+                """, (self.kind, dimension, bucket, Json(self._factory().to_dict())))
+                cur.execute("""
+                    SELECT sketch FROM public.sketch_buckets
+                    WHERE kind = %s AND dimension = %s AND bucket_start = %s
+                    FOR UPDATE
+                """, (self.kind, dimension, bucket))
+                stored = type(sketch).from_dict(cur.fetchone()[0])
+                cur.execute("""
+                    UPDATE public.sketch_buckets
+                    SET sketch = %s, updated_at = now()
+                    WHERE kind = %s AND dimension = %s AND bucket_start = %s
+                """, (Json(stored.merge(sketch).to_dict()), self.kind, dimension, bucket))
+            conn.commit()
+            return len(pending)
+        except Exception:
+            if conn:
+                conn.rollback()
+            # put the unsent sketches back so the next flush retries them
+            with self._lock:
+                for key, sketch in pending.items():
+                    current = self._pending.get(key)
+                    self._pending[key] = sketch.merge(current) if current else sketch
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+
+def load_merged(cur, kind, dimension, start, end, factory):
+    """Merge every stored sketch for ``dimension`` whose bucket overlaps the range."""
+    cur.execute("""
+        SELECT sketch FROM public.sketch_buckets
+        WHERE kind = %s AND dimension = %s
+          AND (%s::timestamptz IS NULL OR bucket_start > %s::timestamptz - %s * interval '1 second')
+          AND (%s::timestamptz IS NULL OR bucket_start <= %s::timestamptz)
+    """, (kind, dimension, start, start, BUCKET_SECONDS, end, end))
+    merged = factory()
+    for row in cur.fetchall():
+        sketch = row['sketch'] if isinstance(row, dict) else row[0]
+        merged.merge(type(merged).from_dict(sketch))
+    return merged
@@ -0,0 +1,78 @@
+-- public_ip as inet instead of text: 7 bytes per IPv4 address (19 for IPv6)
+-- instead of a string, one canonical spelling per address, and CIDR range
+-- filters (ip_filter = '203.0.113.0/24') served by an SP-GiST index through
+-- ``<<=``.  New installs create the columns as inet (table.sql,
+-- page_views.sql, retention.sql); this converts databases created before.
+
+-- NULL for anything that is not an IP address (the column used to take
+-- whatever the client sent)
+CREATE OR REPLACE FUNCTION public.try_inet(value text)
+RETURNS inet LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+  RETURN NULLIF(btrim(value), '')::inet;
+EXCEPTION WHEN invalid_text_representation THEN
+  RETURN NULL;
+END;
+$$;
+
+DO $$
+BEGIN
+  -- ALTER on the partitioned parent converts every partition
+  IF (SELECT data_type FROM information_schema.columns
+      WHERE table_schema = 'public' AND table_name = 'page_views' AND column_name = 'public_ip') = 'text' THEN
+    ALTER TABLE public.page_views ALTER COLUMN public_ip TYPE inet USING public.try_inet(public_ip);
+  END IF;
+
+  IF (SELECT data_type FROM information_schema.columns
+      WHERE table_schema = 'public' AND table_name = 'visitors' AND column_name = 'public_ip') = 'text' THEN
+    ALTER TABLE public.visitors ALTER COLUMN public_ip TYPE inet USING public.try_inet(public_ip);
+  END IF;
+
+  -- The roll-ups are keyed on the address: spellings of the same address
+  -- (and invalid values, which all become NULL) are merged rather than
+  -- colliding on the unique keys
+  IF (SELECT data_type FROM information_schema.columns
+      WHERE table_schema = 'public' AND table_name = 'ip_visit_totals' AND column_name = 'public_ip') = 'text' THEN
+    CREATE TEMP TABLE ip_visit_totals_merged ON COMMIT DROP AS
+      SELECT public.try_inet(public_ip) AS public_ip, SUM(visits)::bigint AS visits
+      FROM public.ip_visit_totals
+      GROUP BY 1;
+    TRUNCATE public.ip_visit_totals;
+    ALTER TABLE public.ip_visit_totals ALTER COLUMN public_ip TYPE inet USING NULL;
+    INSERT INTO public.ip_visit_totals (public_ip, visits)
+      SELECT public_ip, visits FROM ip_visit_totals_merged WHERE public_ip IS NOT NULL;
+  END IF;
+
+  IF (SELECT data_type FROM information_schema.columns
+      WHERE table_schema = 'public' AND table_name = 'visitor_daily' AND column_name = 'public_ip') = 'text' THEN
+    CREATE TEMP TABLE visitor_daily_merged ON COMMIT DROP AS
+      SELECT
+        day, public.try_inet(public_ip) AS public_ip, country_id, country_code, city_id, isp_id,
+        page_visited, device_type_id, browser_id, operating_system_id,
+        SUM(visits)::bigint AS visits, SUM(time_total)::bigint AS time_total,
+        SUM(time_count)::bigint AS time_count
+      FROM public.visitor_daily
+      GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9, 10;
+    TRUNCATE public.visitor_daily;
+    ALTER TABLE public.visitor_daily ALTER COLUMN public_ip TYPE inet USING NULL;
+    INSERT INTO public.visitor_daily (
+      day, public_ip, country_id, country_code, city_id, isp_id,
+      page_visited, device_type_id, browser_id, operating_system_id,
+      visits, time_total, time_count
+    )
+    SELECT
+      day, public_ip, country_id, country_code, city_id, isp_id,
+      page_visited, device_type_id, browser_id, operating_system_id,
+      visits, time_total, time_count
+    FROM visitor_daily_merged;
+  END IF;
+END;
+$$;
+
+-- SP-GiST (radix tree over the address bits) answers both equality and
+-- ``<<=`` containment; it replaces the text btree
+DROP INDEX IF EXISTS public.visitors_public_ip_idx;
+CREATE INDEX IF NOT EXISTS visitors_public_ip_spgist
+  ON public.visitors USING spgist (public_ip inet_ops);
+CREATE INDEX IF NOT EXISTS visitor_daily_public_ip_spgist
+  ON public.visitor_daily USING spgist (public_ip inet_ops);
@@ -0,0 +1,19 @@
+-- Live view counters shared by every worker (see live_stats.py).  Each
+-- worker adds its per-minute deltas every few seconds; snapshots count
+-- distinct sessions and sum hits over the recent minutes.  Minutes older
+-- than the longest window are deleted as they expire.  UNLOGGED: the data
+-- is only worth the last half hour, so it skips the WAL (and replicas).
+CREATE UNLOGGED TABLE IF NOT EXISTS public.live_sessions (
+  minute bigint NOT NULL,
+  session_id text NOT NULL,
+  CONSTRAINT live_sessions_pkey PRIMARY KEY (minute, session_id)
+);
+
+-- kind: 'page' | 'country'
+CREATE UNLOGGED TABLE IF NOT EXISTS public.live_hits (
+  minute bigint NOT NULL,
+  kind text NOT NULL,
+  value text NOT NULL,
+  hits bigint NOT NULL DEFAULT 0,
+  CONSTRAINT live_hits_pkey PRIMARY KEY (minute, kind, value)
+);
@@ -0,0 +1,340 @@
+# Live visitor counters
+#
+# Sliding-window counters fed directly by the ingest path (``/track``) so the
+# dashboard can show "who is on the site right now" without querying
+# Postgres.  Hits are bucketed per minute; a snapshot unions the buckets that
+# fall inside each window.
+#
+# Under gunicorn every worker only sees the hits it served.  With a
+# ``connect``, a background thread adds the worker's per-minute deltas to
+# public.live_sessions / public.live_hits (live.sql) every ``flush_seconds``
+# and reads the totals of all workers back in the same round trip.  That
+# merged snapshot, and the one the broadcaster computes each tick, is kept
+# with the time it was taken; ``latest()`` serves it while it is recent and
+# otherwise falls back to this worker's own buckets, so polling never waits
+# on Postgres.  Without a ``connect`` (tests, a single process) the buckets
+# are the whole state.
+#
+# A single broadcaster thread per worker computes one snapshot per tick and
+# fans it out to every subscribed stream, so N dashboard viewers cost one
+# computation rather than N.  Each open stream holds a request thread for
+# as long as it lasts, so a worker accepts at most ``max_streams``.
+
+import json
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+# Windows (in minutes) reported as "active sessions in the last N minutes"
+LIVE_WINDOWS = (1, 5, 30)
+
+
+class _MinuteBucket:
+    __slots__ = ('minute', 'sessions', 'pages', 'countries')
+
+    def __init__(self, minute):
+        self.minute = minute
+        self.sessions = set()
+        self.pages = Counter()
+        self.countries = Counter()
+
+
+class LiveStats:
+    """Per-minute buckets of recent hits plus a pub/sub fan-out of snapshots."""
+
+    def __init__(self, windows=LIVE_WINDOWS, top_n=10, tick_seconds=2.0,
+                 queue_size=8, clock=time.time, connect=None, flush_seconds=2.0,
+                 max_streams=None, logger=None):
+        self.windows = tuple(sorted(windows))
+        self.horizon = self.windows[-1]
+        self.top_n = top_n
+        self.tick_seconds = tick_seconds
+        self.queue_size = queue_size
+        self.flush_seconds = flush_seconds
+        self.max_streams = max_streams
+        self._clock = clock
+        self._connect = connect
+        self._logger = logger
+        self._lock = threading.Lock()
+        # this worker's hits over the longest window, and the part of them
+        # not yet added to the shared tables
+        self._buckets = deque()
+        self._pending = deque()
+        self._subscribers = set()
+        # (merged snapshot, clock() when taken) or None
+        self._latest = None
+        self._broadcaster = None
+        self._flusher = None
+
+    # -- ingest -------------------------------------------------------------
+
+    def record(self, session_id, page=None, country=None):
+        """Count one hit.  Cheap enough to call inline from ``/track``."""
+        minute = int(self._clock() // 60)
+        with self._lock:
+            for buckets in (self._buckets, self._pending) if self._connect else (self._buckets,):
+                if not buckets or buckets[-1].minute != minute:
+                    buckets.append(_MinuteBucket(minute))
+                    self._expire(buckets, minute)
+                bucket = buckets[-1]
+                if session_id:
+                    bucket.sessions.add(str(session_id))
+                if page:
+                    bucket.pages[page] += 1
+                if country:
+                    bucket.countries[country] += 1
+            if self._connect and (self._flusher is None or not self._flusher.is_alive()):
+                self._flusher = threading.Thread(target=self._flush_loop, name='live-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f"Error flushing live counters: {e}")
+            with self._lock:
+                if not self._pending:
+                    self._flusher = None
+                    return
+
+    def flush(self):
+        """Add this worker's new hits to the shared tables and refresh the
+        merged snapshot; returns the number of minutes written."""
+        with self._lock:
+            buckets, self._pending = list(self._pending), deque()
+        if not buckets:
+            return 0
+
+        conn = None
+        try:
+            conn = self._connect()
+            cur = conn.cursor()
+            sessions = sorted({(b.minute, session) for b in buckets for session in b.sessions})
+            if sessions:
+                cur.execute("""
+                    INSERT INTO public.live_sessions (minute, session_id)
+                    SELECT * FROM unnest(%s::bigint[], %s::text[])
+                    ON CONFLICT DO NOTHING
+                """, ([m for m, _ in sessions], [session for _, session in sessions]))
+            hits = Counter()
+            for b in buckets:
+                for kind, counter in (('country', b.countries), ('page', b.pages)):
+                    for value, n in counter.items():
+                        hits[(b.minute, kind, value)] += n
+            if hits:
+                # sorted, so concurrent flushes take the row locks in one order
+                rows = sorted(hits.items())
+                cur.execute("""
+                    INSERT INTO public.live_hits AS h (minute, kind, value, hits)
+                    SELECT * FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::bigint[])
+                    ON CONFLICT (minute, kind, value) DO UPDATE SET hits = h.hits + EXCLUDED.hits
+                """, (
+                    [m for (m, _, _), _ in rows], [k for (_, k, _), _ in rows],
+                    [v for (_, _, v), _ in rows], [n for _, n in rows],
+                ))
+            oldest = int(self._clock() // 60) - self.horizon + 1
+            cur.execute("DELETE FROM public.live_sessions WHERE minute < %s", (oldest,))
+            cur.execute("DELETE FROM public.live_hits WHERE minute < %s", (oldest,))
+            conn.commit()
+        except Exception:
+            if conn:
+                conn.rollback()
+                conn.close()
+            # keep the deltas for the next flush
+            with self._lock:
+                for bucket in reversed(buckets):
+                    current = self._pending[0] if self._pending else None
+                    if current is not None and current.minute == bucket.minute:
+                        current.sessions |= bucket.sessions
+                        current.pages.update(bucket.pages)
+                        current.countries.update(bucket.countries)
+                    else:
+                        self._pending.appendleft(bucket)
+                self._expire(self._pending, int(self._clock() // 60))
+            raise
+
+        # the deltas are committed; a failed read-back must not requeue them
+        try:
+            self._remember(self._read_shared(cur))
+            conn.rollback()
+        finally:
+            conn.close()
+        return len(buckets)
+
+    def _expire(self, buckets, current_minute):
+        # caller holds the lock
+        oldest = current_minute - self.horizon + 1
+        while buckets and buckets[0].minute < oldest:
+            buckets.popleft()
+
+    # -- snapshots ----------------------------------------------------------
+
+    def snapshot(self):
+        """Return this worker's counters as a JSON-serialisable dict."""
+        now = self._clock()
+        minute = int(now // 60)
+        with self._lock:
+            self._expire(self._buckets, minute)
+            buckets = list(self._buckets)
+
+        active = {}
+        sessions = set()
+        pages = Counter()
+        countries = Counter()
+        # walk newest → oldest so each window is a superset of the previous one
+        remaining = list(self.windows)
+        for bucket in reversed(buckets):
+            while remaining and bucket.minute <= minute - remaining[0]:
+                active[f'{remaining.pop(0)}m'] = len(sessions)
+            if not remaining:
+                break
+            sessions |= bucket.sessions
+            pages.update(bucket.pages)
+            countries.update(bucket.countries)
+        for window in remaining:
+            active[f'{window}m'] = len(sessions)
+
+        return {
+            'timestamp': now,
+            'active_sessions': active,
+            'top_pages': [
+                {'page_visited': page, 'count': count}
+                for page, count in pages.most_common(self.top_n)
+            ],
+            'top_countries': [
+                {'country': country, 'count': count}
+                for country, count in countries.most_common(self.top_n)
+            ],
+        }
+
+    def _shared_snapshot(self):
+        """The counters of every worker, read from the shared tables."""
+        conn = self._connect()
+        try:
+            snapshot = self._read_shared(conn.cursor())
+            conn.rollback()
+        finally:
+            conn.close()
+        return snapshot
+
+    def _read_shared(self, cur):
+        now = self._clock()
+        minute = int(now // 60)
+        # a bucket is in the N-minute window when minute - bucket < N
+        cur.execute(
+            "SELECT " + ", ".join(
+                f"COUNT(DISTINCT session_id) FILTER (WHERE minute > %(minute)s - {window})"
+                for window in self.windows
+            ) + " FROM public.live_sessions WHERE minute > %(minute)s - %(horizon)s",
+            {'minute': minute, 'horizon': self.horizon},
+        )
+        active = {f'{window}m': count for window, count in zip(self.windows, cur.fetchone())}
+        top = {}
+        for kind in ('page', 'country'):
+            cur.execute("""
+                SELECT value, SUM(hits)::bigint AS count FROM public.live_hits
+                WHERE kind = %s AND minute > %s - %s
+                GROUP BY value ORDER BY count DESC, value LIMIT %s
+            """, (kind, minute, self.horizon, self.top_n))
+            top[kind] = cur.fetchall()
+        return {
+            'timestamp': now,
+            'active_sessions': active,
+            'top_pages': [{'page_visited': page, 'count': count} for page, count in top['page']],
+            'top_countries': [{'country': country, 'count': count} for country, count in top['country']],
+        }
+
+    def _remember(self, snapshot):
+        self._latest = (snapshot, self._clock())
+
+    def latest(self):
+        """The merged snapshot from the last flush or broadcast while it is
+        recent, else this worker's own counters.  Never touches Postgres."""
+        latest = self._latest
+        max_age = 2 * max(self.tick_seconds, self.flush_seconds)
+        if latest is not None and self._clock() - latest[1] <= max_age:
+            return latest[0]
+        return self.snapshot()
+
+    # -- pub/sub ------------------------------------------------------------
+
+    def subscribe(self):
+        """Register a listener and return the queue snapshots are pushed to,
+        or None when ``max_streams`` listeners are already registered."""
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            if self.max_streams is not None and len(self._subscribers) >= self.max_streams:
+                return None
+            self._subscribers.add(q)
+            if self._broadcaster is None or not self._broadcaster.is_alive():
+                self._broadcaster = threading.Thread(
+                    target=self._broadcast_loop, name='live-stats', daemon=True
+                )
+                self._broadcaster.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self):
+        """Compute one snapshot and push it to every subscriber."""
+        snapshot = self._shared_snapshot() if self._connect else self.snapshot()
+        self._remember(snapshot)
+        message = json.dumps(snapshot)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # slow consumer: drop its oldest update rather than block the
+                # broadcaster for everybody else
+                try:
+                    q.get_nowait()
+                    q.put_nowait(message)
+                except (queue.Empty, queue.Full):
+                    pass
+        return message
+
+    def _broadcast_loop(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    # nobody listening – let the thread exit; the next
+                    # subscriber starts a new one
+                    self._broadcaster = None
+                    self._latest = None
+                    return
+            try:
+                self.publish()
+            except Exception as e:
+                # the shared tables may be briefly unreachable; keep the
+                # streams open and try again next tick
+                if self._logger:
+                    self._logger.error(f"Error publishing live counters: {e}")
+            time.sleep(self.tick_seconds)
+
+    def stream(self, q=None, heartbeat_seconds=15.0):
+        """Yield Server-Sent Events frames for one client until it disconnects.
+
+        ``q`` is a queue from ``subscribe()``; one is taken when not given.
+        """
+        if q is None:
+            q = self.subscribe()
+        try:
+            yield f"event: snapshot\ndata: {json.dumps(self.latest())}\n\n"
+            while True:
+                try:
+                    message = q.get(timeout=heartbeat_seconds)
+                except queue.Empty:
+                    # comment frame keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: snapshot\ndata: {message}\n\n"
+        finally:
+            self.unsubscribe(q)
@@ -0,0 +1,132 @@
+# Prometheus metrics for /metrics
+#
+# gunicorn runs several worker processes, each with its own memory, so a
+# plain in-process registry would report whichever worker happened to answer
+# the scrape.  When ``PROMETHEUS_MULTIPROC_DIR`` is set (gunicorn.conf.py sets
+# it before any worker starts) prometheus_client keeps every value in small
+# mmap'ed files in that directory and ``render`` sums them across workers at
+# scrape time.  Without it – ``python app.py`` – the default in-process
+# registry is used.
+#
+# Collected:
+#   http_requests_total / http_request_duration_seconds  per route + method
+#   db_statement_duration_seconds                          per statement type
+#   ingest_rows_total, ingest_upsert_conflicts_total       per table
+#   ingest_bot_hits_total                                  per bot reason
+#   ingest_rejected_total                                  rate limits / shedding
+#   upstream_request_duration_seconds                      per /api/app-users app
+#   worker_resident_memory_bytes                           per live worker (pid)
+
+import os
+import resource
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests handled',
+    ['method', 'route', 'status'],
+)
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to produce the response',
+    ['method', 'route'],
+)
+DB_STATEMENT_SECONDS = Histogram(
+    'db_statement_duration_seconds', 'Time spent executing SQL statements',
+    ['statement'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+INGEST_ROWS = Counter(
+    'ingest_rows_total', 'Rows written by the ingest endpoints',
+    ['table', 'operation'],
+)
+UPSERT_CONFLICTS = Counter(
+    'ingest_upsert_conflicts_total', 'Upserts that updated an existing row',
+    ['table'],
+)
+# One avoided page_views write per hit
+BOT_HITS = Counter(
+    'ingest_bot_hits_total', 'Bot hits kept out of page_views',
+    ['reason', 'action'],
+)
+INGEST_REJECTED = Counter(
+    'ingest_rejected_total', 'Ingest requests refused with 429/503',
+    ['reason'],
+)
+UPSTREAM_SECONDS = Histogram(
+    'upstream_request_duration_seconds', 'Upstream user-detail requests',
+    ['app', 'outcome'],
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60),
+)
+# 'liveall': one series per worker pid, dropped when the worker exits
+RESIDENT_MEMORY = Gauge(
+    'worker_resident_memory_bytes', 'Resident set size of the worker process',
+    multiprocess_mode='liveall',
+)
+
+# Memory is sampled on the request path, at most this often
+MEMORY_SAMPLE_SECONDS = 5.0
+
+# Label for requests that matched no route (keeps 404 scans from
+# creating a series per URL)
+UNMATCHED_ROUTE = '<unmatched>'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+_last_memory_sample = 0.0
+
+
+def resident_memory_bytes():
+    """Current RSS of this process (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sample_memory(force=False):
+    global _last_memory_sample
+    now = time.monotonic()
+    if force or now - _last_memory_sample >= MEMORY_SAMPLE_SECONDS:
+        _last_memory_sample = now
+        RESIDENT_MEMORY.set(resident_memory_bytes())
+
+
+def observe_request(method, route, status, seconds):
+    route = route or UNMATCHED_ROUTE
+    REQUESTS.labels(method, route, str(status)).inc()
+    REQUEST_SECONDS.labels(method, route).observe(seconds)
+    sample_memory()
+
+
+def observe_upstream(app_slug, seconds, outcome):
+    UPSTREAM_SECONDS.labels(app_slug, outcome).observe(seconds)
+
+
+def db_timer(statement):
+    """Context manager timing one SQL statement: ``with db_timer('track_insert'):``."""
+    return DB_STATEMENT_SECONDS.labels(statement).time()
+
+
+def render():
+    """Return ``(body, content_type)`` for a scrape, aggregated across workers."""
+    sample_memory(force=True)
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
@@ -0,0 +1,151 @@
+# Schema migration runner
+#
+# Applies the SQL assets checked into ``backend/`` once per deploy instead of
+# on the first request of every worker.  Each asset is checksummed; an asset
+# is (re-)executed only when its checksum differs from the one recorded in
+# ``public.schema_migrations``.  A Postgres advisory lock serialises runners,
+# so several containers starting at once apply each change exactly once.
+#
+# Assets must therefore be idempotent (``IF NOT EXISTS`` / ``CREATE OR
+# REPLACE``): editing one re-runs the whole file.
+#
+# Usage:
+#     python migrations.py            # apply pending assets
+#     python migrations.py --status   # list assets and whether they're current
+#
+# gunicorn runs ``apply_migrations`` from ``on_starting`` (gunicorn.conf.py),
+# i.e. once in the master process before any worker is forked.  Both apply
+# the schema to the main database and to every shard database (SHARD_DSN_*,
+# see shards.py).
+
+import hashlib
+import os
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+
+from shards import shard_connectors
+
+# Applied in this order
+MIGRATIONS = (
+    'table.sql',
+    'indexes.sql',
+    'sketches.sql',
+    'page_views.sql',
+    'bot_hits.sql',
+    'live.sql',
+    'retention.sql',
+    'dimensions.sql',
+    'inet.sql',
+    'supabase_analytics_function.sql',
+)
+
+# Arbitrary but fixed key for pg_advisory_lock
+MIGRATION_LOCK_KEY = 0x7472_6163  # "trac"
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def asset_checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def pending_migrations(applied, base_dir=BASE_DIR, names=MIGRATIONS):
+    """Return ``[(name, checksum), ...]`` for assets that are new or changed.
+
+    ``applied`` maps asset name → checksum recorded in ``schema_migrations``.
+    """
+    pending = []
+    for name in names:
+        checksum = asset_checksum(os.path.join(base_dir, name))
+        if applied.get(name) != checksum:
+            pending.append((name, checksum))
+    return pending
+
+
+def _applied_checksums(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.schema_migrations (
+          name text PRIMARY KEY,
+          checksum text NOT NULL,
+          applied_at timestamp with time zone NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("SELECT name, checksum FROM public.schema_migrations")
+    return dict(cur.fetchall())
+
+
+def apply_migrations(conn, base_dir=BASE_DIR, names=MIGRATIONS, log=print):
+    """Apply every new or changed asset; returns the names that were applied."""
+    cur = conn.cursor()
+    # session-level lock: held across the per-asset commits below
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        applied = _applied_checksums(cur)
+        conn.commit()
+
+        done = []
+        for name, checksum in pending_migrations(applied, base_dir, names):
+            log(f"Applying {name} ({checksum[:12]})")
+            with open(os.path.join(base_dir, name), 'r', encoding='utf-8') as f:
+                cur.execute(f.read())
+            cur.execute("""
+                INSERT INTO public.schema_migrations (name, checksum, applied_at)
+                VALUES (%s, %s, now())
+                ON CONFLICT (name) DO UPDATE SET
+                    checksum = EXCLUDED.checksum,
+                    applied_at = EXCLUDED.applied_at
+            """, (name, checksum))
+            # one transaction per asset so a failure leaves earlier ones recorded
+            conn.commit()
+            done.append(name)
+
+        if not done:
+            log("Schema up to date.")
+        return done
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+
+
+def get_db_connection():
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        database=os.environ.get("DB_NAME", "trac_db"),
+        user=os.environ.get("DB_USER", "trac_user"),
+        password=os.environ.get("DB_PASS", "trac_password"),
+        port=os.environ.get("DB_PORT", "5432"),
+    )
+
+
+def main(argv):
+    load_dotenv()
+    connectors = shard_connectors(get_db_connection)
+    status = 0
+    for shard, connect in connectors:
+        conn = connect()
+        try:
+            if len(connectors) > 1:
+                print(f"[{shard}]")
+            if '--status' in argv:
+                cur = conn.cursor()
+                applied = _applied_checksums(cur)
+                conn.commit()
+                pending = {name for name, _ in pending_migrations(applied)}
+                for name in MIGRATIONS:
+                    print(f"{'pending ' if name in pending else 'current '} {name}")
+                status = status or (1 if pending else 0)
+            else:
+                apply_migrations(conn)
+        finally:
+            conn.close()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
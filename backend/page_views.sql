@@ -0,0 +1,81 @@
+-- Append-only event log written by /track (event_type 'view') and /log/time
+-- (event_type 'time').  Rows are only ever inserted, so concurrent hits on
+-- one session never wait on each other; public.visitors is derived from it
+-- by the compactor (see compactor.py).
+--
+-- Partitioned by month on the server-side receive time.  Rows arrive in
+-- roughly that order, which is what makes the BRIN index on it effective;
+-- the session_id btree serves the compactor and by_page.
+CREATE TABLE IF NOT EXISTS public.page_views (
+  id bigserial NOT NULL,
+  received_at timestamp with time zone NOT NULL DEFAULT now(),
+  event_type text NOT NULL DEFAULT 'view',
+  session_id uuid NOT NULL,
+  viewed_at timestamp with time zone NULL,
+  public_ip inet NULL,
+  country text NULL,
+  country_code text NULL,
+  city text NULL,
+  isp text NULL,
+  page_visited text NULL,
+  user_agent text NULL,
+  device_type text NULL,
+  browser text NULL,
+  operating_system text NULL,
+  time_spent_seconds integer NULL,
+  CONSTRAINT page_views_event_type_check CHECK (event_type IN ('view', 'time')),
+  CONSTRAINT page_views_time_spent_seconds_check CHECK (
+    time_spent_seconds >= 0 AND time_spent_seconds <= 86400
+  )
+) PARTITION BY RANGE (received_at);
+
+-- Catches rows outside every monthly partition so ingest never fails
+CREATE TABLE IF NOT EXISTS public.page_views_default
+  PARTITION OF public.page_views DEFAULT;
+
+CREATE INDEX IF NOT EXISTS page_views_received_at_brin
+  ON public.page_views USING brin (received_at);
+CREATE INDEX IF NOT EXISTS page_views_session_id_idx
+  ON public.page_views (session_id);
+
+-- Create the monthly partitions from the current month to ``months_ahead``
+-- months out (page_views_y2025m06, ...).  Called here and by the compactor.
+CREATE OR REPLACE FUNCTION public.ensure_page_view_partitions(months_ahead integer DEFAULT 2)
+RETURNS void LANGUAGE plpgsql AS $$
+DECLARE
+  month_start date;
+  partition_name text;
+BEGIN
+  FOR i IN 0..months_ahead LOOP
+    -- month boundaries in UTC, whatever the session time zone
+    month_start := (date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => i))::date;
+    partition_name := format('page_views_y%sm%s',
+                             to_char(month_start, 'YYYY'), to_char(month_start, 'MM'));
+    IF to_regclass('public.' || partition_name) IS NULL THEN
+      BEGIN
+        EXECUTE format(
+          'CREATE TABLE public.%I PARTITION OF public.page_views FOR VALUES FROM (%L) TO (%L)',
+          partition_name,
+          month_start::timestamp AT TIME ZONE 'UTC',
+          (month_start + interval '1 month')::timestamp AT TIME ZONE 'UTC'
+        );
+      EXCEPTION WHEN duplicate_table OR unique_violation THEN
+        -- another worker's compactor created it first (a concurrent CREATE
+        -- can also fail on the pg_type name index)
+        NULL;
+      END;
+    END IF;
+  END LOOP;
+END;
+$$;
+
+SELECT public.ensure_page_view_partitions();
+
+-- How far the compactor has folded page_views into public.visitors
+CREATE TABLE IF NOT EXISTS public.compactor_state (
+  name text PRIMARY KEY,
+  watermark timestamp with time zone NULL,
+  updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+INSERT INTO public.compactor_state (name) VALUES ('visitors')
+ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,43 @@
+# Precompress the exported frontend at image build time
+#
+#     python precompress.py static_frontend
+#
+# Writes ``<file>.br`` and ``<file>.gz`` next to every compressible asset
+# (when the compressed copy is actually smaller).  ``static_files.py`` picks
+# the variants up at startup and serves them without compressing per request.
+
+import gzip
+import os
+import sys
+
+import brotli
+
+COMPRESSIBLE = ('.html', '.js', '.mjs', '.css', '.json', '.map', '.svg', '.txt', '.xml', '.ico', '.webmanifest')
+MIN_SIZE = 256
+
+
+def precompress(root):
+    written = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < MIN_SIZE:
+                continue
+            for suffix, compressed in (
+                ('.br', brotli.compress(data, quality=11)),
+                ('.gz', gzip.compress(data, compresslevel=9, mtime=0)),
+            ):
+                if len(compressed) < len(data):
+                    with open(path + suffix, 'wb') as f:
+                        f.write(compressed)
+                    written += 1
+    return written
+
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else 'static_frontend'
+    print(f"Precompressed {precompress(root)} files in {root}")
@@ -0,0 +1,254 @@
+# Time-on-page percentiles from mergeable DDSketch summaries
+#
+# avg_time_on_page is dragged around by a few sessions clamped at 86400s,
+# and exact percentiles would mean sorting every filtered row.  Instead each
+# session's time_spent_seconds goes into a DDSketch (Masson, Rim & Lee,
+# "DDSketch: A Fast and Fully-Mergeable Quantile Sketch with Relative-Error
+# Guarantees", VLDB 2019) per hour bucket of its first_seen and per scope:
+#
+#     all                 every session
+#     page:<page_visited> sessions by their (latest) page
+#     site:<site id>      sessions whose page is under a site in sites_config
+#
+# Sketches live in public.sketch_buckets (kind 'ddsketch') next to the top-K
+# summaries and are written through the same SketchBuffer, so a percentile
+# over any range merges a few small JSON documents.
+#
+# A DDSketch is a histogram over logarithmic bins: a value x > 0 lands in
+# bin ceil(log_gamma(x)) with gamma = (1 + a) / (1 - a), and every quantile
+# it reports is within a relative error ``a`` of the true value at that
+# rank.  Merging adds bin counts, and so does removing a value (a negative
+# count): the compactor reports each session's previous time with n=-1 when
+# a later report replaces it, so every session is counted once with its
+# current time.  With a = 1% the range 1s..86400s spans ~570 bins.
+
+import argparse
+import math
+import os
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+
+from heavy_hitters import BUCKET_SECONDS, SketchBuffer
+from shards import shard_connectors
+from sites_config import SITES, site_for_page
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+# reported by /api/time-on-page
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class DDSketch:
+    """Relative-error quantile sketch with signed, mergeable bin counts."""
+
+    kind = 'ddsketch'
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # values too small for a log bin (0s visits)
+        self.zero_count = 0
+        # bin index -> count
+        self.bins = {}
+
+    def _index(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index):
+        # midpoint (in relative terms) of (gamma^(i-1), gamma^i]
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def offer(self, value, n=1):
+        """Add ``value`` ``n`` times; a negative ``n`` removes it again."""
+        value = float(value)
+        if value <= 0:
+            self.zero_count += n
+            return
+        index = self._index(value)
+        count = self.bins.get(index, 0) + n
+        if count:
+            self.bins[index] = count
+        else:
+            self.bins.pop(index, None)
+        self._collapse()
+
+    def _collapse(self):
+        # fold the lowest bins together: only the smallest quantiles lose accuracy
+        if len(self.bins) <= self.max_bins:
+            return
+        ordered = sorted(self.bins)
+        excess = ordered[:len(ordered) - self.max_bins + 1]
+        target = excess[-1]
+        self.bins[target] = sum(self.bins.pop(i) for i in excess[:-1]) + self.bins[target]
+
+    def merge(self, other):
+        """Fold ``other`` into this sketch (in place) and return ``self``."""
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            total = self.bins.get(index, 0) + count
+            if total:
+                self.bins[index] = total
+            else:
+                self.bins.pop(index, None)
+        self._collapse()
+        return self
+
+    @property
+    def count(self):
+        # removals can only run ahead of additions for a bin while the
+        # matching addition is still unflushed; such bins count as empty
+        return max(self.zero_count, 0) + sum(c for c in self.bins.values() if c > 0)
+
+    def quantile(self, q):
+        """Estimated value at quantile ``q`` (0..1), or None when empty."""
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = max(self.zero_count, 0)
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            count = self.bins[index]
+            if count <= 0:
+                continue
+            seen += count
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.bins))
+
+    def summary(self, quantiles=DEFAULT_QUANTILES):
+        """``{'count': n, 'p50': ..., 'p90': ..., ...}`` with values rounded to 0.1s."""
+        result = {'count': self.count}
+        for q in quantiles:
+            value = self.quantile(q)
+            result[f'p{q * 100:g}'] = round(value, 1) if value is not None else None
+        return result
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'max_bins': self.max_bins,
+            'zero': self.zero_count,
+            'bins': {str(i): c for i, c in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get('relative_accuracy', DEFAULT_RELATIVE_ACCURACY),
+                     data.get('max_bins', DEFAULT_MAX_BINS))
+        sketch.zero_count = data.get('zero', 0)
+        sketch.bins = {int(i): c for i, c in (data.get('bins') or {}).items()}
+        return sketch
+
+
+def time_scopes(page, sites=SITES):
+    """Sketch dimensions a session on ``page`` is counted under."""
+    scopes = ['all']
+    if page:
+        scopes.append(f'page:{page}')
+        site = site_for_page(page, sites)
+        if site:
+            scopes.append(f'site:{site}')
+    return scopes
+
+
+def record_session_times(buffer, changes, sites=SITES):
+    """Feed the compactor's session changes to a DDSketch ``SketchBuffer``.
+
+    ``changes`` are ``[old_time, old_page, old_at, new_time, new_page,
+    new_at]`` rows (``*_at`` = first_seen as a unix timestamp); the old
+    value is removed from the bucket and scopes it was counted under.
+    """
+    for old_time, old_page, old_at, new_time, new_page, new_at in changes:
+        if old_time is not None and old_at is not None:
+            buffer.record({scope: old_time for scope in time_scopes(old_page, sites)}, n=-1, at=old_at)
+        if new_time is not None and new_at is not None:
+            buffer.record({scope: new_time for scope in time_scopes(new_page, sites)}, n=1, at=new_at)
+
+
+def load_sketches(cur, prefix, start, end):
+    """Merged DDSketch per dimension starting with ``prefix`` over the range
+    (``heavy_hitters.load_merged`` loads a single dimension)."""
+    cur.execute("""
+        SELECT dimension, sketch FROM public.sketch_buckets
+        WHERE kind = %s AND starts_with(dimension, %s)
+          AND (%s::timestamptz IS NULL OR bucket_start > %s::timestamptz - %s * interval '1 second')
+          AND (%s::timestamptz IS NULL OR bucket_start <= %s::timestamptz)
+    """, (DDSketch.kind, prefix, start, start, BUCKET_SECONDS, end, end))
+    merged = {}
+    for row in cur.fetchall():
+        dimension, data = (row['dimension'], row['sketch']) if isinstance(row, dict) else row
+        sketch = DDSketch.from_dict(data)
+        if dimension in merged:
+            merged[dimension].merge(sketch)
+        else:
+            merged[dimension] = sketch
+    return merged
+
+
+BACKFILL_SQL = """
+    SELECT time_spent_seconds, page_visited, EXTRACT(EPOCH FROM first_seen)
+    FROM public.visitors
+    WHERE time_spent_seconds IS NOT NULL AND first_seen IS NOT NULL
+"""
+
+
+def backfill(connect, log=print, batch_size=10000, flush_rows=200000, read_connect=None):
+    """Sketch every existing visitors row; run once, when enabling sketches.
+
+    Sketches are written through ``connect``; rows are read through
+    ``read_connect`` (a shard database) when given.
+    """
+    buffer = SketchBuffer(connect=connect, factory=DDSketch, kind=DDSketch.kind, background=False)
+    conn = (read_connect or connect)()
+    try:
+        cur = conn.cursor(name='ddsketch_backfill')
+        cur.itersize = batch_size
+        cur.execute(BACKFILL_SQL)
+        rows = 0
+        for time_spent, page, at in cur:
+            buffer.record({scope: time_spent for scope in time_scopes(page)}, at=float(at))
+            rows += 1
+            if rows % flush_rows == 0:
+                # flushes merge into the stored sketches, so memory stays bounded
+                buffer.flush()
+                log(f"Sketched {rows} sessions")
+        buffer.flush()
+    finally:
+        conn.close()
+    log(f"Sketched {rows} sessions")
+    return rows
+
+
+def get_db_connection():
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        database=os.environ.get("DB_NAME", "trac_db"),
+        user=os.environ.get("DB_USER", "trac_user"),
+        password=os.environ.get("DB_PASS", "trac_password"),
+        port=os.environ.get("DB_PORT", "5432"),
+    )
+
+
+def main(argv):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Time-on-page DDSketch maintenance.")
+    parser.add_argument('--backfill', action='store_true',
+                        help="sketch the existing visitors rows (once, before the compactor feeds new ones)")
+    args = parser.parse_args(argv)
+    if not args.backfill:
+        parser.print_help()
+        return 1
+    # sketches live in the main database; the rows in every shard
+    for shard, connect in shard_connectors(get_db_connection):
+        backfill(get_db_connection, log=lambda message: print(f"[{shard}] {message}"), read_connect=connect)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,122 @@
+# Rate limiting and load shedding for the tracking endpoints
+#
+# ``TokenBuckets``: one bucket per key (client IP, session id).  A bucket
+# holds up to ``burst`` tokens and refills at ``rate`` per second; a request
+# takes one token or is refused with the time until the next one.  Only
+# ``(tokens, last_seen)`` is stored per key, in an LRU capped at
+# ``max_entries``.  A bucket left alone for ``burst / rate`` seconds is full
+# again, i.e. indistinguishable from a new one, so such entries are dropped
+# whenever they are encountered at the cold end of the LRU; under pressure
+# the least recently seen keys go first.
+#
+# ``LoadShedder``: caps concurrent database work per worker.  The cap adapts
+# AIMD-style to how long that work takes: it grows by about one slot per
+# window of completions while latency stays under ``target_seconds`` and
+# shrinks by 10% (at most once per ``backoff_seconds``) when the smoothed
+# latency exceeds it.  Requests over the cap are refused up front instead of
+# queueing for a connection the database can't serve.
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBuckets:
+    """Per-key token buckets in a bounded LRU."""
+
+    def __init__(self, rate, burst, max_entries=50000, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        # idle this long → bucket is full again
+        self._idle_seconds = self.burst / self.rate if self.rate > 0 else math.inf
+
+    def take(self, key):
+        """Take one token for ``key``; returns ``(allowed, retry_after_seconds)``."""
+        now = self._clock()
+        with self._lock:
+            entry = self._buckets.pop(key, None)
+            if entry is None:
+                tokens = self.burst
+            else:
+                tokens, last = entry
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                allowed, retry_after = True, 0.0
+                tokens -= 1
+            else:
+                allowed = False
+                retry_after = (1 - tokens) / self.rate if self.rate > 0 else math.inf
+            self._buckets[key] = (tokens, now)
+            self._evict(now)
+        return allowed, retry_after
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            _, (_, last) = next(iter(buckets.items()))
+            if len(buckets) > self.max_entries or now - last >= self._idle_seconds:
+                buckets.popitem(last=False)
+            else:
+                break
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LoadShedder:
+    """Adaptive cap on in-flight database work."""
+
+    def __init__(self, max_in_flight=32, min_in_flight=2, target_seconds=0.1,
+                 backoff_seconds=1.0, smoothing=0.2, clock=time.monotonic):
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.target_seconds = target_seconds
+        self.backoff_seconds = backoff_seconds
+        self.smoothing = smoothing
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.latency = None
+        self._backed_off_at = -math.inf
+
+    def try_acquire(self):
+        """Return a slot token (pass it to ``release``), or None when shedding."""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+        return self._clock()
+
+    def release(self, started):
+        now = self._clock()
+        elapsed = now - started
+        with self._lock:
+            self.in_flight -= 1
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += self.smoothing * (elapsed - self.latency)
+            if self.latency > self.target_seconds:
+                if now - self._backed_off_at >= self.backoff_seconds:
+                    self.limit = max(self.min_in_flight, self.limit * 0.9)
+                    self._backed_off_at = now
+            else:
+                self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+
+    def retry_after(self):
+        """Seconds a shed client should wait: about one smoothed DB round."""
+        return max(1, math.ceil(self.latency or 0))
+
+    def status(self):
+        with self._lock:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            }
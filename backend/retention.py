@@ -0,0 +1,216 @@
+# Retention: roll old visitors rows into daily aggregates
+#
+# Rows whose first_seen (created_at when missing) is older than the horizon
+# are moved, ``--batch`` rows per transaction, into public.visitor_daily and
+# public.ip_visit_totals: each batch is deleted and aggregated in one
+# statement, so a row is counted exactly once even if the job is interrupted.
+# ``FOR UPDATE SKIP LOCKED`` keeps the job from waiting on (or blocking) the
+# compactor, and short transactions keep lock times and WAL bursts small.
+#
+# Afterwards the page_views monthly partitions that lie entirely before the
+# horizon are detached (``DETACH ... CONCURRENTLY``) and dropped, and old rows
+# in the default partition are deleted in batches.
+#
+# get_filtered_analytics_visual reads visitor_daily for archived days, so
+# the dashboard keeps showing them (at day resolution).  The job runs on the
+# main database and then on each shard database (SHARD_DSN_*, see shards.py).
+#
+# Usage:
+#     python retention.py                  # RETENTION_DAYS (default 90)
+#     python retention.py --days 30 --batch 2000
+#     python retention.py --dry-run        # only report what would move
+
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg2
+from dotenv import load_dotenv
+
+from shards import shard_connectors
+
+ROLL_UP_SQL = """
+    WITH batch AS (
+        SELECT id FROM public.visitors
+        WHERE COALESCE(first_seen, created_at) < %(horizon)s
+        ORDER BY id
+        LIMIT %(batch)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    moved AS (
+        DELETE FROM public.visitors v
+        USING batch b
+        WHERE v.id = b.id
+        RETURNING v.*
+    ),
+    daily AS (
+        INSERT INTO public.visitor_daily AS d (
+            day, public_ip, country_id, country_code, city_id, isp_id,
+            page_visited, device_type_id, browser_id, operating_system_id,
+            visits, time_total, time_count
+        )
+        SELECT
+            (COALESCE(first_seen, created_at) AT TIME ZONE 'UTC')::date,
+            -- rows dimensions.py --backfill has not reached carry text
+            public_ip, COALESCE(country_id, public.dimension_id('country', country)), country_code,
+            COALESCE(city_id, public.dimension_id('city', city)),
+            COALESCE(isp_id, public.dimension_id('isp', isp)), page_visited,
+            COALESCE(device_type_id, public.dimension_id('device_type', device_type)),
+            COALESCE(browser_id, public.dimension_id('browser', browser)),
+            COALESCE(operating_system_id, public.dimension_id('operating_system', operating_system)),
+            COUNT(*), COALESCE(SUM(time_spent_seconds), 0), COUNT(time_spent_seconds)
+        FROM moved
+        GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9, 10
+        ON CONFLICT ON CONSTRAINT visitor_daily_key DO UPDATE SET
+            visits = d.visits + EXCLUDED.visits,
+            time_total = d.time_total + EXCLUDED.time_total,
+            time_count = d.time_count + EXCLUDED.time_count
+    ),
+    ips AS (
+        INSERT INTO public.ip_visit_totals AS t (public_ip, visits)
+        SELECT public_ip, COUNT(*) FROM moved
+        WHERE public_ip IS NOT NULL
+        GROUP BY public_ip
+        ON CONFLICT (public_ip) DO UPDATE SET visits = t.visits + EXCLUDED.visits
+    )
+    SELECT COUNT(*) FROM moved
+"""
+
+PURGE_DEFAULT_SQL = """
+    DELETE FROM public.page_views_default
+    WHERE ctid IN (
+        SELECT ctid FROM public.page_views_default
+        WHERE received_at < %(horizon)s
+        LIMIT %(batch)s
+    )
+"""
+
+PARTITION_NAME = re.compile(r'^page_views_y(\d{4})m(\d{2})$')
+
+
+def horizon_for(days, now=None):
+    """Midnight UTC ``days`` days ago; rows before it are archived."""
+    now = now or datetime.now(timezone.utc)
+    day = (now - timedelta(days=days)).date()
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def expired_partitions(names, horizon):
+    """Monthly page_views partitions whose whole range lies before ``horizon``."""
+    expired = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if not match:
+            continue
+        year, month = int(match.group(1)), int(match.group(2))
+        month_end = date(year + month // 12, month % 12 + 1, 1)
+        if datetime(month_end.year, month_end.month, 1, tzinfo=timezone.utc) <= horizon:
+            expired.append(name)
+    return sorted(expired)
+
+
+def roll_up_visitors(conn, horizon, batch_size=5000, pause=0.05, log=print):
+    """Move archived visitors rows batch by batch; returns the number moved."""
+    total = 0
+    cur = conn.cursor()
+    while True:
+        cur.execute(ROLL_UP_SQL, {'horizon': horizon, 'batch': batch_size})
+        moved = cur.fetchone()[0]
+        conn.commit()
+        total += moved
+        if moved:
+            log(f"Rolled up {total} visitors rows")
+        if moved < batch_size:
+            return total
+        # let autovacuum and concurrent writers breathe between batches
+        time.sleep(pause)
+
+
+def drop_expired_partitions(conn, horizon, log=print):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.page_views'::regclass
+    """)
+    names = expired_partitions([row[0] for row in cur.fetchall()], horizon)
+    conn.commit()
+
+    # DETACH ... CONCURRENTLY can't run inside a transaction block
+    previous, conn.autocommit = conn.autocommit, True
+    try:
+        for name in names:
+            log(f"Dropping partition {name}")
+            cur.execute(f'ALTER TABLE public.page_views DETACH PARTITION public."{name}" CONCURRENTLY')
+            cur.execute(f'DROP TABLE public."{name}"')
+    finally:
+        conn.autocommit = previous
+    return names
+
+
+def purge_default_partition(conn, horizon, batch_size=5000, pause=0.05):
+    total = 0
+    cur = conn.cursor()
+    while True:
+        cur.execute(PURGE_DEFAULT_SQL, {'horizon': horizon, 'batch': batch_size})
+        deleted = cur.rowcount
+        conn.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+        time.sleep(pause)
+
+
+def run_retention(conn, days, batch_size=5000, pause=0.05, log=print):
+    horizon = horizon_for(days)
+    log(f"Archiving rows before {horizon.date()} ({days} days)")
+    moved = roll_up_visitors(conn, horizon, batch_size, pause, log)
+    dropped = drop_expired_partitions(conn, horizon, log)
+    purged = purge_default_partition(conn, horizon, batch_size, pause)
+    log(f"Done: {moved} visitors rows rolled up, {len(dropped)} partitions dropped, "
+        f"{purged} old events purged")
+    return moved, dropped, purged
+
+
+def get_db_connection():
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        database=os.environ.get("DB_NAME", "trac_db"),
+        user=os.environ.get("DB_USER", "trac_user"),
+        password=os.environ.get("DB_PASS", "trac_password"),
+        port=os.environ.get("DB_PORT", "5432"),
+    )
+
+
+def main(argv):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Roll old visitors rows into daily aggregates.")
+    parser.add_argument('--days', type=int, default=int(os.environ.get("RETENTION_DAYS", "90")),
+                        help="keep raw rows for this many days")
+    parser.add_argument('--batch', type=int, default=5000, help="rows per transaction")
+    parser.add_argument('--pause', type=float, default=0.05, help="seconds between batches")
+    parser.add_argument('--dry-run', action='store_true', help="only count what would be archived")
+    args = parser.parse_args(argv)
+
+    for shard, connect in shard_connectors(get_db_connection):
+        conn = connect()
+        try:
+            if args.dry_run:
+                horizon = horizon_for(args.days)
+                cur = conn.cursor()
+                cur.execute("SELECT COUNT(*) FROM public.visitors WHERE COALESCE(first_seen, created_at) < %s",
+                            (horizon,))
+                print(f"[{shard}] {cur.fetchone()[0]} visitors rows before {horizon.date()} would be rolled up")
+                continue
+            run_retention(conn, args.days, args.batch, args.pause)
+        finally:
+            conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
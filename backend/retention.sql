@@ -0,0 +1,35 @@
+-- Daily roll-ups of visitors rows older than the retention horizon (see
+-- retention.py).  One row per day and combination of every dimension the
+-- dashboard filters on, public_ip included, so filters and distinct-IP
+-- counts over archived days stay exact; only the per-session detail
+-- (session_id, user_agent, time of day) is gone.
+CREATE TABLE IF NOT EXISTS public.visitor_daily (
+  day date NOT NULL,
+  public_ip inet NULL,
+  -- *_id are keys into public.dimensions (see dimensions.sql)
+  country_id integer NULL,
+  country_code text NULL,
+  city_id integer NULL,
+  isp_id integer NULL,
+  page_visited text NULL,
+  device_type_id integer NULL,
+  browser_id integer NULL,
+  operating_system_id integer NULL,
+  visits bigint NOT NULL,
+  -- SUM / COUNT of the non-null time_spent_seconds, for averages
+  time_total bigint NOT NULL DEFAULT 0,
+  time_count bigint NOT NULL DEFAULT 0,
+  CONSTRAINT visitor_daily_key UNIQUE NULLS NOT DISTINCT (
+    day, public_ip, country_id, country_code, city_id, isp_id,
+    page_visited, device_type_id, browser_id, operating_system_id
+  )
+);
+
+CREATE INDEX IF NOT EXISTS visitor_daily_day_idx ON public.visitor_daily (day);
+
+-- Visits per IP that were rolled up, so "unique" / "repeated" visitor
+-- classification still sees the whole history
+CREATE TABLE IF NOT EXISTS public.ip_visit_totals (
+  public_ip inet PRIMARY KEY,
+  visits bigint NOT NULL
+);
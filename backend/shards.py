@@ -0,0 +1,319 @@
+# Per-site storage shards
+#
+# Every site used to share one visitors table in one database, so a burst on
+# one site slowed every dashboard.  A site's ``shard`` (sites_config.SITES)
+# can now live in a database of its own:
+#
+#     SHARD_DSN_TPL="host=db-tpl dbname=trac_tpl user=trac_user password=..."
+#
+# Each shard database carries the full schema (migrations.py applies it to
+# every configured shard), its own compactor and dimension dictionary, and a
+# small connection pool per worker.  Sites whose shard has no DSN, and pages
+# that belong to no configured site, stay in the main database (the
+# ``default`` shard), so a deployment without SHARD_DSN_* behaves as before.
+#
+# Routing:
+#
+# * /track routes by the page URL, /log/time by the page URL (or site id) the
+#   report names – once shards are configured a report must name one, since
+#   nothing every worker can see maps a bare session id to its shard;
+# * a per-site dashboard query goes to that site's shard only;
+# * the "all" view runs on every shard in parallel and the payloads are
+#   merged by ``merge_payloads``; the visits of each address are added up
+#   over all shards first, so visitor counts and the unique / repeated
+#   filter see an address once.
+#
+# Top-K and time-on-page sketches summarise the hit stream of all sites and
+# stay in the main database.
+
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+from sites_config import SITES, site_for_page
+
+DEFAULT_SHARD = 'default'
+DSN_ENV_PREFIX = 'SHARD_DSN_'
+
+# Chart series in the analytics payload: key field, field to rank by (None:
+# chronological, by key) and the row limit the SQL applies.  All other
+# numeric fields are summed across shards.
+CHART_SERIES = {
+    'by_country': ('id', 'value', None),
+    'by_isp': ('id', 'value', None),
+    'by_date': ('date', None, None),
+    'by_week': ('date', None, None),
+    'by_month': ('date', None, None),
+    'by_device': ('device_type', 'count', None),
+    'by_browser': ('browser', 'count', 5),
+    'by_city': ('city', 'count', 10),
+    'by_page': ('page_visited', 'count', 10),
+}
+VISITOR_LIST_LIMIT = 100
+
+# Parts of a merged payload that are summed or cut per shard, reported to
+# clients under ``merged.approximate``
+APPROXIMATE_FIELDS = (
+    'charts.*.unique_visitors',
+    'charts.*.returning_visitors',
+    'charts.by_browser',
+    'charts.by_city',
+    'charts.by_page',
+)
+
+
+def shard_dsns(sites=SITES, environ=os.environ):
+    """``{shard name: DSN}`` for the shards configured with a database of their own."""
+    dsns = {}
+    for site in sites.values():
+        name = site.get('shard')
+        if name and name != DEFAULT_SHARD:
+            dsn = environ.get(f'{DSN_ENV_PREFIX}{name.upper()}')
+            if dsn:
+                dsns[name] = dsn
+    return dsns
+
+
+def shard_connectors(default_connect, sites=SITES, environ=os.environ):
+    """``[(shard, connect)]`` for the main database and every shard database,
+    for the jobs that run on each (migrations, retention, backfills)."""
+    return [(DEFAULT_SHARD, default_connect)] + [
+        (name, lambda dsn=dsn: psycopg2.connect(dsn))
+        for name, dsn in shard_dsns(sites, environ).items()
+    ]
+
+
+class _PooledConnection:
+    """A pool connection whose ``close()`` hands it back to the pool."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool._release(self._conn)
+            self._conn = None
+
+
+class ConnectionPool:
+    """Reuses up to ``max_idle`` open connections to one shard database.
+
+    Checkout never blocks: when nothing is idle a new connection is opened,
+    and a returned connection beyond ``max_idle`` is closed.
+    """
+
+    def __init__(self, dsn, max_idle=8, connect=psycopg2.connect):
+        self.dsn = dsn
+        self.max_idle = max_idle
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._idle = []
+        self._in_use = 0
+        self._pid = os.getpid()
+
+    def connection(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # inherited across a fork: the sockets belong to the parent
+                self._idle, self._in_use, self._pid = [], 0, os.getpid()
+            conn = self._idle.pop() if self._idle else None
+            self._in_use += 1
+        if conn is None:
+            try:
+                conn = self._connect(self.dsn)
+            except Exception:
+                with self._lock:
+                    self._in_use -= 1
+                raise
+        return _PooledConnection(self, conn)
+
+    def _release(self, conn):
+        try:
+            # a connection that failed mid-transaction is not reused
+            reusable = not conn.closed
+            if reusable:
+                conn.rollback()
+        except Exception:
+            reusable = False
+        with self._lock:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def status(self):
+        with self._lock:
+            return {'idle': len(self._idle), 'in_use': self._in_use}
+
+
+class ShardRouter:
+    """Maps sites, pages and sessions to shards and hands out shard connections."""
+
+    def __init__(self, default_connect, default_read_connect=None, pools=None,
+                 sites=SITES):
+        self._default_connect = default_connect
+        self._default_read_connect = default_read_connect or default_connect
+        self._pools = dict(pools or {})
+        self._sites = sites
+        # site id → shard, for shards that have a database
+        self._site_shards = {
+            site_id: site['shard'] for site_id, site in sites.items()
+            if site.get('shard') in self._pools
+        }
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @classmethod
+    def from_environ(cls, default_connect, default_read_connect=None, sites=SITES,
+                     environ=os.environ, max_idle=8):
+        pools = {
+            name: ConnectionPool(dsn, max_idle=max_idle)
+            for name, dsn in shard_dsns(sites, environ).items()
+        }
+        return cls(default_connect, default_read_connect, pools, sites)
+
+    @property
+    def names(self):
+        """Every shard, ``default`` first (it holds pages of no configured site)."""
+        return [DEFAULT_SHARD] + list(self._pools)
+
+    @property
+    def sharded(self):
+        return bool(self._pools)
+
+    def for_site(self, site_id):
+        return self._site_shards.get(site_id, DEFAULT_SHARD)
+
+    def for_page(self, page):
+        return self.for_site(site_for_page(page, self._sites))
+
+    def for_time_report(self, page=None, site_id=None):
+        """Shard for a /log/time report, or None when shards are configured
+        and the report names neither its page nor its site."""
+        if site_id:
+            return self.for_site(site_id)
+        if page:
+            return self.for_page(page)
+        return None if self._pools else DEFAULT_SHARD
+
+    def connect(self, shard):
+        """Connection for writes to ``shard``."""
+        if shard == DEFAULT_SHARD:
+            return self._default_connect()
+        return self._pools[shard].connection()
+
+    def read_connect(self, shard):
+        """Connection for dashboard reads (the main database may use a replica)."""
+        if shard == DEFAULT_SHARD:
+            return self._default_read_connect()
+        return self._pools[shard].connection()
+
+    def map(self, fn):
+        """``{shard: fn(shard)}`` over every shard, run in parallel."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(len(self.names), 2), thread_name_prefix='shard-query'
+                )
+        futures = {shard: self._executor.submit(fn, shard) for shard in self.names}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def status(self):
+        return [
+            {
+                'shard': shard,
+                'sites': sorted(s for s, name in self._site_shards.items() if name == shard),
+                'pool': self._pools[shard].status() if shard in self._pools else None,
+            }
+            for shard in self.names
+        ]
+
+
+def _merge_series(series_lists, key, rank_by, limit):
+    rows = OrderedDict()
+    for series in series_lists:
+        for row in series or ():
+            merged = rows.get(row.get(key))
+            if merged is None:
+                rows[row.get(key)] = dict(row)
+                continue
+            for field, value in row.items():
+                if field != key and isinstance(value, (int, float)):
+                    merged[field] = (merged.get(field) or 0) + value
+    if rank_by is None:
+        merged = sorted(rows.values(), key=lambda r: (r.get(key) is None, r.get(key) or ''))
+    else:
+        merged = sorted(rows.values(), key=lambda r: r.get(rank_by) or 0, reverse=True)
+    return merged[:limit] if limit else merged
+
+
+def merge_payloads(payloads):
+    """Combine per-shard analytics payloads into one.
+
+    ``payloads`` maps shard → decoded payload.  Counts, time totals and chart
+    series are summed.  ``unique_visitors`` counts an address once: each
+    shard lists in ``shared_ips`` the addresses it counted that other shards
+    have visits for, and the extra counts are taken off.  The per-chart
+    ``unique_visitors`` are still sums over shards, and truncated series
+    (top browsers / cities / pages) are merged from each shard's top rows,
+    so an item just outside every shard's top list can be missed; the
+    payload names these fields in ``merged.approximate``.  ``watermark`` is
+    None: ids are per shard, so the merged view is always refreshed in full.
+    """
+    payloads = {shard: p for shard, p in payloads.items() if p}
+    stats = {'total_visitors': 0, 'unique_visitors': 0, 'time_total': 0, 'time_count': 0}
+    visitors, charts, meta = [], {}, {}
+    shared = Counter()
+    for shard, payload in payloads.items():
+        for field in stats:
+            stats[field] += (payload.get('stats') or {}).get(field) or 0
+        shared.update(payload.get('shared_ips') or ())
+        for row in payload.get('visitor_list') or ():
+            # ids repeat across shards; ``shard`` tells the rows apart
+            visitors.append(dict(row, shard=shard))
+        for name, series in (payload.get('charts') or {}).items():
+            charts.setdefault(name, []).append(series)
+        for name, values in (payload.get('meta') or {}).items():
+            meta.setdefault(name, set()).update(values or ())
+
+    # an address counted by n shards was counted n - 1 times too often
+    stats['unique_visitors'] -= sum(n - 1 for n in shared.values())
+    stats['repeated_visitors'] = max(stats['total_visitors'] - stats['unique_visitors'], 0)
+    stats['avg_time_on_page'] = round(stats['time_total'] / stats['time_count']) if stats['time_count'] else 0
+    # newest first, rows without first_seen leading (as ORDER BY ... DESC
+    # NULLS FIRST); timestamps are ISO strings in one time zone
+    visitors.sort(key=lambda r: (r.get('first_seen') is None, r.get('first_seen') or ''), reverse=True)
+    return {
+        'stats': stats,
+        'watermark': None,
+        'visitor_list': visitors[:VISITOR_LIST_LIMIT],
+        'charts': {
+            name: _merge_series(series_lists, *CHART_SERIES.get(name, ('id', None, None)))
+            for name, series_lists in charts.items()
+        },
+        'meta': {name: sorted(values) for name, values in meta.items()},
+        'merged': {'shards': list(payloads), 'approximate': list(APPROXIMATE_FIELDS)},
+    }
+
+
+def columnar(payload):
+    """Python twin of ``public.analytics_columnar`` for merged payloads."""
+    charts = {}
+    for name, series in (payload.get('charts') or {}).items():
+        columns = {}
+        for row in series:
+            for field, value in row.items():
+                columns.setdefault(field, []).append(value)
+        charts[name] = columns
+    return dict(payload, charts=charts)
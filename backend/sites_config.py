@@ -1,5 +1,7 @@
 # Sites configuration
-# Map of site names to their URLs for filtering
+# Map of site names to their URLs for filtering.  ``shard`` names the storage
+# shard a site's visitors are written to; it gets a database of its own when
+# SHARD_DSN_<SHARD> is set, see shards.py.
 
 SITES = {
     "all": {
@@ -9,23 +11,27 @@ SITES = {
     },
     
     "sanjaya": {
+        "shard": "sanjaya",
         "name": "Sanjaya",
         # base path only; trailing slash is removed by ``get_site_url`` for matching
         "url": "https://rbg.iitm.ac.in/sanjaya",
         "description": "Sanjaya application"
     },
     "fps": {
+        "shard": "fps",
         "name": "FPS",
         # hash‑route based application; keep the ``#/`` portion but drop final slash
         "url": "https://rbg.iitm.ac.in/fps/#",
         "description": "FPS application"
     },
     "tpl": {
+        "shard": "tpl",
         "name": "TPL",
         "url": "https://rbg.iitm.ac.in/tpl",
         "description": "TPL application"
     },
     "rath": {
+        "shard": "rath",
         "name": "RATH",
         "url": "https://rbg.iitm.ac.in/RATH",
         "description": "RATH application"
@@ -62,3 +68,15 @@ def get_site_url(site_id):
         # which matches the base path and all sub‑paths uniformly
         return url.rstrip("/")
     return None
+
+
+def site_for_page(page, sites=SITES):
+    """Id of the configured site whose URL prefixes ``page`` (case-insensitive)."""
+    if not page:
+        return None
+    page = page.lower()
+    for site_id, site in sites.items():
+        url = (site.get('url') or '').rstrip('/').lower()
+        if url and page.startswith(url):
+            return site_id
+    return None
@@ -0,0 +1,10 @@
+-- Mergeable per-bucket summaries written by the backend (see heavy_hitters.py).
+-- One row per (kind, dimension, bucket); the JSON layout depends on ``kind``.
+CREATE TABLE IF NOT EXISTS public.sketch_buckets (
+  kind text NOT NULL,
+  dimension text NOT NULL,
+  bucket_start timestamp with time zone NOT NULL,
+  sketch jsonb NOT NULL,
+  updated_at timestamp with time zone NOT NULL DEFAULT now(),
+  CONSTRAINT sketch_buckets_pkey PRIMARY KEY (kind, dimension, bucket_start)
+);
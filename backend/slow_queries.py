@@ -0,0 +1,174 @@
+# Slow-query recorder with sampled EXPLAIN plans
+#
+# Read statements that take longer than ``threshold_seconds`` are offered to
+# the recorder.  A sampled fraction of them is re-run on a separate
+# connection, in a background thread, under ``EXPLAIN (ANALYZE, BUFFERS)``;
+# the plan and the statement's parameters go into a bounded ring buffer that
+# ``/api/admin/slow-queries`` exposes.
+#
+# The analytics payload is built by a plpgsql function, whose outer plan is
+# a single "Result" node.  So the re-run first tries to load ``auto_explain``
+# with ``log_nested_statements`` and ``log_level = notice``: the plan of every
+# query inside the function then arrives as a NOTICE on the same connection
+# and is stored too.  Where the module can't be loaded (it needs superuser or
+# a ``session_preload_libraries`` entry) only the outer plan is kept.
+#
+# Only one EXPLAIN runs at a time per worker; slow statements seen meanwhile
+# are still counted per query shape but not re-run.  The buffer lives in each
+# worker process, like the other in-process state.
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+# Filters with a small fixed set of values are kept verbatim in the query
+# shape when the value is one of them; any other filter (or value) only
+# contributes its name, so client input can't mint new shapes
+ENUM_PARAMS = {
+    'visitor_type_filter': ('all', 'unique', 'repeated'),
+    'granularity': ('hour', 'day', 'week', 'month'),
+}
+
+NESTED_PLAN_SETTINGS = (
+    "LOAD 'auto_explain'",
+    "SET auto_explain.log_min_duration = 0",
+    "SET auto_explain.log_analyze = on",
+    "SET auto_explain.log_buffers = on",
+    "SET auto_explain.log_nested_statements = on",
+    "SET auto_explain.log_level = notice",
+)
+
+
+def query_shape(statement, params):
+    """Normalised key for grouping, e.g. ``analytics(url_filter, visitor_type_filter=repeated)``."""
+    parts = []
+    for name in sorted(params):
+        value = params[name]
+        if value is None or value == '':
+            continue
+        parts.append(f'{name}={value}' if value in ENUM_PARAMS.get(name, ()) else name)
+    return f"{statement}({', '.join(parts)})"
+
+
+class SlowQueryRecorder:
+    """Ring buffer of sampled slow statements and their plans."""
+
+    def __init__(self, connect, threshold_seconds=1.0, sample_rate=0.1,
+                 capacity=50, explain_timeout=30.0, rng=None, logger=None,
+                 max_shapes=200):
+        self._connect = connect
+        self.threshold_seconds = threshold_seconds
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.max_shapes = max_shapes
+        self.explain_timeout = explain_timeout
+        self._rng = rng or random.Random()
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=capacity)
+        self._shapes = {}
+        self._explaining = False
+
+    def observe(self, statement, sql, args, params, elapsed):
+        """Offer one executed statement; returns the capture thread, if any.
+
+        ``args`` are the values bound to ``sql``; ``params`` names them for
+        the report and the query shape.
+        """
+        if elapsed < self.threshold_seconds:
+            return None
+        shape = query_shape(statement, params)
+        elapsed_ms = round(elapsed * 1000, 1)
+        with self._lock:
+            seen = self._shapes.get(shape)
+            if seen is None:
+                if len(self._shapes) >= self.max_shapes:
+                    # make room by dropping the rarest shape
+                    del self._shapes[min(self._shapes, key=lambda k: self._shapes[k]['count'])]
+                seen = self._shapes[shape] = {'shape': shape, 'count': 0, 'max_ms': 0.0}
+            seen['count'] += 1
+            seen['max_ms'] = max(seen['max_ms'], elapsed_ms)
+            if self._explaining or self._rng.random() >= self.sample_rate:
+                return None
+            self._explaining = True
+
+        entry = {
+            'captured_at': datetime.now(timezone.utc).isoformat(),
+            'statement': statement,
+            'shape': shape,
+            'duration_ms': elapsed_ms,
+            'params': {k: v for k, v in params.items() if v is not None and v != ''},
+        }
+        thread = threading.Thread(
+            target=self._capture, args=(entry, sql, args),
+            name='slow-query-explain', daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def _capture(self, entry, sql, args):
+        try:
+            entry.update(self.explain(sql, args))
+        except Exception as e:
+            entry['explain_error'] = str(e)
+            if self._logger:
+                self._logger.error(f"EXPLAIN of slow {entry['statement']} failed: {e}")
+        finally:
+            with self._lock:
+                self._entries.append(entry)
+                self._explaining = False
+
+    def explain(self, sql, args):
+        """Re-run a read statement under EXPLAIN (ANALYZE, BUFFERS).
+
+        Returns ``{'plan': str, 'nested_plans': [str, ...]}``.  The statement
+        really executes, so the transaction is always rolled back.
+        """
+        conn = self._connect()
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute("SET statement_timeout = %s", (int(self.explain_timeout * 1000),))
+            nested = True
+            try:
+                for setting in NESTED_PLAN_SETTINGS:
+                    cur.execute(setting)
+            except Exception:
+                nested = False
+            conn.autocommit = False
+
+            del conn.notices[:]
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, args)
+            plan = '\n'.join(row[0] for row in cur.fetchall())
+            conn.rollback()
+            nested_plans = [
+                notice.strip().removeprefix('NOTICE:').strip()
+                for notice in conn.notices
+                if 'plan:' in notice
+            ] if nested else []
+            return {'plan': plan, 'nested_plans': nested_plans}
+        finally:
+            conn.close()
+
+    def snapshot(self):
+        """Newest entries first, plus per-shape counts of every slow statement."""
+        with self._lock:
+            entries = list(reversed(self._entries))
+            shapes = sorted((dict(s) for s in self._shapes.values()),
+                            key=lambda s: s['count'], reverse=True)
+        return {
+            'pid': os.getpid(),
+            'threshold_ms': round(self.threshold_seconds * 1000, 1),
+            'sample_rate': self.sample_rate,
+            'capacity': self.capacity,
+            'shapes': shapes,
+            'entries': entries,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._shapes.clear()
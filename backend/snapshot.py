@@ -0,0 +1,690 @@
+# Columnar analytics engine over a memory-mapped snapshot of visitors
+#
+# get_filtered_analytics_visual re-derives every chart row by row on each
+# call, which dominates long ranges with several breakdowns.  This module
+# exports visitors (plus the visitor_daily roll-ups and the page_views view
+# events by_page needs) into NumPy column files, and answers the same filter
+# set in process with boolean masks and ``np.bincount`` grouping, returning
+# the same JSON shape.
+#
+# Layout: ``SNAPSHOT_DIR/<generation>/`` holds one ``.npy`` file per column
+# and ``meta.json`` with the dictionaries.  Every dimension is an int32 code
+# (-1 for NULL) into a label list: public.dimensions keys are renumbered per
+# kind, and public_ip, country_code and page_visited are encoded on export.
+# Live and archived rows share the column files (live rows first, weighted
+# by ``visits``); timestamps are int64 microseconds since the epoch (UTC).
+# ``SNAPSHOT_DIR/CURRENT`` names the complete generation; workers map its
+# files with ``mmap_mode='r'``, so they share one copy in the page cache,
+# and pick up a new generation on their own.
+#
+# The export runs in one REPEATABLE READ transaction and carries the
+# ``watermark`` of what it saw, so a dashboard served from a snapshot can
+# catch up with ``since=`` delta refreshes from SQL.  A snapshot is as old as
+# its last export: the app only uses it when ANALYTICS_ENGINE=snapshot (or
+# ``engine=snapshot``) and it is younger than SNAPSHOT_MAX_AGE_SECONDS.
+#
+# Usage:
+#     python snapshot.py                 # export once
+#     python snapshot.py --every 300     # export every 5 minutes
+
+import argparse
+import ipaddress
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+from dimensions import DIMENSIONS
+
+FORMAT_VERSION = 1
+CURRENT_FILE = 'CURRENT'
+NULL_TIME = np.iinfo(np.int64).min
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+VISITOR_LIST_LIMIT = 100
+# date_trunc unit → datetime64 unit ('week' is handled on its own)
+TRUNC_UNITS = {'minute': 'm', 'hour': 'h', 'day': 'D', 'month': 'M', 'year': 'Y'}
+
+# name → dtype; the first group has a value per row (live, then archived),
+# the second per live row, the third per view event, the last per address
+ROW_COLUMNS = {
+    'first_seen': np.int64, 'public_ip': np.int32, 'country_code': np.int32,
+    'page_visited': np.int32, 'visits': np.int64, 'time_total': np.int64,
+    'time_count': np.int64, 'visit_count': np.int64,
+    **{dimension: np.int32 for dimension in DIMENSIONS if dimension not in ('operating_system', 'user_agent')},
+}
+LIVE_COLUMNS = {
+    'id': np.int64, 'created_at': np.int64, 'operating_system': np.int32,
+    'user_agent': np.int32, 'has_events': np.bool_,
+}
+VIEW_COLUMNS = {'view_row': np.int64, 'view_page': np.int32, 'view_at': np.int64}
+IP_COLUMNS = {'ip_v6': np.bool_, 'ip_hi': np.uint64, 'ip_lo': np.uint64}
+
+_MICROS = "(EXTRACT(EPOCH FROM {}) * 1000000)::bigint"
+
+# dimension keys in DIMENSIONS order; rows ``dimensions.py --backfill`` has not
+# encoded yet are looked up by their text
+_LIVE_KEYS = ', '.join(f"COALESCE(v.{d}_id, public.dimension_key('{d}', v.{d}))" for d in DIMENSIONS)
+
+LIVE_SQL = f"""
+    SELECT
+        v.id, {_MICROS.format('v.created_at')}, {_MICROS.format('v.first_seen')},
+        v.public_ip, v.country_code, v.page_visited, v.time_spent_seconds,
+        {_LIVE_KEYS},
+        v.session_id::text,
+        EXISTS (SELECT 1 FROM public.page_views pv WHERE pv.session_id = v.session_id)
+    FROM public.visitors v
+    ORDER BY v.id
+"""
+
+ARCHIVED_SQL = f"""
+    SELECT
+        {_MICROS.format("d.day::timestamp AT TIME ZONE 'UTC'")},
+        d.public_ip, d.country_code, d.page_visited, d.visits, d.time_total, d.time_count,
+        d.country_id, d.city_id, d.isp_id, d.device_type_id, d.browser_id
+    FROM public.visitor_daily d
+"""
+
+VIEWS_SQL = f"""
+    SELECT v.id, pv.page_visited, {_MICROS.format('COALESCE(pv.viewed_at, pv.received_at)')}
+    FROM public.page_views pv
+    JOIN public.visitors v ON v.session_id = pv.session_id
+    WHERE pv.event_type = 'view' AND pv.page_visited IS NOT NULL
+"""
+
+IP_COUNTS_SQL = """
+    SELECT public_ip, SUM(visits)::bigint
+    FROM (
+        SELECT public_ip, COUNT(*) AS visits FROM public.visitors GROUP BY public_ip
+        UNION ALL
+        SELECT public_ip, visits FROM public.ip_visit_totals
+    ) c
+    WHERE public_ip IS NOT NULL
+    GROUP BY public_ip
+"""
+
+
+class SnapshotBuilder:
+    """Accumulates rows and writes them out as one snapshot generation."""
+
+    def __init__(self, dimensions, ips, ip_counts, watermark=None):
+        """``dimensions``: ``(kind, id, value)`` sorted by kind and value;
+        ``ips``: every address in visitors / visitor_daily, in inet order;
+        ``ip_counts``: address → visits (ip_counts in the SQL function)."""
+        self.labels = {kind: [] for kind in DIMENSIONS}
+        self._dimension_codes = {kind: {} for kind in DIMENSIONS}
+        for kind, key, value in dimensions:
+            if kind in self.labels:
+                self._dimension_codes[kind][key] = len(self.labels[kind])
+                self.labels[kind].append(value)
+        self.ips = list(ips)
+        self._ip_codes = {ip: i for i, ip in enumerate(self.ips)}
+        self._ip_visits = [ip_counts.get(ip, 0) for ip in self.ips]
+        self.watermark = watermark
+        self.country_codes, self._country_code_codes = [], {}
+        self.pages, self._page_codes, self._listed_pages = [], {}, set()
+        self.columns = {
+            name: array('q' if np.dtype(dtype).itemsize == 8 else 'i')
+            for name, dtype in {**ROW_COLUMNS, **LIVE_COLUMNS, **VIEW_COLUMNS}.items()
+        }
+        self.sessions = []
+        self._live_rows = {}
+
+    @staticmethod
+    def _encode(value, codes, labels):
+        if value is None:
+            return -1
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(labels)
+            labels.append(value)
+        return code
+
+    def _page(self, page, listed=True):
+        code = self._encode(page, self._page_codes, self.pages)
+        if listed and code >= 0:
+            self._listed_pages.add(code)
+        return code
+
+    def _dimension(self, kind, key):
+        return -1 if key is None else self._dimension_codes[kind].get(key, -1)
+
+    def _add_row(self, first_seen, public_ip, country_code, page, visits, time_total, time_count,
+                 country_id, city_id, isp_id, device_type_id, browser_id):
+        ip = -1 if public_ip is None else self._ip_codes[str(public_ip)]
+        c = self.columns
+        c['first_seen'].append(NULL_TIME if first_seen is None else first_seen)
+        c['public_ip'].append(ip)
+        c['country_code'].append(self._encode(country_code, self._country_code_codes, self.country_codes))
+        c['page_visited'].append(self._page(page))
+        c['visits'].append(visits)
+        c['time_total'].append(time_total)
+        c['time_count'].append(time_count)
+        c['visit_count'].append(0 if ip < 0 else self._ip_visits[ip])
+        for kind, key in zip(('country', 'city', 'isp', 'device_type', 'browser'),
+                             (country_id, city_id, isp_id, device_type_id, browser_id)):
+            c[kind].append(self._dimension(kind, key))
+
+    def add_live(self, row):
+        """One LIVE_SQL row.  All live rows must come before archived ones."""
+        (id_, created_at, first_seen, public_ip, country_code, page, time_spent,
+         country_id, city_id, isp_id, device_type_id, browser_id,
+         operating_system_id, user_agent_id, session_id, has_events) = row
+        self._live_rows[id_] = len(self.sessions)
+        self._add_row(first_seen, public_ip, country_code, page, 1, time_spent or 0,
+                      int(time_spent is not None), country_id, city_id, isp_id, device_type_id, browser_id)
+        c = self.columns
+        c['id'].append(id_)
+        c['created_at'].append(NULL_TIME if created_at is None else created_at)
+        c['operating_system'].append(self._dimension('operating_system', operating_system_id))
+        c['user_agent'].append(self._dimension('user_agent', user_agent_id))
+        c['has_events'].append(int(bool(has_events)))
+        self.sessions.append((session_id or '').encode())
+
+    def add_archived(self, row):
+        """One ARCHIVED_SQL row."""
+        self._add_row(*row)
+
+    def add_view(self, row):
+        """One VIEWS_SQL row."""
+        visitor_id, page, at = row
+        position = self._live_rows.get(visitor_id)
+        if position is not None:
+            self.columns['view_row'].append(position)
+            self.columns['view_page'].append(self._page(page, listed=False))
+            self.columns['view_at'].append(at)
+
+    def write(self, directory, keep=2):
+        """Write a new generation, point CURRENT at it and prune old ones."""
+        os.makedirs(directory, exist_ok=True)
+        generation = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        staging = os.path.join(directory, f'.{generation}.tmp')
+        os.makedirs(staging)
+        dtypes = {**ROW_COLUMNS, **LIVE_COLUMNS, **VIEW_COLUMNS}
+        for name, values in self.columns.items():
+            np.save(os.path.join(staging, f'{name}.npy'), np.frombuffer(values, dtype=values.typecode).astype(dtypes[name]))
+        width = max((len(s) for s in self.sessions), default=1) or 1
+        np.save(os.path.join(staging, 'session_id.npy'), np.array(self.sessions, dtype=f'S{width}'))
+        listed = np.zeros(len(self.pages), dtype=np.bool_)
+        listed[sorted(self._listed_pages)] = True
+        np.save(os.path.join(staging, 'page_listed.npy'), listed)
+        for name, values in zip(IP_COLUMNS, _ip_numbers(self.ips)):
+            np.save(os.path.join(staging, f'{name}.npy'), values)
+        with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': FORMAT_VERSION,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'watermark': self.watermark,
+                'labels': self.labels,
+                'ips': self.ips,
+                'country_codes': self.country_codes,
+                'pages': self.pages,
+            }, f)
+        os.rename(staging, os.path.join(directory, generation))
+        pointer = os.path.join(directory, f'.{CURRENT_FILE}.tmp')
+        with open(pointer, 'w', encoding='utf-8') as f:
+            f.write(generation)
+        os.replace(pointer, os.path.join(directory, CURRENT_FILE))
+        # workers still mapping a removed generation keep their (unlinked) files
+        generations = sorted(name for name in os.listdir(directory) if not name.startswith('.') and name != CURRENT_FILE)
+        for old in generations[:-keep]:
+            shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+        return generation
+
+
+def _ip_numbers(ips):
+    """Per address: IPv6 flag and the address as two 64-bit halves."""
+    v6 = np.zeros(len(ips), dtype=np.bool_)
+    hi = np.zeros(len(ips), dtype=np.uint64)
+    lo = np.zeros(len(ips), dtype=np.uint64)
+    for i, ip in enumerate(ips):
+        address = ipaddress.ip_interface(ip).ip
+        number = int(address)
+        v6[i] = address.version == 6
+        hi[i], lo[i] = number >> 64, number & 0xFFFFFFFFFFFFFFFF
+    return v6, hi, lo
+
+
+def export_snapshot(conn, directory, batch_size=20000, keep=2, log=print):
+    """Export the database into a new snapshot generation under ``directory``."""
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT kind, id, value FROM public.dimensions ORDER BY kind, value")
+        dimensions = cur.fetchall()
+        cur.execute("""
+            SELECT public_ip FROM (
+                SELECT public_ip FROM public.visitors
+                UNION
+                SELECT public_ip FROM public.visitor_daily
+            ) m
+            WHERE public_ip IS NOT NULL
+            ORDER BY public_ip
+        """)
+        ips = [str(row[0]) for row in cur.fetchall()]
+        cur.execute(IP_COUNTS_SQL)
+        ip_counts = {str(ip): visits for ip, visits in cur.fetchall()}
+        cur.execute("SELECT MAX(id) FROM public.visitors")
+        builder = SnapshotBuilder(dimensions, ips, ip_counts, cur.fetchone()[0])
+        for name, sql, add in (('live', LIVE_SQL, builder.add_live),
+                               ('archived', ARCHIVED_SQL, builder.add_archived),
+                               ('views', VIEWS_SQL, builder.add_view)):
+            named = conn.cursor(name=f'snapshot_{name}')
+            named.itersize = batch_size
+            named.execute(sql)
+            for row in named:
+                add(row)
+            named.close()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    generation = builder.write(directory, keep=keep)
+    log(f"Snapshot {generation}: {len(builder.sessions)} live rows, "
+        f"{len(builder.columns['visits']) - len(builder.sessions)} archived, "
+        f"{len(builder.columns['view_row'])} views")
+    return generation
+
+
+def _micros(value):
+    """ISO timestamp (naive = UTC) → microseconds since the epoch."""
+    dt = datetime.fromisoformat(value) if isinstance(value, str) else value
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _iso(micros):
+    """Microseconds → timestamptz as Postgres writes it in JSON."""
+    if micros == NULL_TIME:
+        return None
+    text = (EPOCH + timedelta(microseconds=int(micros))).isoformat()
+    # Postgres trims trailing zeros of the fraction
+    return re.sub(r'\.(\d*?)0+(?=\+)', lambda m: f'.{m.group(1)}' if m.group(1) else '', text)
+
+
+def _like_prefix(pattern):
+    """Regex for ``ILIKE pattern || '%'`` (backslash escapes, % and _ wildcards)."""
+    parts, escaped = [], False
+    for ch in pattern:
+        if escaped:
+            parts.append(re.escape(ch))
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif ch == '%':
+            parts.append('.*')
+        elif ch == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(ch))
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+def _round(value):
+    # ROUND(numeric) rounds half away from zero
+    return int(value + 0.5) if value >= 0 else -int(-value + 0.5)
+
+
+class Snapshot:
+    """One loaded (memory-mapped) snapshot generation."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError(f"{path}: unsupported snapshot version {meta.get('version')}")
+        self.created_at = datetime.fromisoformat(meta['created_at'])
+        self.watermark = meta['watermark']
+        self.labels = meta['labels']
+        self.ips = meta['ips']
+        self.country_codes = meta['country_codes']
+        self.pages = meta['pages']
+        names = [*ROW_COLUMNS, *LIVE_COLUMNS, *VIEW_COLUMNS, *IP_COLUMNS, 'session_id', 'page_listed']
+        self.columns = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names
+        }
+        self.rows = len(self.columns['visits'])
+        self.live_rows = len(self.columns['id'])
+        self.distinct_urls = sorted(
+            page for page, listed in zip(self.pages, self.columns['page_listed'].tolist()) if listed
+        )
+        self._codes = {}
+
+    def _code(self, kind, label):
+        """Code of ``label`` (-2, matching nothing, when it is unknown)."""
+        codes = self._codes.get(kind)
+        if codes is None:
+            codes = self._codes[kind] = {value: i for i, value in enumerate(self.labels[kind])}
+        return codes.get(label, -2)
+
+    def _page_matches(self, url_filter):
+        """Boolean per page code plus a trailing False for NULL (-1)."""
+        pattern = _like_prefix(url_filter)
+        return np.array([bool(pattern.match(page)) for page in self.pages] + [False])
+
+    def _ip_matches(self, ip_filter):
+        network = ipaddress.ip_network(ip_filter, strict=False)
+        number = int(network.network_address)
+        bits = network.max_prefixlen
+        mask = ((1 << bits) - 1) ^ ((1 << (bits - network.prefixlen)) - 1)
+        c = self.columns
+        matches = (
+            (c['ip_v6'] == (network.version == 6))
+            & ((c['ip_hi'] & np.uint64(mask >> 64)) == np.uint64(number >> 64))
+            & ((c['ip_lo'] & np.uint64(mask & 0xFFFFFFFFFFFFFFFF)) == np.uint64(number & 0xFFFFFFFFFFFFFFFF))
+        )
+        return np.append(matches, False)
+
+    def _mask(self, country_filter, start, end, visitor_type_filter, device_filter,
+              url_filter, browser_filter, ip_filter, isp_filter):
+        c = self.columns
+        mask = np.ones(self.rows, dtype=np.bool_)
+        for kind, label in (('country', country_filter), ('device_type', device_filter),
+                            ('browser', browser_filter), ('isp', isp_filter)):
+            if label is not None:
+                mask &= c[kind] == self._code(kind, label)
+        if start is not None or end is not None:
+            first_seen = c['first_seen']
+            mask &= first_seen != NULL_TIME
+            if start is not None:
+                mask &= first_seen >= start
+            if end is not None:
+                mask &= first_seen <= end
+        if visitor_type_filter == 'unique':
+            mask &= c['visit_count'] == 1
+        elif visitor_type_filter == 'repeated':
+            mask &= c['visit_count'] > 1
+        if url_filter is not None:
+            mask &= self._page_matches(url_filter)[c['page_visited']]
+        if ip_filter is not None:
+            mask &= self._ip_matches(ip_filter)[c['public_ip']]
+        return mask
+
+    def _grouped(self, codes, selected, groups, unique=False):
+        """Per-group ``sum(visits)`` (and distinct addresses) over ``selected`` rows."""
+        visits = np.asarray(self.columns['visits'])[selected]
+        sums = np.bincount(codes, weights=visits, minlength=groups).astype(np.int64)
+        if not unique:
+            return sums, None
+        ips = np.asarray(self.columns['public_ip'])[selected]
+        known = ips >= 0
+        width = max(len(self.ips), 1)
+        pairs = np.unique(codes[known].astype(np.int64) * width + ips[known])
+        return sums, np.bincount(pairs // width, minlength=groups)
+
+    def _top(self, column, mask, label_field, value_field, labels, limit=None):
+        codes = np.asarray(self.columns[column])
+        selected = mask & (codes >= 0)
+        sums, _ = self._grouped(codes[selected], selected, len(labels))
+        order = [int(i) for i in np.argsort(-sums, kind='stable') if sums[i] > 0]
+        return [{label_field: labels[i], value_field: int(sums[i])} for i in order[:limit]]
+
+    def _by_time(self, mask, unit, as_date):
+        first_seen = np.asarray(self.columns['first_seen'])
+        timed = mask & (first_seen != NULL_TIME)
+        stamps = first_seen[timed].astype('datetime64[us]')
+        if unit == 'week':
+            days = stamps.astype('datetime64[D]').astype(np.int64)
+            # 1970-01-01 was a Thursday; weeks start on Monday
+            buckets = (days - (days + 3) % 7).astype('datetime64[D]').astype('datetime64[us]')
+        else:
+            buckets = stamps.astype(f'datetime64[{TRUNC_UNITS[unit]}]').astype('datetime64[us]')
+        values, codes = np.unique(buckets.astype(np.int64), return_inverse=True)
+        sums, uniques = self._grouped(codes.reshape(-1), timed, len(values), unique=True)
+        series = []
+        for i, value in enumerate(values):
+            date = _iso(value)
+            series.append({
+                'date': date[:10] if as_date else date,
+                'count': int(sums[i]),
+                'unique_visitors': int(uniques[i]),
+                'returning_visitors': int(sums[i] - uniques[i]),
+            })
+        untimed = mask & (first_seen == NULL_TIME)
+        if untimed.any():
+            # GROUP BY keeps the NULL bucket; ORDER BY puts it last
+            sums, uniques = self._grouped(np.zeros(int(untimed.sum()), dtype=np.int64), untimed, 1, unique=True)
+            series.append({
+                'date': None, 'count': int(sums[0]), 'unique_visitors': int(uniques[0]),
+                'returning_visitors': int(sums[0] - uniques[0]),
+            })
+        return series
+
+    def _by_page(self, mask, url_filter, start, end):
+        c = self.columns
+        live_mask = mask[:self.live_rows]
+        # view events of the filtered sessions, with the range / url filter of their own
+        view_row, view_page, view_at = (np.asarray(c[n]) for n in VIEW_COLUMNS)
+        views = live_mask[view_row]
+        if url_filter is not None:
+            views &= self._page_matches(url_filter)[view_page]
+        if start is not None:
+            views &= view_at >= start
+        if end is not None:
+            views &= view_at <= end
+        page = np.asarray(c['page_visited'])
+        # sessions with no events count their last page once; archived rows their visits
+        rows = mask & (page >= 0)
+        rows[:self.live_rows] &= ~np.asarray(c['has_events'])
+        weights = np.asarray(c['visits'])[rows]
+        counts = (np.bincount(view_page[views], minlength=len(self.pages))
+                  + np.bincount(page[rows], weights=weights, minlength=len(self.pages)).astype(np.int64))
+        order = [int(i) for i in np.argsort(-counts, kind='stable')[:10] if counts[i] > 0]
+        return [{'page_visited': self.pages[i], 'count': int(counts[i])} for i in order]
+
+    def _visitor_list(self, mask):
+        c = self.columns
+        rows = np.flatnonzero(mask[:self.live_rows])
+        first_seen = np.asarray(c['first_seen'])[rows]
+        # ORDER BY first_seen DESC (NULLs first)
+        key = np.where(first_seen == NULL_TIME, np.iinfo(np.int64).max, first_seen)
+        if len(rows) > VISITOR_LIST_LIMIT:
+            keep = np.argpartition(key, len(rows) - VISITOR_LIST_LIMIT)[-VISITOR_LIST_LIMIT:]
+            rows, key = rows[keep], key[keep]
+        rows = rows[np.argsort(-key, kind='stable')]
+
+        def label(kind, code):
+            return None if code < 0 else self.labels[kind][code]
+
+        visitors = []
+        for i in rows:
+            ip = int(c['public_ip'][i])
+            country_code = int(c['country_code'][i])
+            page = int(c['page_visited'][i])
+            session = c['session_id'][i].decode()
+            visitors.append({
+                'id': int(c['id'][i]),
+                'created_at': _iso(c['created_at'][i]),
+                'public_ip': self.ips[ip] if ip >= 0 else None,
+                'country': label('country', c['country'][i]),
+                'country_code': self.country_codes[country_code] if country_code >= 0 else None,
+                'city': label('city', c['city'][i]),
+                'page_visited': self.pages[page] if page >= 0 else None,
+                'user_agent': label('user_agent', c['user_agent'][i]),
+                'device_type': label('device_type', c['device_type'][i]),
+                'browser': label('browser', c['browser'][i]),
+                'operating_system': label('operating_system', c['operating_system'][i]),
+                'session_id': session or None,
+                'time_spent_seconds': int(c['time_total'][i]) if c['time_count'][i] else None,
+                'isp': label('isp', c['isp'][i]),
+                'first_seen': _iso(c['first_seen'][i]),
+                'visit_count': int(c['visit_count'][i]) if ip >= 0 else None,
+            })
+        return visitors
+
+    def analytics(self, country_filter=None, start_date_filter=None, end_date_filter=None,
+                  visitor_type_filter=None, device_filter=None, url_filter=None,
+                  browser_filter=None, ip_filter=None, isp_filter=None, granularity='day'):
+        """The ``get_filtered_analytics_visual`` payload, computed from the snapshot."""
+        start = _micros(start_date_filter) if start_date_filter else None
+        end = _micros(end_date_filter) if end_date_filter else None
+        mask = self._mask(country_filter, start, end, visitor_type_filter, device_filter,
+                          url_filter, browser_filter, ip_filter, isp_filter)
+        c = self.columns
+
+        visits = np.asarray(c['visits'])[mask]
+        ips = np.asarray(c['public_ip'])[mask]
+        total = int(visits.sum())
+        unique = int(len(np.unique(ips[ips >= 0])))
+        time_total = int(np.asarray(c['time_total'])[mask].sum())
+        time_count = int(np.asarray(c['time_count'])[mask].sum())
+
+        codes = np.asarray(c['country_code'])
+        selected = mask & (codes >= 0)
+        sums, uniques = self._grouped(codes[selected], selected, len(self.country_codes), unique=True)
+        by_country = [
+            {'id': self.country_codes[i], 'value': int(sums[i]), 'unique_visitors': int(uniques[i]),
+             'returning_visitors': int(sums[i] - uniques[i])}
+            for i in (int(i) for i in np.argsort(-sums, kind='stable')) if sums[i] > 0
+        ]
+
+        def listed(values):
+            # json_agg of nothing is NULL
+            return list(values) or None
+
+        return {
+            'stats': {
+                'total_visitors': total,
+                'unique_visitors': unique,
+                'repeated_visitors': max(total - unique, 0),
+                'avg_time_on_page': _round(time_total / time_count) if time_count else 0,
+                'time_total': time_total,
+                'time_count': time_count,
+            },
+            'watermark': self.watermark,
+            'visitor_list': self._visitor_list(mask),
+            'charts': {
+                'by_country': by_country,
+                'by_isp': self._top('isp', mask, 'id', 'value', self.labels['isp']),
+                'by_date': self._by_time(mask, granularity, as_date=False),
+                'by_week': self._by_time(mask, 'week', as_date=True),
+                'by_month': self._by_time(mask, 'month', as_date=True),
+                'by_device': self._top('device_type', mask, 'device_type', 'count', self.labels['device_type']),
+                'by_browser': self._top('browser', mask, 'browser', 'count', self.labels['browser'], 5),
+                'by_city': self._top('city', mask, 'city', 'count', self.labels['city'], 10),
+                'by_page': self._by_page(mask, url_filter, start, end),
+            },
+            'meta': {
+                'distinct_countries': listed(self.labels['country']),
+                'distinct_isps': listed(self.labels['isp']),
+                'distinct_devices': listed(self.labels['device_type']),
+                'distinct_urls': listed(self.distinct_urls),
+                'distinct_browsers': listed(self.labels['browser']),
+                'distinct_ips': listed(self.ips),
+            },
+        }
+
+
+class SnapshotStore:
+    """The current snapshot generation of a directory, reloaded when it changes."""
+
+    def __init__(self, directory, check_seconds=30.0, clock=time.monotonic, logger=None):
+        self.directory = directory
+        self.check_seconds = check_seconds
+        self._clock = clock
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._generation = None
+        self._reloader = None
+        self.reload()
+        self._checked_at = clock()
+
+    def reload(self):
+        """Load the generation CURRENT names if it changed; True when swapped in."""
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE), encoding='utf-8') as f:
+                generation = f.read().strip()
+        except OSError:
+            return False
+        if generation == self._generation:
+            return False
+        try:
+            snapshot = Snapshot(os.path.join(self.directory, generation))
+        except Exception as e:
+            if self._logger:
+                self._logger.error(f"Error loading analytics snapshot {generation}: {e}")
+            return False
+        with self._lock:
+            self._snapshot, self._generation = snapshot, generation
+        if self._logger:
+            self._logger.info(f"Loaded analytics snapshot {generation} ({snapshot.rows} rows)")
+        return True
+
+    def current(self, max_age_seconds=None):
+        """The loaded snapshot, or None when there is none (or it is too old)."""
+        now = self._clock()
+        with self._lock:
+            if now - self._checked_at >= self.check_seconds and (
+                    self._reloader is None or not self._reloader.is_alive()):
+                self._checked_at = now
+                self._reloader = threading.Thread(target=self.reload, name='snapshot-reload', daemon=True)
+                self._reloader.start()
+            snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        if max_age_seconds is not None:
+            age = (datetime.now(timezone.utc) - snapshot.created_at).total_seconds()
+            if age > max_age_seconds:
+                return None
+        return snapshot
+
+    def status(self):
+        with self._lock:
+            snapshot = self._snapshot
+        return {
+            'directory': self.directory,
+            'generation': self._generation,
+            'created_at': snapshot.created_at.isoformat() if snapshot else None,
+            'rows': snapshot.rows if snapshot else None,
+        }
+
+
+def get_db_connection():
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        database=os.environ.get("DB_NAME", "trac_db"),
+        user=os.environ.get("DB_USER", "trac_user"),
+        password=os.environ.get("DB_PASS", "trac_password"),
+        port=os.environ.get("DB_PORT", "5432"),
+    )
+
+
+def main(argv):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Export visitors into a columnar analytics snapshot.")
+    parser.add_argument('--dir', default=os.environ.get("SNAPSHOT_DIR"), help="snapshot directory (SNAPSHOT_DIR)")
+    parser.add_argument('--every', type=float, help="keep exporting, this many seconds apart")
+    parser.add_argument('--keep', type=int, default=2, help="generations to keep")
+    args = parser.parse_args(argv)
+    if not args.dir:
+        parser.error("--dir or SNAPSHOT_DIR is required")
+    while True:
+        started = time.monotonic()
+        conn = get_db_connection()
+        try:
+            export_snapshot(conn, args.dir, keep=args.keep)
+        except Exception as e:
+            if not args.every:
+                raise
+            print(f"Error exporting snapshot: {e}", file=sys.stderr)
+        finally:
+            conn.close()
+        if not args.every:
+            return 0
+        time.sleep(max(args.every - (time.monotonic() - started), 0))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,121 @@
+# Static frontend serving from an in-memory manifest
+#
+# The Next.js export in ``static_frontend`` never changes while the process
+# runs, so it is indexed once at startup: per file we keep its MIME type, a
+# content ETag and any precompressed ``.br`` / ``.gz`` siblings produced by
+# ``precompress.py`` at image build time.  Requests are then answered with a
+# dict lookup – no ``os.path.exists``/``isfile`` per hit – and:
+#
+# * hashed build output (``_next/static/...``) is sent with a one-year
+#   ``immutable`` Cache-Control, so browsers never re-request it;
+# * everything else (notably ``index.html``) is revalidated via ETag and
+#   answered with ``304 Not Modified`` when unchanged;
+# * the best precompressed variant the client accepts is sent as-is.
+
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, send_file
+
+from compression import accepts_encoding
+
+# Build output whose file names embed a content hash
+IMMUTABLE_PREFIXES = ('_next/static/',)
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticEntry:
+    __slots__ = ('path', 'mimetype', 'etag', 'immutable', 'variants')
+
+    def __init__(self, path, mimetype, etag, immutable, variants):
+        self.path = path
+        self.mimetype = mimetype
+        self.etag = etag
+        self.immutable = immutable
+        # content-coding → path of the precompressed file
+        self.variants = variants
+
+
+def _file_etag(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()[:20]
+
+
+def build_manifest(root):
+    """Index every servable file below ``root`` by its URL path."""
+    manifest = {}
+    if not os.path.isdir(root):
+        return manifest
+    suffixes = tuple(suffix for _, suffix in ENCODINGS)
+    for dirpath, _, filenames in os.walk(root):
+        names = set(filenames)
+        for name in filenames:
+            if name.endswith(suffixes):
+                continue
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if mimetype.startswith('text/') or mimetype in ('application/javascript', 'image/svg+xml'):
+                mimetype += '; charset=utf-8'
+            variants = {
+                coding: os.path.join(dirpath, name + suffix)
+                for coding, suffix in ENCODINGS
+                if name + suffix in names
+            }
+            manifest[rel] = StaticEntry(
+                path=path,
+                mimetype=mimetype,
+                etag=_file_etag(path),
+                immutable=rel.startswith(IMMUTABLE_PREFIXES),
+                variants=variants,
+            )
+    return manifest
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [t.strip() for t in if_none_match.split(',')]
+    return any(c.removeprefix('W/') == f'"{etag}"' for c in candidates)
+
+
+def serve_entry(entry, request):
+    """Build the response for one manifest entry, honouring caching headers."""
+    coding = None
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    for candidate, _ in ENCODINGS:
+        if candidate in entry.variants and accepts_encoding(accept_encoding, candidate):
+            coding = candidate
+            break
+    # the representation differs per coding, so the validator does too
+    etag = f'{entry.etag}-{coding}' if coding else entry.etag
+    cache_control = IMMUTABLE_CACHE_CONTROL if entry.immutable else REVALIDATE_CACHE_CONTROL
+
+    if _etag_matches(request.headers.get('If-None-Match'), etag):
+        resp = Response(status=304)
+    else:
+        resp = send_file(
+            entry.variants[coding] if coding else entry.path,
+            mimetype=entry.mimetype,
+            conditional=False,
+            etag=False,
+            max_age=None,
+        )
+        if coding:
+            resp.headers['Content-Encoding'] = coding
+    resp.headers['ETag'] = f'"{etag}"'
+    resp.headers['Cache-Control'] = cache_control
+    if entry.variants:
+        resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
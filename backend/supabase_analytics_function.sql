@@ -1,3 +1,29 @@
+-- Lifetime visits per address in this database: live rows plus the visits
+-- retention.py has rolled up.  The sharded "all" view adds these up over
+-- every shard (see _sharded_analytics in app.py).
+CREATE OR REPLACE FUNCTION public.ip_visit_counts()
+RETURNS TABLE (public_ip INET, visits BIGINT) LANGUAGE sql STABLE AS $$
+  SELECT c.public_ip, SUM(c.visits)::bigint
+  FROM (
+    SELECT v.public_ip, COUNT(*) AS visits
+    FROM public.visitors v
+    GROUP BY v.public_ip
+    UNION ALL
+    SELECT t.public_ip, t.visits FROM public.ip_visit_totals t
+  ) c
+  GROUP BY c.public_ip
+$$;
+
+-- other_visits became an 11th argument; without the drop, calls that pass
+-- ten would match both versions
+DROP FUNCTION IF EXISTS public.get_filtered_analytics_visual(
+  TEXT, TIMESTAMPTZ, TIMESTAMPTZ, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT
+);
+
+-- other_visits: {"<address>": visits, ...} the addresses of this database
+-- have on other shards.  They are added to the local counts so the unique /
+-- repeated split is global, and the payload then lists in ``shared_ips``
+-- which of the addresses it counted other shards count too.
 CREATE OR REPLACE FUNCTION public.get_filtered_analytics_visual(
   country_filter TEXT DEFAULT NULL,
   start_date_filter TIMESTAMPTZ DEFAULT NULL,
@@ -8,23 +34,49 @@ CREATE OR REPLACE FUNCTION public.get_filtered_analytics_visual(
   browser_filter TEXT DEFAULT NULL,
   ip_filter TEXT DEFAULT NULL,
   isp_filter TEXT DEFAULT NULL,
-  granularity TEXT DEFAULT 'day'
+  granularity TEXT DEFAULT 'day',
+  other_visits JSONB DEFAULT NULL
 )
 RETURNS JSON LANGUAGE plpgsql AS $$
 DECLARE
   analytics_payload JSON;
+  country_key INTEGER;
+  device_key INTEGER;
+  browser_key INTEGER;
+  isp_key INTEGER;
+  ip_range INET;
 BEGIN
+  -- country / device / browser / isp are stored as public.dimensions keys
+  -- (see dimensions.sql): filter and group on the keys, and look labels up
+  -- only for the rows that are returned.  A label that has no key matches
+  -- nothing, since the key stays NULL while its filter is set.  visitors rows
+  -- that ``dimensions.py --backfill`` has not encoded yet still carry the
+  -- text (and no key), so they are matched and labelled by it instead.
+  SELECT id INTO country_key FROM public.dimensions WHERE kind = 'country' AND value = country_filter;
+  SELECT id INTO device_key FROM public.dimensions WHERE kind = 'device_type' AND value = device_filter;
+  SELECT id INTO browser_key FROM public.dimensions WHERE kind = 'browser' AND value = browser_filter;
+  SELECT id INTO isp_key FROM public.dimensions WHERE kind = 'isp' AND value = isp_filter;
+  -- a single address or a CIDR block ('203.0.113.0/24'); <<= uses the
+  -- SP-GiST index on public_ip
+  ip_range := ip_filter::inet;
+
   WITH ip_counts AS (
-    SELECT public_ip, COUNT(*) AS visit_count
-    FROM public.visitors
-    GROUP BY public_ip
+    -- live rows plus visits already rolled up by retention.py, plus the
+    -- visits on other shards when the caller passes them
+    SELECT c.public_ip, SUM(c.visits) AS visit_count
+    FROM (
+      SELECT l.public_ip, l.visits FROM public.ip_visit_counts() l
+      UNION ALL
+      SELECT o.key::inet, o.value::bigint FROM jsonb_each_text(other_visits) o
+    ) c
+    GROUP BY c.public_ip
   ),
   filtered AS (
     SELECT v.*, ic.visit_count
     FROM public.visitors v
     LEFT JOIN ip_counts ic ON v.public_ip = ic.public_ip
     WHERE
-      (country_filter IS NULL OR v.country = country_filter)
+      (country_filter IS NULL OR v.country_id = country_key OR v.country = country_filter)
       AND (start_date_filter IS NULL OR v.first_seen >= start_date_filter)
       AND (end_date_filter IS NULL OR v.first_seen <= end_date_filter)
       AND (
@@ -33,38 +85,144 @@ BEGIN
         OR (visitor_type_filter = 'unique' AND ic.visit_count = 1)
         OR (visitor_type_filter = 'repeated' AND ic.visit_count > 1)
       )
-      AND (device_filter IS NULL OR v.device_type = device_filter)
+      AND (device_filter IS NULL OR v.device_type_id = device_key OR v.device_type = device_filter)
       -- perform case‑insensitive comparison so a mix of upper/lower case
       -- paths (e.g. ``/TPL/`` vs ``/tpl/``) don't get dropped.  the
       -- frontend/backend already normalise the filter string, but ILIKE ensures
       -- the database side is robust as well.
       AND (url_filter IS NULL OR v.page_visited ILIKE url_filter || '%')
-      AND (browser_filter IS NULL OR v.browser = browser_filter)
-      AND (ip_filter IS NULL OR v.public_ip = ip_filter)
-      AND (isp_filter IS NULL OR v.isp = isp_filter)
+      AND (browser_filter IS NULL OR v.browser_id = browser_key OR v.browser = browser_filter)
+      AND (ip_filter IS NULL OR v.public_ip <<= ip_range)
+      AND (isp_filter IS NULL OR v.isp_id = isp_key OR v.isp = isp_filter)
+  ),
+  -- days older than the retention horizon, same filters; a day counts when
+  -- its midnight (UTC) is inside the range
+  archived AS (
+    SELECT
+      (d.day::timestamp AT TIME ZONE 'UTC') AS first_seen,
+      d.public_ip, d.country_code, d.city_id, d.isp_id, d.page_visited,
+      d.device_type_id, d.browser_id, d.visits, d.time_total, d.time_count
+    FROM public.visitor_daily d
+    LEFT JOIN ip_counts ic ON d.public_ip = ic.public_ip
+    WHERE
+      (start_date_filter IS NULL OR (d.day::timestamp AT TIME ZONE 'UTC') >= start_date_filter)
+      AND (end_date_filter IS NULL OR (d.day::timestamp AT TIME ZONE 'UTC') <= end_date_filter)
+      AND (country_filter IS NULL OR d.country_id = country_key)
+      AND (
+        visitor_type_filter IS NULL
+        OR visitor_type_filter = 'all'
+        OR (visitor_type_filter = 'unique' AND ic.visit_count = 1)
+        OR (visitor_type_filter = 'repeated' AND ic.visit_count > 1)
+      )
+      AND (device_filter IS NULL OR d.device_type_id = device_key)
+      AND (url_filter IS NULL OR d.page_visited ILIKE url_filter || '%')
+      AND (browser_filter IS NULL OR d.browser_id = browser_key)
+      AND (ip_filter IS NULL OR d.public_ip <<= ip_range)
+      AND (isp_filter IS NULL OR d.isp_id = isp_key)
+  ),
+  -- every session, live or archived, weighted by how many it stands for
+  weighted AS (
+    SELECT
+      first_seen, public_ip, country_code,
+      COALESCE(city_id, public.dimension_key('city', city)) AS city_id,
+      COALESCE(isp_id, public.dimension_key('isp', isp)) AS isp_id,
+      page_visited,
+      COALESCE(device_type_id, public.dimension_key('device_type', device_type)) AS device_type_id,
+      COALESCE(browser_id, public.dimension_key('browser', browser)) AS browser_id,
+      1::bigint AS visits,
+      COALESCE(time_spent_seconds, 0)::bigint AS time_total,
+      (time_spent_seconds IS NOT NULL)::int::bigint AS time_count
+    FROM filtered
+    UNION ALL
+    SELECT
+      first_seen, public_ip, country_code, city_id, isp_id, page_visited,
+      device_type_id, browser_id, visits, time_total, time_count
+    FROM archived
   ),
   recent AS (
     SELECT * FROM filtered
     ORDER BY first_seen DESC
     LIMIT 100
+  ),
+  -- one row per page view of the filtered sessions; sessions that have no
+  -- events in page_views (written before it existed, or bulk-loaded straight
+  -- into visitors) count their last page once, as do archived sessions
+  page_hits AS (
+    SELECT pv.page_visited, 1::bigint AS views
+    FROM filtered f
+    JOIN public.page_views pv ON pv.session_id = f.session_id
+    WHERE pv.event_type = 'view'
+      AND pv.page_visited IS NOT NULL
+      AND (url_filter IS NULL OR pv.page_visited ILIKE url_filter || '%')
+      AND (start_date_filter IS NULL OR COALESCE(pv.viewed_at, pv.received_at) >= start_date_filter)
+      AND (end_date_filter IS NULL OR COALESCE(pv.viewed_at, pv.received_at) <= end_date_filter)
+    UNION ALL
+    SELECT f.page_visited, 1::bigint
+    FROM filtered f
+    WHERE f.page_visited IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM public.page_views pv WHERE pv.session_id = f.session_id)
+    UNION ALL
+    SELECT a.page_visited, a.visits
+    FROM archived a
+    WHERE a.page_visited IS NOT NULL
+  ),
+  totals AS (
+    SELECT
+      COALESCE(SUM(visits), 0)::bigint AS total_visitors,
+      COUNT(DISTINCT public_ip) AS unique_visitors,
+      COALESCE(ROUND(SUM(time_total)::numeric / NULLIF(SUM(time_count), 0)), 0) AS avg_time_on_page,
+      COALESCE(SUM(time_total), 0)::bigint AS time_total,
+      COALESCE(SUM(time_count), 0)::bigint AS time_count
+    FROM weighted
   )
   SELECT json_build_object(
-    'stats', json_build_object(
-      'total_visitors', (SELECT COUNT(*) FROM filtered),
-      'unique_visitors', (SELECT COUNT(DISTINCT public_ip) FROM filtered),
-      'avg_time_on_page', COALESCE((SELECT ROUND(AVG(time_spent_seconds)) FROM filtered WHERE time_spent_seconds IS NOT NULL), 0)
+    'stats', (
+      SELECT json_build_object(
+        'total_visitors', total_visitors,
+        'unique_visitors', unique_visitors,
+        -- computed here so the API can pass the JSON through untouched
+        'repeated_visitors', GREATEST(total_visitors - unique_visitors, 0),
+        'avg_time_on_page', avg_time_on_page,
+        -- what avg_time_on_page is computed from, for delta refreshes
+        'time_total', time_total,
+        'time_count', time_count
+      ) FROM totals
     ),
-    'visitor_list', COALESCE((SELECT json_agg(r) FROM recent r), '[]'),
+    -- pass back as ``since`` to get_analytics_delta
+    'watermark', (SELECT MAX(id) FROM public.visitors),
+    'shared_ips', CASE WHEN other_visits IS NOT NULL THEN COALESCE((
+      SELECT json_agg(DISTINCT public_ip) FROM weighted WHERE other_visits ? public_ip::text
+    ), '[]') END,
+    'visitor_list', COALESCE((
+      SELECT json_agg(row_to_json(t) ORDER BY t.first_seen DESC NULLS FIRST) FROM (
+        SELECT
+          r.id, r.created_at, r.public_ip, COALESCE(country.value, r.country) AS country,
+          r.country_code, COALESCE(city.value, r.city) AS city, r.page_visited,
+          COALESCE(user_agent.value, r.user_agent) AS user_agent,
+          COALESCE(device_type.value, r.device_type) AS device_type,
+          COALESCE(browser.value, r.browser) AS browser,
+          COALESCE(operating_system.value, r.operating_system) AS operating_system, r.session_id,
+          r.time_spent_seconds, COALESCE(isp.value, r.isp) AS isp, r.first_seen, r.visit_count
+        FROM recent r
+        LEFT JOIN public.dimensions country ON country.id = r.country_id
+        LEFT JOIN public.dimensions city ON city.id = r.city_id
+        LEFT JOIN public.dimensions isp ON isp.id = r.isp_id
+        LEFT JOIN public.dimensions device_type ON device_type.id = r.device_type_id
+        LEFT JOIN public.dimensions browser ON browser.id = r.browser_id
+        LEFT JOIN public.dimensions operating_system ON operating_system.id = r.operating_system_id
+        LEFT JOIN public.dimensions user_agent ON user_agent.id = r.user_agent_id
+      ) t
+    ), '[]'),
     'charts', json_build_object(
       'by_country', COALESCE((
         SELECT json_agg(row_to_json(t))
         FROM (
             SELECT
                 country_code AS id,
-                COUNT(*) AS value,
+                SUM(visits)::bigint AS value,
                 COUNT(DISTINCT public_ip) AS unique_visitors,
-                COUNT(*) - COUNT(DISTINCT public_ip) AS returning_visitors
-            FROM filtered
+                SUM(visits)::bigint - COUNT(DISTINCT public_ip) AS returning_visitors
+            FROM weighted
             WHERE country_code IS NOT NULL
             GROUP BY country_code
             ORDER BY value DESC
@@ -72,18 +230,22 @@ BEGIN
       ), '[]'),
       'by_isp', COALESCE((
         SELECT json_agg(row_to_json(t)) FROM (
-          SELECT isp AS id, COUNT(*) AS value FROM filtered WHERE isp IS NOT NULL
-          GROUP BY isp ORDER BY value DESC
+          SELECT d.value AS id, k.value FROM (
+            SELECT isp_id, SUM(visits)::bigint AS value FROM weighted WHERE isp_id IS NOT NULL
+            GROUP BY isp_id
+          ) k
+          JOIN public.dimensions d ON d.id = k.isp_id
+          ORDER BY k.value DESC
         ) t
       ), '[]'),
       'by_date', COALESCE((
         SELECT json_agg(row_to_json(d)) FROM (
           SELECT
               date_trunc(granularity, first_seen) AS date,
-              COUNT(*) AS count,
+              SUM(visits)::bigint AS count,
               COUNT(DISTINCT public_ip) AS unique_visitors,
-              COUNT(*) - COUNT(DISTINCT public_ip) AS returning_visitors
-          FROM filtered
+              SUM(visits)::bigint - COUNT(DISTINCT public_ip) AS returning_visitors
+          FROM weighted
           GROUP BY 1
           ORDER BY 1
         ) d
@@ -92,10 +254,10 @@ BEGIN
         SELECT json_agg(row_to_json(w)) FROM (
           SELECT
               date_trunc('week', first_seen)::date AS date,
-              COUNT(*) AS count,
+              SUM(visits)::bigint AS count,
               COUNT(DISTINCT public_ip) AS unique_visitors,
-              COUNT(*) - COUNT(DISTINCT public_ip) AS returning_visitors
-          FROM filtered
+              SUM(visits)::bigint - COUNT(DISTINCT public_ip) AS returning_visitors
+          FROM weighted
           GROUP BY date
           ORDER BY date
         ) w
@@ -104,50 +266,262 @@ BEGIN
         SELECT json_agg(row_to_json(m)) FROM (
           SELECT
               date_trunc('month', first_seen)::date AS date,
-              COUNT(*) AS count,
+              SUM(visits)::bigint AS count,
               COUNT(DISTINCT public_ip) AS unique_visitors,
-              COUNT(*) - COUNT(DISTINCT public_ip) AS returning_visitors
-          FROM filtered
+              SUM(visits)::bigint - COUNT(DISTINCT public_ip) AS returning_visitors
+          FROM weighted
           GROUP BY date
           ORDER BY date
         ) m
       ), '[]'),
       'by_device', COALESCE((
         SELECT json_agg(row_to_json(t)) FROM (
-          SELECT device_type, COUNT(*) AS count FROM filtered WHERE device_type IS NOT NULL
-          GROUP BY device_type ORDER BY count DESC
+          SELECT d.value AS device_type, k.count FROM (
+            SELECT device_type_id, SUM(visits)::bigint AS count FROM weighted WHERE device_type_id IS NOT NULL
+            GROUP BY device_type_id
+          ) k
+          JOIN public.dimensions d ON d.id = k.device_type_id
+          ORDER BY k.count DESC
         ) t
       ), '[]'),
       'by_browser', COALESCE((
         SELECT json_agg(row_to_json(t)) FROM (
-          SELECT browser, COUNT(*) AS count FROM filtered WHERE browser IS NOT NULL
-          GROUP BY browser ORDER BY count DESC LIMIT 5
+          SELECT d.value AS browser, k.count FROM (
+            SELECT browser_id, SUM(visits)::bigint AS count FROM weighted WHERE browser_id IS NOT NULL
+            GROUP BY browser_id ORDER BY count DESC LIMIT 5
+          ) k
+          JOIN public.dimensions d ON d.id = k.browser_id
+          ORDER BY k.count DESC
         ) t
       ), '[]'),
       'by_city', COALESCE((
         SELECT json_agg(row_to_json(t)) FROM (
-          SELECT city, COUNT(*) AS count FROM filtered WHERE city IS NOT NULL
-          GROUP BY city ORDER BY count DESC LIMIT 10
+          SELECT d.value AS city, k.count FROM (
+            SELECT city_id, SUM(visits)::bigint AS count FROM weighted WHERE city_id IS NOT NULL
+            GROUP BY city_id ORDER BY count DESC LIMIT 10
+          ) k
+          JOIN public.dimensions d ON d.id = k.city_id
+          ORDER BY k.count DESC
         ) t
       ), '[]'),
       'by_page', COALESCE((
         SELECT json_agg(row_to_json(t)) FROM (
-          SELECT page_visited, COUNT(*) AS count FROM filtered WHERE page_visited IS NOT NULL
+          SELECT page_visited, SUM(views)::bigint AS count FROM page_hits
           GROUP BY page_visited ORDER BY count DESC LIMIT 10
         ) t
       ), '[]')
     ),
     'meta', json_build_object(
-      'distinct_countries', (SELECT json_agg(DISTINCT country) FROM public.visitors WHERE country IS NOT NULL),
-      'distinct_isps', (SELECT json_agg(DISTINCT isp) FROM public.visitors WHERE isp IS NOT NULL),
-      'distinct_devices', (SELECT json_agg(DISTINCT device_type) FROM public.visitors WHERE device_type IS NOT NULL),
-      'distinct_urls', (SELECT json_agg(DISTINCT page_visited) FROM public.visitors WHERE page_visited IS NOT NULL),
-      'distinct_browsers', (SELECT json_agg(DISTINCT browser) FROM public.visitors WHERE browser IS NOT NULL),
-      'distinct_ips', (SELECT json_agg(DISTINCT public_ip) FROM public.visitors WHERE public_ip IS NOT NULL)
+      -- the dictionary already holds each label once
+      'distinct_countries', (SELECT json_agg(value ORDER BY value) FROM public.dimensions WHERE kind = 'country'),
+      'distinct_isps', (SELECT json_agg(value ORDER BY value) FROM public.dimensions WHERE kind = 'isp'),
+      'distinct_devices', (SELECT json_agg(value ORDER BY value) FROM public.dimensions WHERE kind = 'device_type'),
+      'distinct_urls', (SELECT json_agg(DISTINCT page_visited) FROM (SELECT page_visited FROM public.visitors UNION SELECT page_visited FROM public.visitor_daily) m WHERE page_visited IS NOT NULL),
+      'distinct_browsers', (SELECT json_agg(value ORDER BY value) FROM public.dimensions WHERE kind = 'browser'),
+      'distinct_ips', (SELECT json_agg(DISTINCT public_ip) FROM (SELECT public_ip FROM public.visitors UNION SELECT public_ip FROM public.visitor_daily) m WHERE public_ip IS NOT NULL)
     )
   )
   INTO analytics_payload;
 
   RETURN analytics_payload;
 END;
-$$;
\ No newline at end of file
+$$;
+
+-- Delta refresh for polling dashboards: what changed since ``since_id``, the
+-- watermark a previous call returned.  Only visitors rows with id > since_id
+-- are read, plus the rows of the by_date buckets they fall into
+-- (visitors_first_seen_idx), instead of the whole date range:
+--
+--   watermark            MAX(visitors.id) now; pass it as the next since_id
+--   visitor_list         the new rows, newest first, shaped as in the full payload
+--   charts.by_date       the touched buckets, recomputed in full (replace them)
+--   stats_delta          increments of total_visitors, unique_visitors,
+--                        time_total and time_count
+--
+-- Sessions are inserted by the compactor, one pass at a time, so ids become
+-- visible in order and no row below a returned watermark appears later.
+-- Updates to existing sessions (time reports, a later page) and the other
+-- charts are picked up by the next full payload.  The unique / repeated
+-- visitor filters depend on every IP's visit count, which new rows change
+-- for old rows as well, so with those the full payload is returned instead
+-- (no ``delta`` key).
+CREATE OR REPLACE FUNCTION public.get_analytics_delta(
+  since_id BIGINT,
+  country_filter TEXT DEFAULT NULL,
+  start_date_filter TIMESTAMPTZ DEFAULT NULL,
+  end_date_filter TIMESTAMPTZ DEFAULT NULL,
+  visitor_type_filter TEXT DEFAULT NULL,
+  device_filter TEXT DEFAULT NULL,
+  url_filter TEXT DEFAULT NULL,
+  browser_filter TEXT DEFAULT NULL,
+  ip_filter TEXT DEFAULT NULL,
+  isp_filter TEXT DEFAULT NULL,
+  granularity TEXT DEFAULT 'day'
+)
+RETURNS JSON LANGUAGE plpgsql AS $$
+DECLARE
+  delta_payload JSON;
+  new_watermark BIGINT;
+  country_key INTEGER;
+  device_key INTEGER;
+  browser_key INTEGER;
+  isp_key INTEGER;
+  ip_range INET;
+BEGIN
+  IF visitor_type_filter IN ('unique', 'repeated') THEN
+    RETURN public.get_filtered_analytics_visual(
+      country_filter, start_date_filter, end_date_filter, visitor_type_filter, device_filter,
+      url_filter, browser_filter, ip_filter, isp_filter, granularity
+    );
+  END IF;
+
+  SELECT id INTO country_key FROM public.dimensions WHERE kind = 'country' AND value = country_filter;
+  SELECT id INTO device_key FROM public.dimensions WHERE kind = 'device_type' AND value = device_filter;
+  SELECT id INTO browser_key FROM public.dimensions WHERE kind = 'browser' AND value = browser_filter;
+  SELECT id INTO isp_key FROM public.dimensions WHERE kind = 'isp' AND value = isp_filter;
+  ip_range := ip_filter::inet;
+  -- never behind since_id, e.g. when a more lagged replica answers this call
+  SELECT GREATEST(MAX(id), since_id) INTO new_watermark FROM public.visitors;
+
+  WITH matching AS NOT MATERIALIZED (
+    SELECT v.*
+    FROM public.visitors v
+    WHERE v.id <= new_watermark
+      AND (country_filter IS NULL OR v.country_id = country_key OR v.country = country_filter)
+      AND (start_date_filter IS NULL OR v.first_seen >= start_date_filter)
+      AND (end_date_filter IS NULL OR v.first_seen <= end_date_filter)
+      AND (device_filter IS NULL OR v.device_type_id = device_key OR v.device_type = device_filter)
+      AND (url_filter IS NULL OR v.page_visited ILIKE url_filter || '%')
+      AND (browser_filter IS NULL OR v.browser_id = browser_key OR v.browser = browser_filter)
+      AND (ip_filter IS NULL OR v.public_ip <<= ip_range)
+      AND (isp_filter IS NULL OR v.isp_id = isp_key OR v.isp = isp_filter)
+  ),
+  archived AS NOT MATERIALIZED (
+    SELECT (d.day::timestamp AT TIME ZONE 'UTC') AS first_seen, d.day, d.public_ip, d.visits
+    FROM public.visitor_daily d
+    WHERE
+      (start_date_filter IS NULL OR (d.day::timestamp AT TIME ZONE 'UTC') >= start_date_filter)
+      AND (end_date_filter IS NULL OR (d.day::timestamp AT TIME ZONE 'UTC') <= end_date_filter)
+      AND (country_filter IS NULL OR d.country_id = country_key)
+      AND (device_filter IS NULL OR d.device_type_id = device_key)
+      AND (url_filter IS NULL OR d.page_visited ILIKE url_filter || '%')
+      AND (browser_filter IS NULL OR d.browser_id = browser_key)
+      AND (ip_filter IS NULL OR d.public_ip <<= ip_range)
+      AND (isp_filter IS NULL OR d.isp_id = isp_key)
+  ),
+  fresh AS (
+    SELECT * FROM matching WHERE id > since_id
+  ),
+  touched AS (
+    SELECT DISTINCT date_trunc(granularity, first_seen) AS bucket
+    FROM fresh
+    WHERE first_seen IS NOT NULL
+  ),
+  bucket_rows AS (
+    SELECT date_trunc(granularity, m.first_seen) AS bucket, m.public_ip, 1::bigint AS visits
+    FROM matching m
+    -- lets visitors_first_seen_idx narrow the scan to the touched buckets
+    WHERE m.first_seen >= (SELECT MIN(bucket) FROM touched)
+      AND date_trunc(granularity, m.first_seen) IN (SELECT bucket FROM touched)
+    UNION ALL
+    SELECT date_trunc(granularity, a.first_seen), a.public_ip, a.visits
+    FROM archived a
+    WHERE a.day >= ((SELECT MIN(bucket) FROM touched) - interval '1 day')::date
+      AND date_trunc(granularity, a.first_seen) IN (SELECT bucket FROM touched)
+  ),
+  -- addresses in the new rows that the range had not seen before
+  new_ips AS (
+    SELECT DISTINCT f.public_ip
+    FROM fresh f
+    WHERE f.public_ip IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM matching m WHERE m.public_ip = f.public_ip AND m.id <= since_id)
+      AND NOT EXISTS (SELECT 1 FROM archived a WHERE a.public_ip = f.public_ip)
+  ),
+  recent AS (
+    SELECT * FROM fresh
+    ORDER BY first_seen DESC
+    LIMIT 100
+  )
+  SELECT json_build_object(
+    'delta', true,
+    'since', since_id,
+    'watermark', new_watermark,
+    'stats_delta', (
+      SELECT json_build_object(
+        'total_visitors', COUNT(*),
+        'unique_visitors', (SELECT COUNT(*) FROM new_ips),
+        'time_total', COALESCE(SUM(time_spent_seconds), 0),
+        'time_count', COUNT(time_spent_seconds)
+      ) FROM fresh
+    ),
+    'visitor_list', COALESCE((
+      SELECT json_agg(row_to_json(t) ORDER BY t.first_seen DESC NULLS FIRST) FROM (
+        SELECT
+          r.id, r.created_at, r.public_ip, COALESCE(country.value, r.country) AS country,
+          r.country_code, COALESCE(city.value, r.city) AS city, r.page_visited,
+          COALESCE(user_agent.value, r.user_agent) AS user_agent,
+          COALESCE(device_type.value, r.device_type) AS device_type,
+          COALESCE(browser.value, r.browser) AS browser,
+          COALESCE(operating_system.value, r.operating_system) AS operating_system, r.session_id,
+          r.time_spent_seconds, COALESCE(isp.value, r.isp) AS isp, r.first_seen,
+          (SELECT COUNT(*) FROM public.visitors v WHERE v.public_ip = r.public_ip)
+            + COALESCE((SELECT ipt.visits FROM public.ip_visit_totals ipt WHERE ipt.public_ip = r.public_ip), 0)
+            AS visit_count
+        FROM recent r
+        LEFT JOIN public.dimensions country ON country.id = r.country_id
+        LEFT JOIN public.dimensions city ON city.id = r.city_id
+        LEFT JOIN public.dimensions isp ON isp.id = r.isp_id
+        LEFT JOIN public.dimensions device_type ON device_type.id = r.device_type_id
+        LEFT JOIN public.dimensions browser ON browser.id = r.browser_id
+        LEFT JOIN public.dimensions operating_system ON operating_system.id = r.operating_system_id
+        LEFT JOIN public.dimensions user_agent ON user_agent.id = r.user_agent_id
+      ) t
+    ), '[]'),
+    'charts', json_build_object(
+      'by_date', COALESCE((
+        SELECT json_agg(row_to_json(d)) FROM (
+          SELECT
+              bucket AS date,
+              SUM(visits)::bigint AS count,
+              COUNT(DISTINCT public_ip) AS unique_visitors,
+              SUM(visits)::bigint - COUNT(DISTINCT public_ip) AS returning_visitors
+          FROM bucket_rows
+          GROUP BY 1
+          ORDER BY 1
+        ) d
+      ), '[]')
+    )
+  )
+  INTO delta_payload;
+
+  RETURN delta_payload;
+END;
+$$;
+
+-- Reshape a chart series (array of objects) into parallel arrays:
+--   [{"date": d1, "count": 1}, {"date": d2, "count": 2}]
+--   → {"date": [d1, d2], "count": [1, 2]}
+-- Used by the API's optional columnar encoding.
+CREATE OR REPLACE FUNCTION public.analytics_series_to_columns(series JSONB)
+RETURNS JSONB LANGUAGE sql IMMUTABLE AS $$
+  SELECT COALESCE(jsonb_object_agg(key, vals), '{}'::jsonb)
+  FROM (
+    SELECT e.key, jsonb_agg(e.value ORDER BY r.ord) AS vals
+    FROM jsonb_array_elements(series) WITH ORDINALITY AS r(obj, ord),
+         jsonb_each(r.obj) AS e
+    GROUP BY e.key
+  ) cols
+$$;
+
+-- The analytics payload with every chart series in columnar form.
+CREATE OR REPLACE FUNCTION public.analytics_columnar(payload JSONB)
+RETURNS JSONB LANGUAGE sql IMMUTABLE AS $$
+  SELECT jsonb_set(
+    payload,
+    '{charts}',
+    COALESCE((
+      SELECT jsonb_object_agg(name, public.analytics_series_to_columns(series))
+      FROM jsonb_each(payload->'charts') AS c(name, series)
+    ), '{}'::jsonb)
+  )
+$$;
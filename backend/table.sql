@@ -1,7 +1,7 @@
-create table public.visitors (
+create table if not exists public.visitors (
   id bigserial not null,
   created_at timestamp with time zone not null default now(),
-  public_ip text null,
+  public_ip inet null,
   country text null,
   country_code text null,
   city text null,
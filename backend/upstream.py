@@ -0,0 +1,541 @@
+# Pooled, cached access to the app user-detail upstreams
+#
+# ``/api/app-users`` used to open a fresh ``httpx.Client`` per request, which
+# meant a new TCP+TLS handshake to the institutional servers every time and
+# no reuse of identical answers.  ``UpstreamPool`` keeps one long-lived
+# keep-alive client per upstream and caches normalised responses keyed by
+# ``(app, start_date, end_date)``:
+#
+# * fresh entries are served straight from memory;
+# * stale entries (within the stale window) are served immediately while one
+#   background refresh runs (stale-while-revalidate);
+# * concurrent misses for the same key share a single upstream call
+#   (single-flight).
+#
+# Errors are never cached; a failed refresh leaves the stale entry in place.
+# The cache is bounded by the size of the upstream bodies it holds
+# (``max_bytes``) as well as by entry count, and dates are normalised to
+# ``YYYY-MM-DD`` before they become part of a key.
+#
+# ``fetch_many`` fans one query out to several upstreams on a bounded thread
+# pool and returns whatever finished before the deadline, with per-upstream
+# status and timing.  The deadline is also the timeout of every request the
+# fan-out makes, so a call that misses it gives its pool thread back instead
+# of holding it until the upstream answers.
+#
+# Export bodies can be very large, so they are parsed incrementally with
+# ijson: each ``details`` entry (or each entry of ``details.users``,
+# ``details.admins`` and ``details.surveys`` for the export_all_data
+# upstreams) is normalised as soon as it has been read and the raw document
+# is never held in memory.  ``select_users`` then filters,
+# projects and pages the cached list so clients only receive what they show.
+
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import httpx
+import ijson
+
+UPSTREAM_HEADERS = {
+    'Content-Type': 'application/json',
+    'Accept': '*/*',
+    'User-Agent': (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+        'AppleWebKit/537.36 (KHTML, like Gecko) '
+        'Chrome/144.0.0.0 Safari/537.36'
+    ),
+}
+
+
+def normalize_date(value):
+    """``''`` or an ISO date, as ``YYYY-MM-DD``; ValueError for anything else."""
+    value = str(value or '').strip()
+    return date.fromisoformat(value).isoformat() if value else ''
+
+
+def normalize_users(upstream):
+    """Map an upstream document onto the ``{'users': [...]}`` shape the frontend uses."""
+    if isinstance(upstream, dict):
+        details = upstream.get('details')
+        if isinstance(details, list):
+            return {'users': [normalize_detail(d) for d in details]}
+        if _has_nested_details(details):
+            return {'users': [
+                normalize_nested_detail(d, role) if isinstance(d, dict) else d
+                for key, role in _NESTED_DETAILS if isinstance(details.get(key), list)
+                for d in details[key]
+            ]}
+
+        for key in ('users', 'data', 'results'):
+            if isinstance(upstream.get(key), list):
+                return {'users': upstream[key]}
+
+    if isinstance(upstream, list):
+        return {'users': upstream}
+
+    # Fallback: wrap whatever came back
+    return {'users': [], 'raw': upstream}
+
+
+def normalize_detail(d):
+    """Normalise one ``details`` entry from the export endpoints."""
+    return {
+        'userid':         d.get('userid'),
+        'user_name':      d.get('rep_name') or d.get('name') or d.get('username') or '',
+        'user_role':      d.get('user_role') or d.get('role'),
+        'district':       d.get('district_name') or d.get('district'),
+        'police_station': d.get('police_station') or d.get('ps') or None,
+        'last_login':     d.get('last_login'),
+        'phone':          d.get('phone_no'),
+    }
+
+
+def normalize_nested_detail(d, role):
+    """Normalise one entry of ``details.users``/``admins``/``surveys``.
+
+    These rows differ per app, so every upstream field is kept for the
+    frontend's columns; ``_role`` says which array the row came from and
+    ``district``/``user_role`` are filled in for ``select_users``.
+    """
+    row = dict(d)
+    row['_role'] = role
+    row['district'] = d.get('district_name') or d.get('district')
+    row['user_role'] = d.get('user_role') or d.get('role') or role
+    return row
+
+
+# Arrays that hold user rows, in order of preference, and how to map each item
+_USER_ARRAYS = (
+    ('details', normalize_detail),
+    ('users', None),
+    ('data', None),
+    ('results', None),
+)
+
+# export_all_data upstreams: ``details`` is an object of arrays, one per role
+_NESTED_DETAILS = (('users', 'User'), ('admins', 'Admin'), ('surveys', 'Survey'))
+
+
+def _has_nested_details(details):
+    return isinstance(details, dict) and any(
+        isinstance(details.get(key), list) for key, _ in _NESTED_DETAILS
+    )
+
+
+class _IterReader:
+    """Minimal file-like adapter over an iterator of byte chunks for ijson."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.bytes_read += len(chunk)
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _until(chunks, stop):
+    """Yield from ``chunks``, raising ``httpx.ReadTimeout`` once ``stop`` has passed.
+
+    httpx timeouts apply to each read, so a body that trickles in would
+    otherwise outlive the caller's deadline.
+    """
+    for chunk in chunks:
+        if time.perf_counter() > stop:
+            raise httpx.ReadTimeout('Upstream body not received before the deadline')
+        yield chunk
+
+
+def stream_users(chunks):
+    """Incrementally parse an upstream body and normalise it like ``normalize_users``.
+
+    ``chunks`` is an iterator of bytes (e.g. ``httpx.Response.iter_bytes()``).
+    Only one user entry is materialised at a time besides the output list.
+    """
+    reader = _IterReader(chunks)
+    events = ijson.parse(reader, use_float=True)
+
+    first = next(events, None)
+    if first is None:
+        raise ValueError('Empty upstream response')
+    _, event, value = first
+    if event == 'start_array':
+        item_prefixes = {'item': None}
+    elif event == 'start_map':
+        item_prefixes = {f'{key}.item': mapper for key, mapper in _USER_ARRAYS}
+        item_prefixes.update(
+            (f'details.{key}.item', partial(normalize_nested_detail, role=role))
+            for key, role in _NESTED_DETAILS
+        )
+    else:
+        return {'users': [], 'raw': value}, reader.bytes_read
+
+    found = {}
+    # everything outside the user arrays is kept so unknown shapes can still
+    # be returned as ``raw``; with the arrays streamed, what remains is small
+    root = ijson.ObjectBuilder()
+    root.event(event, value)
+    item = None
+    item_prefix = None
+    for prefix, event, value in events:
+        if item is not None:
+            if prefix == item_prefix and event in ('end_map', 'end_array'):
+                item.event(event, value)
+                mapper = item_prefixes[item_prefix]
+                found[item_prefix].append(mapper(item.value) if mapper else item.value)
+                item = None
+            else:
+                item.event(event, value)
+            continue
+        if prefix in item_prefixes:
+            rows = found.setdefault(prefix, [])
+            if event in ('start_map', 'start_array'):
+                item_prefix = prefix
+                item = ijson.ObjectBuilder()
+                item.event(event, value)
+            else:
+                mapper = item_prefixes[prefix]
+                rows.append(mapper(value) if mapper and isinstance(value, dict) else value)
+            continue
+        root.event(event, value)
+
+    if 'item' in item_prefixes:
+        return {'users': found.get('item', [])}, reader.bytes_read
+    for key, _ in _USER_ARRAYS:
+        # an empty array produces no item events but is still a match
+        if f'{key}.item' in found or isinstance(root.value.get(key), list):
+            return {'users': found.get(f'{key}.item', [])}, reader.bytes_read
+        if key == 'details' and _has_nested_details(root.value.get('details')):
+            return {'users': [
+                row for nested, _ in _NESTED_DETAILS
+                for row in found.get(f'details.{nested}.item', [])
+            ]}, reader.bytes_read
+    return {'users': [], 'raw': root.value}, reader.bytes_read
+
+
+def select_users(payload, district=None, role=None, fields=None, page=None, page_size=None):
+    """Filter, project and paginate a normalised ``{'users': [...]}`` payload.
+
+    ``district``/``role`` match case-insensitively against the normalised
+    ``district``/``user_role`` fields; ``fields`` is a list of keys to keep.
+    Without ``page_size`` every matching row is returned.
+    """
+    users = payload.get('users', [])
+    if district or role:
+        district = district.lower() if district else None
+        role = role.lower() if role else None
+        users = [
+            u for u in users
+            if isinstance(u, dict)
+            and (not district or str(u.get('district') or '').lower() == district)
+            and (not role or str(u.get('user_role') or '').lower() == role)
+        ]
+
+    result = {k: v for k, v in payload.items() if k != 'users'}
+    result['total'] = len(users)
+    if page_size:
+        page = max(1, page or 1)
+        start = (page - 1) * page_size
+        users = users[start:start + page_size]
+        result['page'] = page
+        result['page_size'] = page_size
+    if fields:
+        users = [
+            {k: u.get(k) for k in fields} if isinstance(u, dict) else u
+            for u in users
+        ]
+    result['users'] = users
+    return result
+
+
+class _Call:
+    """One in-flight upstream request that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class UpstreamPool:
+    """Keep-alive clients per upstream plus a stale-while-revalidate cache."""
+
+    def __init__(self, endpoints, timeout=30.0, fresh_seconds=60.0,
+                 stale_seconds=600.0, max_entries=256, max_bytes=64 * 2**20,
+                 max_connections=10, fanout_workers=8, clock=time.monotonic,
+                 logger=None, observe=None):
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.fresh_seconds = fresh_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        # upstream body bytes held by the cache, a proxy for its memory
+        self.max_bytes = max_bytes
+        self._cache_bytes = 0
+        self.max_connections = max_connections
+        self._clock = clock
+        self._logger = logger
+        # observe(app_slug, seconds, outcome) after every real upstream call
+        self._observe = observe
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=fanout_workers, thread_name_prefix='upstream-fanout'
+        )
+
+    def client(self, app_slug):
+        """Return the shared client for ``app_slug``, creating it on first use."""
+        with self._lock:
+            client = self._clients.get(app_slug)
+            if client is None:
+                # verify=False: many internal/institutional servers use
+                # self-signed certs; disabling verification prevents SSL
+                # handshake timeouts on the proxy side.
+                client = httpx.Client(
+                    verify=False,
+                    timeout=self.timeout,
+                    headers=UPSTREAM_HEADERS,
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_connections,
+                        keepalive_expiry=60.0,
+                    ),
+                )
+                self._clients[app_slug] = client
+            return client
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    # -- fetching -----------------------------------------------------------
+
+    def _fetch_upstream(self, app_slug, start_date, end_date, timeout=None):
+        upstream_url = self.endpoints[app_slug]
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = httpx.Timeout(timeout)
+        with self.client(app_slug).stream(
+            'POST', upstream_url, json={'start_date': start_date, 'end_date': end_date},
+            **kwargs
+        ) as resp:
+            if resp.is_error:
+                # error bodies are small; read them so callers can log the text
+                resp.read()
+            resp.raise_for_status()
+            chunks = resp.iter_bytes()
+            if timeout is not None:
+                chunks = _until(chunks, time.perf_counter() + timeout)
+            payload, size = stream_users(chunks)
+        if self._logger:
+            self._logger.info(f"Upstream OK ({size} bytes) for {app_slug}")
+        return payload, size
+
+    def _store(self, key, payload, size):
+        # caller holds the lock
+        previous = self._cache.pop(key, None)
+        if previous is not None:
+            self._cache_bytes -= previous[2]
+        if size > self.max_bytes:
+            # larger than the whole cache: served, never kept
+            return
+        self._cache[key] = (payload, self._clock(), size)
+        self._cache_bytes += size
+        while len(self._cache) > self.max_entries or self._cache_bytes > self.max_bytes:
+            self._cache_bytes -= self._cache.popitem(last=False)[1][2]
+
+    def _run(self, key, call, timeout=None):
+        started = time.perf_counter()
+        try:
+            call.result, size = self._fetch_upstream(*key, timeout=timeout)
+            self._observed(key[0], started, 'ok')
+            with self._lock:
+                self._store(key, call.result, size)
+        except Exception as e:
+            call.error = e
+            self._observed(key[0], started, 'error')
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            call.done.set()
+
+    def _observed(self, app_slug, started, outcome):
+        if self._observe is not None:
+            self._observe(app_slug, time.perf_counter() - started, outcome)
+
+    def _start(self, key):
+        # caller holds the lock; returns (call, owner)
+        call = self._inflight.get(key)
+        if call is not None:
+            return call, False
+        call = self._inflight[key] = _Call()
+        return call, True
+
+    def _revalidate(self, key, call):
+        self._run(key, call)
+        if call.error is not None and self._logger:
+            self._logger.error(f"Background refresh failed for {key[0]}: {call.error}")
+
+    def fetch(self, app_slug, start_date='', end_date='', timeout=None):
+        """Return ``(payload, cache_status)`` for one upstream query.
+
+        ``cache_status`` is ``HIT``, ``STALE`` or ``MISS``.  Upstream errors
+        (``httpx.HTTPStatusError``, timeouts, ...) propagate to the caller.
+        ``timeout`` caps the whole miss – connect, wait and body – in seconds
+        (default: the client timeout per operation).
+        """
+        if app_slug not in self.endpoints:
+            raise KeyError(app_slug)
+        key = (app_slug, normalize_date(start_date), normalize_date(end_date))
+        now = self._clock()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                payload, fetched_at, _ = entry
+                age = now - fetched_at
+                if age < self.fresh_seconds:
+                    self._cache.move_to_end(key)
+                    return payload, 'HIT'
+                if age < self.fresh_seconds + self.stale_seconds:
+                    call, owner = self._start(key)
+                    if owner:
+                        threading.Thread(
+                            target=self._revalidate, args=(key, call),
+                            name=f'upstream-refresh-{app_slug}', daemon=True,
+                        ).start()
+                    return payload, 'STALE'
+            call, owner = self._start(key)
+
+        if owner:
+            self._run(key, call, timeout)
+        elif not call.done.wait(timeout):
+            raise httpx.TimeoutException(f'No response from {app_slug} within {timeout:g}s')
+        if call.error is not None:
+            raise call.error
+        return call.result, 'MISS'
+
+    def _timed_fetch(self, app_slug, start_date, end_date, stop):
+        started = time.perf_counter()
+        try:
+            remaining = stop - started
+            if remaining <= 0:
+                # queued behind other calls until the fan-out had given up
+                raise httpx.TimeoutException(f'No slot for {app_slug} before the deadline')
+            payload, cache_status = self.fetch(app_slug, start_date, end_date, timeout=remaining)
+            return payload, cache_status, None, time.perf_counter() - started
+        except Exception as e:
+            return None, None, e, time.perf_counter() - started
+
+    def fetch_many(self, app_slugs, start_date='', end_date='', deadline=None):
+        """Query several upstreams concurrently and merge their ``users``.
+
+        Each upstream gets ``deadline`` seconds (default: the client timeout);
+        the calls run in parallel, so the whole fan-out is bounded by the same
+        figure, and each request is given up at that point too.  Upstreams
+        that fail or miss the deadline are reported in ``upstreams`` and
+        contribute no rows – the rest are still returned.
+        Every user row is tagged with the ``app`` it came from.
+        """
+        deadline = self.timeout if deadline is None else deadline
+        started = time.perf_counter()
+        futures = {
+            slug: self._executor.submit(
+                self._timed_fetch, slug, start_date, end_date, started + deadline
+            )
+            for slug in app_slugs
+        }
+
+        users = []
+        upstreams = {}
+        for slug, future in futures.items():
+            remaining = max(0.0, deadline - (time.perf_counter() - started))
+            try:
+                payload, cache_status, error, elapsed = future.result(timeout=remaining)
+            except FutureTimeout:
+                # the request hits the same deadline and frees its thread
+                upstreams[slug] = {
+                    'status': 'timeout',
+                    'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+                    'error': f'No response within {deadline:g}s',
+                    'count': 0,
+                }
+                continue
+
+            if isinstance(error, httpx.TimeoutException):
+                upstreams[slug] = {
+                    'status': 'timeout',
+                    'elapsed_ms': round(elapsed * 1000, 1),
+                    'error': f'No response within {deadline:g}s',
+                    'count': 0,
+                }
+                continue
+
+            if error is not None:
+                if isinstance(error, httpx.HTTPStatusError):
+                    message = f'Upstream returned {error.response.status_code}'
+                else:
+                    message = str(error)
+                if self._logger:
+                    self._logger.error(f"Fan-out to {slug} failed: {message}")
+                upstreams[slug] = {
+                    'status': 'error',
+                    'elapsed_ms': round(elapsed * 1000, 1),
+                    'error': message,
+                    'count': 0,
+                }
+                continue
+
+            if 'raw' in payload:
+                # a shape stream_users doesn't know: say so instead of
+                # reporting an upstream with no users
+                if self._logger:
+                    self._logger.error(f"Fan-out to {slug}: unrecognised response shape")
+                upstreams[slug] = {
+                    'status': 'error',
+                    'elapsed_ms': round(elapsed * 1000, 1),
+                    'error': 'Unrecognised upstream response',
+                    'count': 0,
+                }
+                continue
+
+            rows = payload.get('users', [])
+            users.extend(
+                dict(row, app=slug) if isinstance(row, dict) else {'app': slug, 'value': row}
+                for row in rows
+            )
+            upstreams[slug] = {
+                'status': 'ok',
+                'elapsed_ms': round(elapsed * 1000, 1),
+                'cache': cache_status,
+                'count': len(rows),
+            }
+
+        return {
+            'users': users,
+            'upstreams': upstreams,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        }
@@ -1,7 +1,7 @@
 
 "use client";
 
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
 import { useRouter } from "next/navigation";
 import { Header } from "@/components/header";
 import { StatsGrid } from "@/components/stats-cards";
@@ -36,6 +36,55 @@ interface AnalyticsData {
     by_browser: any[];
   };
   visitor_list: Visitor[];
+  watermark?: number | null;
+}
+
+// Response to /api/analytics?since=<watermark>: only what changed
+interface AnalyticsDelta {
+  delta: true;
+  watermark: number | null;
+  stats_delta: {
+    total_visitors: number;
+    unique_visitors: number;
+    time_total: number;
+    time_count: number;
+  };
+  charts: { by_date: TrafficTimelineData[] };
+  visitor_list: Visitor[];
+}
+
+// Every Nth auto-refresh reloads the full payload (top-N charts, updated sessions)
+const FULL_REFRESH_EVERY = 10;
+
+function mergeDelta(current: AnalyticsData, delta: AnalyticsDelta): AnalyticsData {
+  const d = delta.stats_delta;
+  const stats = { ...current.stats } as AnalyticsData["stats"] & { time_total?: number; time_count?: number };
+  stats.total_visitors += d.total_visitors;
+  stats.unique_visitors += d.unique_visitors;
+  stats.repeated_visitors = Math.max(stats.total_visitors - stats.unique_visitors, 0);
+  if (stats.time_total !== undefined && stats.time_count !== undefined) {
+    stats.time_total += d.time_total;
+    stats.time_count += d.time_count;
+    stats.avg_time_on_page = stats.time_count ? Math.round(stats.time_total / stats.time_count) : 0;
+  }
+
+  // touched buckets come back recomputed in full: replace them
+  const buckets = new Map(current.charts.by_date.map((row) => [row.date, row]));
+  for (const row of delta.charts.by_date) {
+    buckets.set(row.date, row);
+  }
+  const byDate = Array.from(buckets.values()).sort((a, b) => a.date.localeCompare(b.date));
+
+  const fresh = new Set(delta.visitor_list.map((v) => v.id));
+  const visitors = [...delta.visitor_list, ...current.visitor_list.filter((v) => !fresh.has(v.id))].slice(0, 100);
+
+  return {
+    ...current,
+    stats,
+    charts: { ...current.charts, by_date: byDate },
+    visitor_list: visitors,
+    watermark: delta.watermark,
+  };
 }
 
 export default function DashboardPage() {
@@ -48,6 +97,7 @@ export default function DashboardPage() {
   const [selectedPeriod, setSelectedPeriod] = useState<'day' | 'week' | 'month' | 'all' | 'custom'>('day');
   const [selectedSite, setSelectedSite] = useState<string>('all');
   const [sites, setSites] = useState<Array<{ id: string; name: string }>>([]);
+  const watermarkRef = useRef<number | null>(null);
 
   useEffect(() => {
     const currentSession = getStoredSession();
@@ -83,7 +133,7 @@ export default function DashboardPage() {
     loadSites();
   }, [authReady, session]);
 
-  const loadData = async (currentFilters: FiltersState) => {
+  const loadData = async (currentFilters: FiltersState, delta = false) => {
     const cleanedFilters: { [key: string]: string } = {};
     for (const key in currentFilters) {
       if (currentFilters[key] && currentFilters[key] !== "all") {
@@ -98,7 +148,10 @@ export default function DashboardPage() {
     cleanedFilters['site_filter'] = selectedSite;
 
     const params = new URLSearchParams(cleanedFilters);
-    
+    if (delta && watermarkRef.current !== null) {
+      params.set('since', String(watermarkRef.current));
+    }
+
     try {
       const response = await fetch(`/api/analytics?${params.toString()}`, {
         method: 'GET',
@@ -109,8 +162,13 @@ export default function DashboardPage() {
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
-      const data = await response.json();
-      setData(data);
+      const payload = await response.json();
+      watermarkRef.current = payload.watermark ?? null;
+      if (payload.delta) {
+        setData((current) => (current ? mergeDelta(current, payload as AnalyticsDelta) : current));
+      } else {
+        setData(payload);
+      }
     } catch (error) {
       console.error("Failed to load analytics data:", error);
     }
@@ -121,8 +179,13 @@ export default function DashboardPage() {
       return;
     }
 
+    watermarkRef.current = null;
     loadData(filters);
-    const interval = setInterval(() => loadData(filters), 30000);
+    let refreshes = 0;
+    const interval = setInterval(() => {
+      refreshes += 1;
+      loadData(filters, refreshes % FULL_REFRESH_EVERY !== 0);
+    }, 30000);
     return () => clearInterval(interval);
   }, [authReady, session, filters, selectedPeriod, selectedSite]);
 
@@ -19,6 +19,7 @@ import { useState, useMemo } from "react";
 import { Users } from "lucide-react";
 
 export interface Visitor {
+  id?: number;
   created_at: string;
   location: string;
   device_type: string;
@@ -36,6 +36,7 @@ for i in {1..50}; do
     -H "Content-Type: application/json" \
     -d "{
       \"sessionId\": \"$SESSION_ID\",
+      \"pageVisited\": \"/\",
       \"timeSpentSeconds\": 30
     }" > /dev/null 2>&1
   echo -n "."
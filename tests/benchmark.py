@@ -0,0 +1,363 @@
+"""Concurrent load generator / benchmark for the ingest and dashboard endpoints.
+
+Drives ``/track``, ``/log/time`` and ``/api/analytics`` at the same time, each
+with its own arrival rate (open loop: requests are issued on a Poisson
+schedule whether or not earlier ones finished, so a slow server shows up as
+latency instead of silently lowering the load).  Analytics requests draw
+their filters from ``extreme_test.generate_combinations`` so the mix matches
+what the dashboard really sends.
+
+Ingest traffic comes from ``--client-ips`` synthetic clients (sent as
+``X-Forwarded-For``, one fixed address per session) so the per-IP and
+per-session rate limits see a realistic spread instead of one host.  Start
+the backend with ``TRUSTED_PROXY_HOPS=1`` for the addresses to count, or
+raise ``RATE_LIMIT_*`` for a run that measures the server without the
+limiter.  ``--chatty-share`` sends part of the hits from a few very busy
+sessions to exercise the limiter on purpose.
+
+Run it against a backend that talks to a local Postgres, e.g.::
+
+    docker compose up -d db backend
+    python backend/seed.py            # or generate_data.py for big datasets
+    python tests/benchmark.py --duration 60 --track-rate 200 --analytics-rate 5
+
+Results (p50/p95/p99, histogram, throughput, errors and the share of 429/503
+rejections per endpoint) are printed and saved as JSON under
+``bench_results/``; pass ``--compare`` with an earlier file to see the
+change per endpoint.  Rejections are answered quickly, so latency figures
+from a run with many of them describe the limiter rather than the server.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import extreme_test
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15",
+    "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Mobile Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+]
+LOCATIONS = [
+    ("India", "IN", "Chennai", "Jio"), ("India", "IN", "Mumbai", "Airtel"),
+    ("United States", "US", "Austin", "Comcast"), ("Germany", "DE", "Berlin", "Deutsche Telekom"),
+    ("United Kingdom", "GB", "London", "Vodafone"),
+]
+PAGES = [
+    "https://rbg.iitm.ac.in/sanjaya/", "https://rbg.iitm.ac.in/sanjaya/reports",
+    "https://rbg.iitm.ac.in/fps/#/home", "https://rbg.iitm.ac.in/tpl/dashboard",
+    "https://rbg.iitm.ac.in/RATH/",
+]
+FALLBACK_META = {
+    "distinct_countries": ["India", "United States"],
+    "distinct_browsers": ["Chrome", "Firefox"],
+    "distinct_devices": ["Desktop", "Mobile"],
+}
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram (~2% relative precision) in milliseconds."""
+
+    def __init__(self, precision=0.02):
+        self.base = 1 + precision
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, ms):
+        index = int(math.log(max(ms, 0.01) / 0.01, self.base))
+        with self._lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def _upper(self, index):
+        return 0.01 * self.base ** (index + 1)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 2) if self.count else None,
+            "p50_ms": _round(self.percentile(50)),
+            "p95_ms": _round(self.percentile(95)),
+            "p99_ms": _round(self.percentile(99)),
+            "max_ms": _round(self.max) if self.count else None,
+            # upper bound (ms) → count, for plotting / comparing shapes
+            "histogram": {
+                f"{self._upper(i):.2f}": n for i, n in sorted(self.buckets.items())
+            },
+        }
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def poisson_schedule(rate, duration, rng):
+    """Arrival offsets (seconds) for a Poisson process of ``rate`` per second."""
+    times = []
+    if rate <= 0:
+        return times
+    t = rng.expovariate(rate)
+    while t < duration:
+        times.append(t)
+        t += rng.expovariate(rate)
+    return times
+
+
+class Workload:
+    """Builds requests for each scenario from a seeded RNG."""
+
+    def __init__(self, base_url, combos, rng, session_pool=2000, client_ips=1000, chatty_share=0.0):
+        self.base_url = base_url.rstrip("/")
+        self.combos = combos
+        self.rng = rng
+        self.chatty_share = chatty_share
+        self.sessions = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(session_pool)]
+        # 198.18.0.0/15 is reserved for benchmarks, so no real client is impersonated
+        ips = [f"198.{18 + i // 65536 % 2}.{i // 256 % 256}.{i % 256}" for i in range(client_ips)]
+        self.session_ips = {
+            session: ips[i % len(ips)] if ips else None for i, session in enumerate(self.sessions)
+        }
+
+    # Called from the dispatcher thread only, so the request sequence is a
+    # pure function of the seed.
+
+    def _session(self):
+        # a share of the hits from a few very chatty sessions (Pareto ranks)
+        if self.chatty_share and self.rng.random() < self.chatty_share:
+            return self.sessions[min(int(self.rng.paretovariate(1.2)) - 1, len(self.sessions) - 1)]
+        return self.rng.choice(self.sessions)
+
+    def _client_headers(self, session):
+        ip = self.session_ips[session]
+        return {"X-Forwarded-For": ip} if ip else {}
+
+    def track(self):
+        country, code, city, isp = self.rng.choice(LOCATIONS)
+        session = self._session()
+        body = {
+            "sessionId": session,
+            "userAgent": self.rng.choice(USER_AGENTS),
+            "country": country,
+            "countryCode": code,
+            "city": city,
+            "isp": isp,
+            "publicIp": self.session_ips[session]
+            or f"10.{self.rng.randrange(4)}.{self.rng.randrange(256)}.{self.rng.randrange(256)}",
+            "pageVisited": self.rng.choice(PAGES),
+            "timestamp": int(time.time() * 1000),
+        }
+        return "POST", f"{self.base_url}/track", body, self._client_headers(session)
+
+    def log_time(self):
+        session = self._session()
+        body = {
+            "sessionId": session,
+            "timeSpentSeconds": int(self.rng.lognormvariate(4, 1)),
+            "pageVisited": self.rng.choice(PAGES),
+        }
+        return "POST", f"{self.base_url}/log/time", body, self._client_headers(session)
+
+    def analytics(self):
+        params = dict(self.rng.choice(self.combos))
+        if params.get("period") == "custom":
+            params.pop("period")
+        query = urllib.parse.urlencode({k: v for k, v in params.items() if v is not None})
+        return "GET", f"{self.base_url}/api/analytics?{query}", None, {}
+
+
+def send(method, url, body, headers, timeout):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method,
+                                 headers={"Content-Type": "application/json",
+                                          "Accept-Encoding": "gzip", **headers})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    extreme_test.BASE_URL = f"{args.base_url.rstrip('/')}/api/analytics"
+    meta = extreme_test.get_meta() or FALLBACK_META
+    combos = extreme_test.generate_combinations(meta)
+    workload = Workload(args.base_url, combos, rng, session_pool=args.sessions,
+                        client_ips=args.client_ips, chatty_share=args.chatty_share)
+
+    scenarios = {
+        "track": (args.track_rate, workload.track),
+        "log_time": (args.log_rate, workload.log_time),
+        "analytics": (args.analytics_rate, workload.analytics),
+    }
+    schedule = sorted(
+        (offset, name)
+        for name, (rate, _) in scenarios.items()
+        for offset in poisson_schedule(rate, args.duration, rng)
+    )
+    latency = {name: LatencyHistogram() for name in scenarios}
+    service = {name: LatencyHistogram() for name in scenarios}
+    statuses = {name: {} for name in scenarios}
+    errors = {name: 0 for name in scenarios}
+    lock = threading.Lock()
+
+    def fire(name, scheduled_at, request):
+        started = time.perf_counter()
+        try:
+            status = send(*request, timeout=args.timeout)
+        except Exception:
+            status = "error"
+        done = time.perf_counter()
+        # latency counts from the *scheduled* start, so queueing behind a slow
+        # server is included (no coordinated omission)
+        latency[name].record((done - scheduled_at) * 1000)
+        service[name].record((done - started) * 1000)
+        with lock:
+            statuses[name][str(status)] = statuses[name].get(str(status), 0) + 1
+            if status == "error" or (isinstance(status, int) and status >= 400):
+                errors[name] += 1
+
+    print(f"Running {len(schedule)} requests over {args.duration}s "
+          f"({len(combos)} analytics filter combinations)...")
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for offset, name in schedule:
+            delay = t0 + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fire, name, t0 + offset, scenarios[name][1]())
+    elapsed = time.perf_counter() - t0
+
+    results = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "base_url": args.base_url,
+            "duration_s": args.duration,
+            "elapsed_s": round(elapsed, 2),
+            "seed": args.seed,
+            "workers": args.workers,
+            "sessions": args.sessions,
+            "client_ips": args.client_ips,
+            "chatty_share": args.chatty_share,
+            "git_commit": _git_commit(),
+        },
+        "scenarios": {},
+    }
+    for name, (rate, _) in scenarios.items():
+        summary = latency[name].summary()
+        results["scenarios"][name] = {
+            "target_rate": rate,
+            "throughput_rps": round(latency[name].count / elapsed, 2) if elapsed else 0,
+            "errors": errors[name],
+            "status_codes": statuses[name],
+            "rejected_pct": rejected_pct(statuses[name]),
+            "latency": summary,
+            "service_time": service[name].summary(),
+        }
+    return results
+
+
+def rejected_pct(status_codes):
+    """Share (%) of responses refused by the rate limiter (429) or load shedding (503)."""
+    total = sum(status_codes.values())
+    return {
+        code: round(100 * status_codes.get(code, 0) / total, 2) if total else 0.0
+        for code in ("429", "503")
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def print_report(results, baseline=None):
+    print(f"\n{'endpoint':<10} {'rps':>8} {'err':>6} {'429%':>6} {'503%':>6} "
+          f"{'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, r in results["scenarios"].items():
+        lat = r["latency"]
+        rejected = r.get("rejected_pct") or rejected_pct(r["status_codes"])
+        print(f"{name:<10} {r['throughput_rps']:>8} {r['errors']:>6} "
+              f"{rejected['429']:>6} {rejected['503']:>6} "
+              + " ".join(f"{(lat[k] if lat[k] is not None else '-'):>9}"
+                         for k in ("p50_ms", "p95_ms", "p99_ms", "max_ms")))
+        if baseline and name in baseline.get("scenarios", {}):
+            old = baseline["scenarios"][name]["latency"]
+            deltas = []
+            for k in ("p50_ms", "p95_ms", "p99_ms"):
+                if old.get(k) and lat.get(k):
+                    deltas.append(f"{k[:3]} {100 * (lat[k] - old[k]) / old[k]:+.1f}%")
+            if deltas:
+                print(f"{'':<10} vs baseline: {', '.join(deltas)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--base-url", default=os.environ.get("BENCH_BASE_URL", "http://localhost:5000"))
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load")
+    parser.add_argument("--track-rate", type=float, default=50, help="/track requests per second")
+    parser.add_argument("--log-rate", type=float, default=20, help="/log/time requests per second")
+    parser.add_argument("--analytics-rate", type=float, default=2, help="/api/analytics requests per second")
+    parser.add_argument("--workers", type=int, default=64, help="max concurrent requests")
+    parser.add_argument("--sessions", type=int, default=2000, help="distinct visitor sessions")
+    parser.add_argument("--client-ips", type=int, default=1000,
+                        help="synthetic client IPs sent as X-Forwarded-For (0: none, all hits from this host)")
+    parser.add_argument("--chatty-share", type=float, default=0.0,
+                        help="share of ingest hits from a few very busy sessions (exercises the limiter)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="result file (default: bench_results/bench-<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    output = args.output or os.path.join(
+        "bench_results", f"bench-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to: {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
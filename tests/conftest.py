@@ -0,0 +1,10 @@
+# The backend modules import each other as top-level modules (that's how
+# gunicorn runs them from backend/), so make that directory importable too.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+# /track starts the live counters' background flush; keep it from writing to
+# whatever fake connection a later test patches in
+os.environ.setdefault('LIVE_FLUSH_SECONDS', '3600')
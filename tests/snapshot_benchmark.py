@@ -0,0 +1,160 @@
+"""Benchmark the columnar snapshot engine against get_filtered_analytics_visual.
+
+Exports a snapshot of the database (or reuses ``--dir``), then runs the same
+sample of dashboard filter combinations (``extreme_test.generate_combinations``,
+resolved to dates the way /api/analytics does) through both engines, one
+after the other, and reports per-engine latency, the speed-up and how many
+payloads disagreed on the stats or chart totals.
+
+    python backend/generate_data.py     # a dataset worth measuring
+    python tests/snapshot_benchmark.py --queries 200
+
+Results are printed and saved as JSON under ``bench_results/``.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import extreme_test  # noqa: E402
+from benchmark import LatencyHistogram, _git_commit  # noqa: E402
+from snapshot import Snapshot, SnapshotStore, export_snapshot, get_db_connection  # noqa: E402
+
+SQL = """
+    SELECT get_filtered_analytics_visual(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)::text
+"""
+PERIOD_DAYS = {"day": 1, "week": 7, "month": 30}
+
+
+def resolve(combo, now):
+    """Filter combination → the 10 function arguments, as /api/analytics builds them."""
+    end_of_today = now.replace(hour=23, minute=59, second=59, microsecond=999999)
+    if combo.get("period") in PERIOD_DAYS:
+        start, end = now - datetime.timedelta(days=PERIOD_DAYS[combo["period"]]), end_of_today
+        granularity = "hour" if combo["period"] == "day" else "day"
+    else:
+        start = datetime.datetime.fromisoformat(combo["start_date_filter"]).replace(tzinfo=datetime.timezone.utc)
+        end = datetime.datetime.fromisoformat(combo["end_date_filter"]).replace(
+            hour=23, minute=59, second=59, microsecond=999999, tzinfo=datetime.timezone.utc)
+        granularity = "day"
+    return (
+        combo.get("country_filter"), start.isoformat(), end.isoformat(),
+        combo.get("visitor_type_filter"), combo.get("device_filter"), None,
+        combo.get("browser_filter"), None, None, granularity,
+    )
+
+
+def fingerprint(payload):
+    """What both engines must agree on: stats and the per-chart totals."""
+    charts = payload.get("charts") or {}
+    return {
+        "stats": {k: v for k, v in (payload.get("stats") or {}).items()},
+        "charts": {
+            name: sum(row.get("count", row.get("value", 0)) or 0 for row in series)
+            for name, series in charts.items() if name not in ("by_browser", "by_city", "by_page")
+        },
+    }
+
+
+def run(args):
+    directory = args.dir or tempfile.mkdtemp(prefix="analytics-snapshot-")
+    conn = get_db_connection()
+    export_seconds = None
+    try:
+        if not args.skip_export:
+            started = time.perf_counter()
+            export_snapshot(conn, directory)
+            export_seconds = round(time.perf_counter() - started, 3)
+        store = SnapshotStore(directory)
+        snapshot = store.current()
+        if snapshot is None:
+            raise SystemExit(f"no snapshot in {directory}")
+        snapshot = Snapshot(snapshot.path)
+
+        meta = snapshot.analytics()["meta"]
+        combos = extreme_test.generate_combinations({k: v or [] for k, v in meta.items()})
+        rng = random.Random(args.seed)
+        sample = rng.sample(combos, min(args.queries, len(combos)))
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        latency = {"sql": LatencyHistogram(), "snapshot": LatencyHistogram()}
+        mismatches = []
+        cur = conn.cursor()
+        for combo in sample:
+            params = resolve(combo, now)
+            started = time.perf_counter()
+            cur.execute(SQL, params)
+            sql_payload = json.loads(cur.fetchone()[0])
+            conn.rollback()
+            latency["sql"].record((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            snapshot_payload = json.loads(json.dumps(snapshot.analytics(*params)))
+            latency["snapshot"].record((time.perf_counter() - started) * 1000)
+
+            if fingerprint(sql_payload) != fingerprint(snapshot_payload):
+                mismatches.append(combo)
+    finally:
+        conn.close()
+
+    size = sum(
+        os.path.getsize(os.path.join(snapshot.path, name)) for name in os.listdir(snapshot.path)
+    )
+    return {
+        "commit": _git_commit(),
+        "started_at": now.isoformat(),
+        "queries": len(sample),
+        "rows": snapshot.rows,
+        "snapshot_bytes": size,
+        "export_seconds": export_seconds,
+        "engines": {name: hist.summary() for name, hist in latency.items()},
+        # snapshots lag the database, so a few can differ on a busy server
+        "mismatches": len(mismatches),
+        "mismatch_samples": mismatches[:5],
+    }
+
+
+def print_report(results):
+    exported = f", exported in {results['export_seconds']}s" if results["export_seconds"] else ""
+    print(f"\n{results['queries']} queries over {results['rows']} rows "
+          f"(snapshot {results['snapshot_bytes'] / 2**20:.1f} MiB{exported})")
+    print(f"{'engine':<10} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, lat in results["engines"].items():
+        print(f"{name:<10} " + " ".join(
+            f"{(lat[k] if lat[k] is not None else '-'):>9}"
+            for k in ("mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms")))
+    sql, snap = results["engines"]["sql"], results["engines"]["snapshot"]
+    if sql["p50_ms"] and snap["p50_ms"]:
+        print(f"speed-up: p50 {sql['p50_ms'] / snap['p50_ms']:.1f}x, p95 {sql['p95_ms'] / snap['p95_ms']:.1f}x")
+    print(f"payload mismatches: {results['mismatches']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--dir", help="snapshot directory (default: a new temporary one)")
+    parser.add_argument("--skip-export", action="store_true", help="use the snapshot already in --dir")
+    parser.add_argument("--queries", type=int, default=100, help="filter combinations to run")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="result file (default: bench_results/snapshot-<time>.json)")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_report(results)
+
+    output = args.output or os.path.join(
+        "bench_results", f"snapshot-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to: {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
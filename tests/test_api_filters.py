@@ -14,8 +14,9 @@ class DummyCursor:
         self.last_params = params
 
     def fetchone(self):
-        # return a minimal structure so the view can proceed
-        return {'data': {'stats': {'total_visitors': 1}}}
+        # return a minimal structure so the view can proceed; the payload
+        # comes back from Postgres as JSON text
+        return {'data': '{"stats": {"total_visitors": 1}}'}
 
 
 class DummyConn:
@@ -30,7 +31,7 @@ def test_site_filter_overrides_url_filter(monkeypatch, caplog):
     """Ensure the `/api/analytics` handler resolves site_filter correctly."""
     monkeypatch.setattr(app, 'get_db_connection', lambda: DummyConn())
     caplog.set_level('INFO')
-    client = app.test_client()
+    client = app.app.test_client()
 
     response = client.get('/api/analytics', query_string={'site_filter': 'tpl'})
     assert response.status_code == 200
@@ -45,7 +46,7 @@ def test_manual_url_filter_when_all(monkeypatch, caplog):
     """A custom url_filter should pass through when site_filter is 'all'."""
     monkeypatch.setattr(app, 'get_db_connection', lambda: DummyConn())
     caplog.set_level('INFO')
-    client = app.test_client()
+    client = app.app.test_client()
 
     response = client.get('/api/analytics', query_string={'site_filter': 'all', 'url_filter': 'foo'})
     assert response.status_code == 200
@@ -53,3 +54,68 @@ def test_manual_url_filter_when_all(monkeypatch, caplog):
     logs = caplog.text
     assert "Resolved site_filter='all' to site_url='None'" in logs
     assert "URL filter: foo" in logs
+
+
+def test_payload_passes_through_and_columnar_is_done_in_sql(monkeypatch):
+    cursors = []
+
+    class RecordingConn(DummyConn):
+        def cursor(self, cursor_factory=None):
+            cursors.append(DummyCursor())
+            return cursors[-1]
+
+    monkeypatch.setattr(app, 'get_db_connection', lambda: RecordingConn())
+    client = app.app.test_client()
+
+    response = client.get('/api/analytics', query_string={'period': 'week'})
+    assert response.get_data(as_text=True) == '{"stats": {"total_visitors": 1}}'
+    assert 'analytics_columnar' not in cursors[-1].last_sql
+
+    client.get('/api/analytics', query_string={'format': 'columnar'})
+    assert 'analytics_columnar' in cursors[-1].last_sql
+
+
+def test_ip_filter_accepts_cidr_ranges(monkeypatch):
+    cursors = []
+
+    class RecordingConn(DummyConn):
+        def cursor(self, cursor_factory=None):
+            cursors.append(DummyCursor())
+            return cursors[-1]
+
+    monkeypatch.setattr(app, 'get_db_connection', lambda: RecordingConn())
+    client = app.app.test_client()
+
+    client.get('/api/analytics', query_string={'ip_filter': '203.0.113.77/24'})
+    assert cursors[-1].last_params[7] == '203.0.113.0/24'
+    client.get('/api/analytics', query_string={'ip_filter': '2001:db8::1'})
+    assert cursors[-1].last_params[7] == '2001:db8::1/128'
+
+    response = client.get('/api/analytics', query_string={'ip_filter': 'office'})
+    assert response.status_code == 400
+
+
+def test_since_requests_a_delta(monkeypatch):
+    cursors = []
+
+    class RecordingConn(DummyConn):
+        def cursor(self, cursor_factory=None):
+            cursors.append(DummyCursor())
+            return cursors[-1]
+
+    monkeypatch.setattr(app, 'get_db_connection', lambda: RecordingConn())
+    client = app.app.test_client()
+
+    client.get('/api/analytics', query_string={'since': '1234', 'period': 'day'})
+    assert 'get_analytics_delta' in cursors[-1].last_sql
+    assert cursors[-1].last_params[0] == 1234
+    assert cursors[-1].last_params[-1] == 'hour'
+
+    client.get('/api/analytics', query_string={'period': 'day'})
+    assert 'get_analytics_delta' not in cursors[-1].last_sql
+
+    assert client.get('/api/analytics', query_string={'since': 'latest'}).status_code == 400
+
+    # an empty watermark is a full fetch, not a delta from ''
+    client.get('/api/analytics', query_string={'since': '', 'period': 'day'})
+    assert 'get_analytics_delta' not in cursors[-1].last_sql
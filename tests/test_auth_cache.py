@@ -0,0 +1,120 @@
+# Token verification caches, with locally generated keys and a stub cert endpoint
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt as pyjwt
+import pytest
+import rsa
+from google.auth import crypt
+from google.auth import jwt as google_jwt
+
+from backend import auth_config
+from backend.auth_config import CachingRequest, TokenCache, decode_app_token, verify_gcp_token
+
+
+@pytest.fixture(scope="module")
+def keypair():
+    public, private = rsa.newkeys(1024)
+    return public.save_pkcs1().decode(), private.save_pkcs1().decode()
+
+
+@pytest.fixture
+def cert_server(keypair):
+    public_pem, _ = keypair
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.hits += 1
+            body = json.dumps({"test-key": public_pem}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", "public, max-age=3600")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.hits = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_id_token(private_pem, **overrides):
+    now = int(time.time())
+    claims = {
+        "iss": "https://accounts.google.com",
+        "aud": auth_config.GCP_CLIENT_ID,
+        "sub": "123",
+        "email": "someone@example.org",
+        "iat": now,
+        "exp": now + 600,
+    }
+    claims.update(overrides)
+    signer = crypt.RSASigner.from_string(private_pem, key_id="test-key")
+    return google_jwt.encode(signer, claims).decode()
+
+
+def test_gcp_verification_reuses_certs_and_results(keypair, cert_server):
+    _, private_pem = keypair
+    certs_url = f"http://127.0.0.1:{cert_server.server_address[1]}/certs"
+    request = CachingRequest()
+
+    first = make_id_token(private_pem, sub="a")
+    second = make_id_token(private_pem, sub="b")
+    assert verify_gcp_token(first, request=request, certs_url=certs_url)["sub"] == "a"
+    assert verify_gcp_token(second, request=request, certs_url=certs_url)["sub"] == "b"
+    # second token verified against the cached certificate response
+    assert cert_server.hits == 1
+
+    # a cached token is answered without touching the transport at all
+    assert verify_gcp_token(first, request=None, certs_url="http://invalid.test")["sub"] == "a"
+
+
+def test_gcp_rejects_wrong_issuer(keypair, cert_server):
+    _, private_pem = keypair
+    certs_url = f"http://127.0.0.1:{cert_server.server_address[1]}/certs"
+    token = make_id_token(private_pem, iss="https://evil.example")
+    assert verify_gcp_token(token, request=CachingRequest(), certs_url=certs_url) is None
+
+
+def test_cert_cache_honours_max_age(cert_server):
+    clock = [0.0]
+    request = CachingRequest(clock=lambda: clock[0])
+    url = f"http://127.0.0.1:{cert_server.server_address[1]}/certs"
+    request(url)
+    request(url)
+    assert cert_server.hits == 1
+    clock[0] = 3601
+    request(url)
+    assert cert_server.hits == 2
+
+
+def test_token_cache_expires_with_token():
+    clock = [100.0]
+    cache = TokenCache(clock=lambda: clock[0])
+    cache.put("tok", {"exp": 150})
+    assert cache.get("tok") == {"exp": 150}
+    clock[0] = 150
+    assert cache.get("tok") is None
+    cache.put("no-exp", {"sub": "x"})
+    assert cache.get("no-exp") is None
+
+
+def test_app_token_decode_still_rejects_expired():
+    token = pyjwt.encode({"sub": "x", "exp": time.time() + 60},
+                         auth_config.JWT_SECRET_KEY, algorithm="HS256")
+    assert decode_app_token(token)["sub"] == "x"
+    assert decode_app_token(token)["sub"] == "x"
+
+    expired = pyjwt.encode({"sub": "x", "exp": time.time() - 1},
+                           auth_config.JWT_SECRET_KEY, algorithm="HS256")
+    with pytest.raises(pyjwt.ExpiredSignatureError):
+        decode_app_token(expired)
@@ -0,0 +1,57 @@
+# Pieces of the load-test harness that don't need a running server
+
+import random
+
+from benchmark import LatencyHistogram, Workload, poisson_schedule, rejected_pct
+
+
+def test_histogram_percentiles_within_precision():
+    hist = LatencyHistogram(precision=0.02)
+    for ms in range(1, 1001):
+        hist.record(float(ms))
+    summary = hist.summary()
+    assert summary["count"] == 1000
+    for p, expected in ((50, 500), (95, 950), (99, 990)):
+        assert abs(hist.percentile(p) - expected) / expected <= 0.021
+    assert summary["max_ms"] == 1000
+    assert sum(summary["histogram"].values()) == 1000
+
+
+def test_schedule_is_seeded_and_hits_rate():
+    first = poisson_schedule(100, 20, random.Random(1))
+    assert first == poisson_schedule(100, 20, random.Random(1))
+    assert 1800 < len(first) < 2200
+    assert all(0 <= t < 20 for t in first)
+    assert poisson_schedule(0, 20, random.Random(1)) == []
+
+
+def test_workload_requests_are_deterministic():
+    combos = [{"period": "custom", "start_date_filter": "2024-01-01", "country_filter": None}]
+
+    def build(seed):
+        w = Workload("http://localhost:5000/", combos, random.Random(seed))
+        return [w.log_time(), w.analytics()]
+
+    assert build(3) == build(3)
+    method, url, body, headers = build(3)[1]
+    assert method == "GET" and body is None and headers == {}
+    assert url == "http://localhost:5000/api/analytics?start_date_filter=2024-01-01"
+
+
+def test_ingest_is_spread_over_sessions_and_ips():
+    w = Workload("http://localhost:5000", [], random.Random(5), session_pool=500, client_ips=100)
+    hits = [w.track() for _ in range(2000)]
+    sessions = {body["sessionId"] for _, _, body, _ in hits}
+    ips = {headers["X-Forwarded-For"] for _, _, _, headers in hits}
+    assert len(sessions) > 400 and len(ips) == 100
+    # a session always comes from the same address
+    for _, _, body, headers in hits:
+        assert body["publicIp"] == headers["X-Forwarded-For"] == w.session_ips[body["sessionId"]]
+
+    local = Workload("http://localhost:5000", [], random.Random(5), client_ips=0)
+    assert local.log_time()[3] == {}
+
+
+def test_rejected_share():
+    assert rejected_pct({"200": 90, "429": 8, "503": 2}) == {"429": 8.0, "503": 2.0}
+    assert rejected_pct({}) == {"429": 0.0, "503": 0.0}
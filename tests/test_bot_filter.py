@@ -0,0 +1,99 @@
+# Bot classification at ingest and the bot_hits counter
+
+from datetime import date
+
+from prometheus_client import REGISTRY
+
+from backend import app
+from backend.bot_filter import BotClassifier, BotCounter, parse_networks
+
+FIREFOX = "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0"
+GOOGLEBOT = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+UPTIME = "Mozilla/5.0+(compatible; UptimeRobot/2.0; http://www.uptimerobot.com/)"
+
+
+def test_classifies_by_user_agent_pattern_and_ip_range():
+    classifier = BotClassifier(networks=parse_networks(["66.249.64.0/19  # crawler", "", "2001:db8::/32"]))
+
+    info, reason = classifier.classify(FIREFOX, "10.0.0.1")
+    assert reason is None
+    assert (info.device_type, info.browser, info.operating_system) == ("Desktop", "Firefox", "Linux")
+
+    assert classifier.classify(GOOGLEBOT, "10.0.0.1")[1] == "user_agent"
+    assert classifier.classify("python-requests/2.31", None)[1] == "pattern"
+    assert classifier.classify(FIREFOX, "66.249.66.1")[1] == "ip_range"
+    assert classifier.classify(FIREFOX, "2001:db8::1")[1] == "ip_range"
+    assert classifier.classify(FIREFOX, "not-an-ip")[1] is None
+    assert classifier.classify(FIREFOX, None, "10.0.0.1", "66.249.66.1")[1] == "ip_range"
+
+
+def test_user_agent_parse_is_cached(monkeypatch):
+    classifier = BotClassifier()
+    calls = []
+    parse = classifier._parse_user_agent
+    monkeypatch.setattr(classifier, "_parse_user_agent", lambda ua: calls.append(ua) or parse(ua))
+
+    for _ in range(5):
+        classifier.classify(UPTIME, None)
+    assert calls == [UPTIME]
+
+
+class CounterCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, params):
+        day, reason, hits = params
+        self.rows[(day, reason)] = self.rows.get((day, reason), 0) + hits
+
+
+class CounterConn:
+    def __init__(self):
+        self.rows = {}
+
+    def cursor(self):
+        return CounterCursor(self.rows)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_counter_batches_hits_per_day_and_reason():
+    conn = CounterConn()
+    counter = BotCounter(lambda: conn, flush_seconds=3600, clock=lambda: 1_717_243_200.0)
+    for reason in ("user_agent", "user_agent", "pattern"):
+        counter.record(reason)
+
+    assert counter.flush() == 2
+    assert conn.rows == {(date(2024, 6, 1), "user_agent"): 2, (date(2024, 6, 1), "pattern"): 1}
+    assert counter.flush() == 0
+
+
+def test_track_diverts_bots_before_any_database_write(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(app, "get_db_connection", lambda: (_ for _ in ()).throw(AssertionError("db write")))
+    monkeypatch.setattr(app.bot_counter, "record", recorded.append)
+    before = REGISTRY.get_sample_value("ingest_bot_hits_total", {"reason": "user_agent", "action": "count"}) or 0
+
+    resp = app.app.test_client().post("/track", json={"sessionId": "s1", "userAgent": GOOGLEBOT})
+
+    assert resp.status_code == 202
+    assert recorded == ["user_agent"]
+    assert REGISTRY.get_sample_value("ingest_bot_hits_total", {"reason": "user_agent", "action": "count"}) == before + 1
+
+
+def test_track_checks_the_connection_address_without_public_ip(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(app, "bot_classifier", BotClassifier(networks=parse_networks(["66.249.64.0/19"])))
+    monkeypatch.setattr(app, "get_db_connection", lambda: (_ for _ in ()).throw(AssertionError("db write")))
+    monkeypatch.setattr(app.bot_counter, "record", recorded.append)
+    client = app.app.test_client()
+
+    for body in ({"sessionId": "s1", "userAgent": FIREFOX},
+                 {"sessionId": "s2", "userAgent": FIREFOX, "publicIp": "203.0.113.9"}):
+        resp = client.post("/track", json=body, environ_base={"REMOTE_ADDR": "66.249.66.1"})
+        assert resp.status_code == 202
+    assert recorded == ["ip_range", "ip_range"]
@@ -0,0 +1,104 @@
+# page_views → visitors compactor: watermark handling and batching
+
+from datetime import datetime, timedelta, timezone
+
+from backend.compactor import COMPACT_SQL, SessionCompactor
+
+T0 = datetime(2025, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class ScriptedCursor:
+    """Answers the compactor's queries from a small in-memory state."""
+
+    def __init__(self, db):
+        self.db = db
+        self._row = None
+
+    def execute(self, sql, params=None):
+        self.db.executed.append((sql, params))
+        if 'FOR UPDATE SKIP LOCKED' in sql:
+            self._row = None if self.db.locked else (self.db.watermark, self.db.now - timedelta(seconds=params[0]))
+        elif 'MIN(received_at)' in sql:
+            self._row = (self.db.first_event,)
+        elif sql is COMPACT_SQL:
+            self.db.windows.append((params['lower'], params['upper']))
+            self._row = (3, 2, 1, None)
+        elif 'UPDATE public.compactor_state' in sql:
+            self.db.pending_watermark = params[0]
+
+    def fetchone(self):
+        return self._row
+
+
+class FakeDB:
+    def __init__(self, watermark=None, first_event=None, now=T0, locked=False):
+        self.watermark = watermark
+        self.first_event = first_event
+        self.now = now
+        self.locked = locked
+        self.executed = []
+        self.windows = []
+        self.pending_watermark = None
+        self.commits = 0
+
+    def cursor(self):
+        return ScriptedCursor(self)
+
+    def commit(self):
+        self.commits += 1
+        if self.pending_watermark is not None:
+            self.watermark = self.pending_watermark
+
+    def rollback(self):
+        self.pending_watermark = None
+
+    def close(self):
+        pass
+
+
+def compactor(db, **kwargs):
+    calls = []
+    kwargs.setdefault('settle_seconds', 2)
+    kwargs.setdefault('overlap_seconds', 30)
+    c = SessionCompactor(lambda: db, on_compacted=lambda *a: calls.append(a), **kwargs)
+    return c, calls
+
+
+def test_pass_rereads_overlap_and_advances_to_settled_cutoff():
+    db = FakeDB(watermark=T0 - timedelta(minutes=1))
+    c, calls = compactor(db)
+
+    assert c.compact() == 'done'
+    assert db.windows == [(T0 - timedelta(seconds=90), T0 - timedelta(seconds=2))]
+    assert db.watermark == T0 - timedelta(seconds=2)
+    assert calls == [(3, 2, 1)]
+
+
+def test_backlog_is_processed_in_batches():
+    db = FakeDB(first_event=T0 - timedelta(hours=2, minutes=30))
+    c, _ = compactor(db, batch_seconds=3600)
+
+    results = [c.compact() for _ in range(3)]
+
+    assert results == ['partial', 'partial', 'done']
+    assert db.watermark == T0 - timedelta(seconds=2)
+    assert db.commits == 3
+
+
+def test_empty_log_and_busy_lock_do_nothing():
+    empty = FakeDB()
+    c, calls = compactor(empty)
+    assert c.compact() == 'done'
+    assert empty.windows == [] and calls == []
+
+    busy = FakeDB(watermark=T0 - timedelta(minutes=1), locked=True)
+    c, calls = compactor(busy)
+    assert c.compact() == 'busy'
+    assert busy.windows == [] and calls == []
+
+
+def test_overlap_rereads_leave_unchanged_rows_alone():
+    upsert = COMPACT_SQL.split('upserted AS')[1].split('timed AS')[0]
+    timed = COMPACT_SQL.split('timed AS')[1].split('changed AS')[0]
+    assert 'IS DISTINCT FROM' in upsert.split('DO UPDATE')[1]
+    assert 'v.time_spent_seconds IS DISTINCT FROM s.time_spent_seconds' in timed
@@ -0,0 +1,36 @@
+# Accept-Encoding negotiation and after_request compression
+
+import gzip
+import json
+
+import brotli
+from flask import Flask, Response, request
+
+from backend.compression import compress_response, negotiate
+
+
+def test_negotiate_respects_quality():
+    assert negotiate("gzip, deflate, br") == "br"
+    assert negotiate("gzip;q=1.0, br;q=0.5") == "gzip"
+    assert negotiate("br;q=0, gzip") == "gzip"
+    assert negotiate("*") == "br"
+    assert negotiate("identity") is None
+    assert negotiate("") is None
+
+
+def test_large_json_is_compressed_small_is_not():
+    app = Flask(__name__)
+    payload = json.dumps({"visitor_list": [{"page": "/x"}] * 500})
+
+    with app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+        resp = compress_response(Response(payload, mimetype="application/json"), request)
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in resp.headers["Vary"]
+        assert gzip.decompress(resp.get_data()).decode() == payload
+
+        small = compress_response(Response("{}", mimetype="application/json"), request)
+        assert "Content-Encoding" not in small.headers
+
+    with app.test_request_context("/", headers={"Accept-Encoding": "br"}):
+        resp = compress_response(Response(payload, mimetype="application/json"), request)
+        assert brotli.decompress(resp.get_data()).decode() == payload
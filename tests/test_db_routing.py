@@ -0,0 +1,127 @@
+# Read-replica routing: round-robin, connect failures, lag fallback
+
+from backend import app
+from backend.db_routing import ReplicaSet, parse_hosts
+
+
+DOWN = object()
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class LagCursor:
+    def __init__(self, lag):
+        self.lag = lag
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return (self.lag,)
+
+
+class FakeConn:
+    def __init__(self, host, lag):
+        self.host = host
+        self.lag = lag
+        self.closed = False
+
+    def cursor(self, cursor_factory=None):
+        return LagCursor(self.lag)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServers:
+    """host → replay lag in seconds (None when unknown), or DOWN."""
+
+    def __init__(self, **lags):
+        self.lags = lags
+        self.connects = []
+
+    def __call__(self, host, port, connect_timeout=None, **params):
+        self.connects.append(host)
+        if self.lags[host] is DOWN:
+            raise OSError(f"could not connect to {host}")
+        return FakeConn(host, self.lags[host])
+
+
+def replica_set(servers, clock, **kwargs):
+    return ReplicaSet([{'host': h, 'port': '5432'} for h in servers.lags],
+                      connect=servers, clock=clock, **kwargs)
+
+
+def test_parse_hosts():
+    assert parse_hosts(" r1:5433, r2 ,") == [("r1", "5433"), ("r2", "5432")]
+    assert parse_hosts(None) == []
+
+
+def test_round_robin_over_healthy_replicas():
+    servers = FakeServers(r1=0.0, r2=0.5)
+    replicas = replica_set(servers, FakeClock())
+
+    hosts = [replicas.connection().host for _ in range(4)]
+    assert hosts == ["r1", "r2", "r1", "r2"]
+
+
+def test_down_replica_is_skipped_until_retry():
+    clock = FakeClock()
+    servers = FakeServers(r1=DOWN, r2=0.0)
+    replicas = replica_set(servers, clock, retry_seconds=30)
+
+    assert [replicas.connection().host for _ in range(3)] == ["r2"] * 3
+    assert servers.connects.count("r1") == 1
+
+    servers.lags["r1"] = 0.0
+    clock.now += 31
+    assert {replicas.connection().host for _ in range(2)} == {"r1", "r2"}
+
+
+def test_lagging_replicas_fall_back_to_primary(monkeypatch):
+    servers = FakeServers(r1=120.0)
+    replicas = replica_set(servers, FakeClock(), max_lag_seconds=30)
+
+    assert replicas.connection() is None
+    assert replicas.status()[0]["lag_seconds"] == 120.0
+    assert replicas.status()[0]["available"] is False
+
+    primary = object()
+    monkeypatch.setattr(app, "read_replicas", replicas)
+    monkeypatch.setattr(app, "get_db_connection", lambda: primary)
+    assert app.get_read_connection() is primary
+
+
+def test_lag_is_rechecked_only_every_check_interval():
+    clock = FakeClock()
+    servers = FakeServers(r1=0.0)
+    replicas = replica_set(servers, clock, check_seconds=10, max_lag_seconds=30)
+
+    assert replicas.connection() is not None
+    servers.lags["r1"] = 300.0
+    # still within the check interval: handed out without probing
+    assert replicas.connection() is not None
+    clock.now += 11
+    assert replicas.connection() is None
+
+
+def test_replica_without_streaming_receiver_is_stale():
+    # receive and replay positions are equal, but nothing arrives any more
+    clock = FakeClock()
+    servers = FakeServers(r1=None)
+    replicas = replica_set(servers, clock, check_seconds=10)
+
+    assert replicas.connection() is None
+    assert replicas.status()[0]["error"] == "WAL receiver not streaming"
+    servers.lags["r1"] = 0.0
+    clock.now += 11
+    assert replicas.connection() is not None
@@ -0,0 +1,121 @@
+# Dictionary-encoded dimensions: the key cache and how /track uses it
+
+from backend import app
+from backend.dimensions import DIMENSIONS, ENCODE_BATCH_SQL, KEY_VALUES, DimensionCache, backfill
+
+FIREFOX = "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0"
+
+
+def test_cache_is_a_bounded_lru():
+    cache = DimensionCache(max_entries=2)
+    cache.put("city", "Paris", 1)
+    cache.put("city", "Lyon", 2)
+    assert cache.get("city", "Paris") == 1  # now most recent
+    cache.put("city", "Nice", 3)
+
+    assert len(cache) == 2
+    assert cache.get("city", "Lyon") is None
+    assert cache.get("city", "Paris") == 1
+    # the same label in another dimension is another key
+    assert cache.get("isp", "Paris") is None
+
+
+def test_params_pair_cached_keys_with_values():
+    cache = DimensionCache()
+    cache.put("country", "France", 7)
+    params = cache.params({"country": "France", "city": "Paris"})
+
+    assert KEY_VALUES.count("%s") == len(params) == 2 * len(DIMENSIONS)
+    assert params[:4] == [7, "France", None, "Paris"]
+    assert params[4:] == [None] * (len(params) - 4)
+
+
+def test_remember_skips_missing_values_and_keys():
+    cache = DimensionCache()
+    cache.remember({"country": "France", "city": None, "isp": "Orange"}, (7, None, None, 4, 5, 6, 8))
+
+    assert len(cache) == 1
+    assert cache.get("country", "France") == 7
+
+
+class KeyCursor:
+    def __init__(self, log):
+        self.log = log
+
+    def execute(self, sql, params=None):
+        self.log.append(list(params))
+
+    def fetchone(self):
+        return (7, 8, 9, 10, 11, 12, 13)
+
+
+class KeyConn:
+    def __init__(self, log):
+        self.log = log
+
+    def cursor(self, cursor_factory=None):
+        return KeyCursor(self.log)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_track_caches_keys_returned_by_the_insert(monkeypatch):
+    log = []
+    monkeypatch.setattr(app, "get_db_connection", lambda: KeyConn(log))
+    monkeypatch.setattr(app.compactor, "ensure_running", lambda: None)
+    monkeypatch.setattr(app, "dimension_keys", DimensionCache())
+    body = {"sessionId": "s-dim", "userAgent": FIREFOX, "country": "France", "city": "Paris", "isp": "Orange"}
+    client = app.app.test_client()
+
+    assert client.post("/track", json=body).status_code == 201
+    assert client.post("/track", json=body).status_code == 201
+
+    first, second = (params[6:] for params in log)
+    assert first[:6] == [None, "France", None, "Paris", None, "Orange"]
+    assert second[:6] == [7, "France", 8, "Paris", 9, "Orange"]
+    assert second[-2:] == [13, FIREFOX]
+
+
+class BackfillCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        if sql == ENCODE_BATCH_SQL:
+            self.conn.batches.append((params['lower'], params['upper']))
+            self.rowcount = 3
+        else:
+            self.conn.bounds_sql = sql
+
+    def fetchone(self):
+        return self.conn.bounds
+
+
+class BackfillConn:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.batches = []
+        self.commits = 0
+
+    def cursor(self):
+        return BackfillCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_backfill_encodes_in_committed_id_ranges():
+    conn = BackfillConn((4, 14))
+    assert backfill(conn, batch_size=5, pause=0, log=lambda message: None) == 9
+    assert conn.batches == [(4, 9), (9, 14), (14, 19)]
+    # the bounds lookup and every batch end their transaction
+    assert conn.commits == 4
+    assert "user_agent IS NOT NULL" in conn.bounds_sql
+
+    done = BackfillConn((None, None))
+    assert backfill(done, pause=0) == 0 and done.batches == []
@@ -0,0 +1,68 @@
+# Synthetic data generator: determinism and distribution shape
+
+import datetime
+from collections import Counter
+
+from backend.generate_data import (
+    COPY_COLUMNS, LOAD_COLUMNS, Generator, RowStream, chunk_plan, copy_lines, encode_rows, vocabulary,
+)
+
+
+def make_generator(seed=1):
+    return Generator(seed, datetime.date(2023, 1, 1), datetime.date(2025, 1, 1),
+                     distinct_ips=50_000, distinct_pages=500)
+
+
+def test_chunks_are_deterministic_and_independent():
+    a, b = make_generator(), make_generator()
+    assert list(a.rows(3, 200)) == list(b.rows(3, 200))
+    assert list(a.rows(3, 50)) != list(a.rows(4, 50))
+    assert list(make_generator(2).rows(3, 50)) != list(a.rows(3, 50))
+
+
+def test_chunk_plan_covers_all_rows():
+    plan = chunk_plan(250_001, chunk_rows=100_000)
+    assert plan == [(0, 100_000), (1, 100_000), (2, 50_001)]
+    assert sum(count for _, count in plan) == 250_001
+
+
+def test_distributions_are_skewed_and_diurnal():
+    rows = list(make_generator().rows(0, 20_000))
+    assert len(rows[0]) == len(COPY_COLUMNS)
+
+    ips = Counter(r[1] for r in rows)
+    # Zipf: the hottest IP recurs a lot, most IPs show up once
+    assert ips.most_common(1)[0][1] > 100
+    assert sum(1 for c in ips.values() if c == 1) > len(ips) / 2
+
+    hours = Counter(r[11].hour for r in rows)
+    assert hours[6] > 3 * hours[19]
+
+    first_seen = [r[11] for r in rows]
+    assert min(first_seen).year == 2023 and max(first_seen).year == 2024
+    assert len({r[0] for r in rows}) == len(rows)  # session ids stay unique
+
+
+def test_copy_stream_escapes_and_marks_nulls():
+    row = ("id", "1.2.3.4", "a\tb", None)
+    stream = RowStream(copy_lines(iter([row, row])))
+    data = b""
+    while chunk := stream.read(5):
+        data += chunk
+    assert data == b"id\t1.2.3.4\ta\\tb\t\\N\n" * 2
+
+
+def test_rows_load_as_dimension_keys():
+    keys = {pair: k for k, pair in enumerate(vocabulary(), start=1)}
+    rows = list(make_generator().rows(0, 2_000))
+    # the vocabulary covers every value the generator emits
+    for row in encode_rows(rows, keys):
+        assert len(row) == len(LOAD_COLUMNS)
+        for column, value in zip(LOAD_COLUMNS, row):
+            if column not in COPY_COLUMNS:
+                assert isinstance(value, int), column
+
+    encoded = next(encode_rows(rows[:1], keys))
+    country = LOAD_COLUMNS.index('country_id')
+    assert LOAD_COLUMNS[country - 1] == 'public_ip' and 'country' not in LOAD_COLUMNS
+    assert encoded[country] == keys[('country', rows[0][COPY_COLUMNS.index('country')])]
@@ -0,0 +1,119 @@
+# Local IP → geo range index, lookup cache, hot reload and /track enrichment
+
+import os
+
+from backend import app
+from backend.geoip import GeoDatabase, GeoRecord, RangeIndex
+
+FIREFOX = "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0"
+
+RANGES_CSV = """start_ip,end_ip,country_code,country,city,isp
+1.0.0.0,1.0.0.255,AU,Australia,Sydney,Cloudflare
+16777472,16777727,CN,China,Fuzhou,
+2001:db8::,2001:db8::ffff,DE,Germany,Berlin,Example
+"""
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def write(path, text, mtime):
+    path.write_text(text)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_csv_ranges_are_binary_searched(tmp_path):
+    path = tmp_path / "geo.csv"
+    path.write_text(RANGES_CSV)
+    index = RangeIndex.from_csv(str(path))
+
+    assert len(index) == 3
+    assert index.lookup("1.0.0.0") == GeoRecord("AU", "Australia", "Sydney", "Cloudflare")
+    assert index.lookup("1.0.0.255").city == "Sydney"
+    assert index.lookup("1.0.1.9") == GeoRecord("CN", "China", "Fuzhou", None)  # integer bounds
+    assert index.lookup("::ffff:1.0.0.7").country_code == "AU"
+    assert index.lookup("2001:db8::42").country == "Germany"
+    assert index.lookup("1.0.2.0") is None
+    assert index.lookup("0.255.255.255") is None
+    assert index.lookup("not-an-ip") is None
+
+
+def test_network_column_and_maxmind_names(tmp_path):
+    path = tmp_path / "blocks.csv"
+    path.write_text("network,country_iso_code,country_name,city_name,autonomous_system_organization\n"
+                    "10.0.0.0/8,FR,France,Paris,Orange\n"
+                    "192.168.0.0/16,FR,France,Paris,Orange\n")
+    index = RangeIndex.from_csv(str(path))
+
+    assert index.lookup("10.20.30.40") == index.lookup("192.168.1.1") == GeoRecord("FR", "France", "Paris", "Orange")
+    # identical records are stored once
+    assert len(index._records) == 1
+
+
+def test_lookups_are_cached_and_reloaded_when_the_file_changes(tmp_path):
+    path = tmp_path / "geo.csv"
+    write(path, RANGES_CSV, 1_000_000_000)
+    loads = []
+
+    def load(p):
+        loads.append(p)
+        return RangeIndex.from_csv(p)
+
+    clock = FakeClock()
+    geo = GeoDatabase(str(path), check_seconds=60, load=load, clock=clock)
+    assert geo.lookup("1.0.0.1").city == "Sydney"
+    assert geo.lookup("1.0.0.1").city == "Sydney"
+    assert geo.status()["cached"] == 1
+    assert len(loads) == 1
+
+    write(path, RANGES_CSV.replace("Sydney", "Melbourne"), 2_000_000_000)
+    assert geo.lookup("1.0.0.1").city == "Sydney"  # not checked yet
+    clock.now += 61
+    geo.lookup("1.0.0.1")
+    geo._reloader.join()
+    assert geo.lookup("1.0.0.1").city == "Melbourne"
+    assert len(loads) == 2
+
+    # a broken file keeps the previous index
+    write(path, "garbage\n", 3_000_000_000)
+    assert not geo.reload()
+    assert geo.lookup("1.0.0.1").city == "Melbourne"
+
+
+def test_track_takes_geo_fields_from_the_database(tmp_path, monkeypatch):
+    path = tmp_path / "geo.csv"
+    path.write_text(RANGES_CSV)
+    inserts = []
+
+    class Cursor:
+        def execute(self, sql, params=None):
+            inserts.append(params)
+
+        def fetchone(self):
+            return (None,) * 7
+
+    class Conn:
+        def cursor(self, cursor_factory=None):
+            return Cursor()
+
+        def commit(self):
+            pass
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(app, "geo_db", GeoDatabase(str(path)))
+    monkeypatch.setattr(app, "get_db_connection", lambda: Conn())
+    monkeypatch.setattr(app.compactor, "ensure_running", lambda: None)
+    body = {"sessionId": "s-geo", "userAgent": FIREFOX, "publicIp": "1.0.0.9",
+            "country": "Narnia", "countryCode": "NA", "city": "Cair Paravel"}
+
+    assert app.app.test_client().post("/track", json=body).status_code == 201
+    params = inserts[0]
+    assert params[2] == "AU"  # country_code
+    assert [params[7], params[9], params[11]] == ["Australia", "Sydney", "Cloudflare"]
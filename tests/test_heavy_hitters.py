@@ -0,0 +1,160 @@
+# Space-Saving summaries: accuracy bounds, merging and serialisation
+
+import random
+from collections import Counter
+
+from backend import app
+from backend.heavy_hitters import SketchBuffer, SpaceSaving, bucket_start
+
+
+def zipf_stream(n, distinct, seed=7):
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(distinct)]
+    return rng.choices([f"/page/{i}" for i in range(distinct)], weights, k=n)
+
+
+def assert_within_bounds(sketch, truth):
+    bound = sketch.total / sketch.capacity
+    for item, count, error in sketch.top(sketch.capacity):
+        assert truth[item] <= count <= truth[item] + error
+        assert error <= bound
+    # anything more frequent than N/k must be tracked
+    for item, true_count in truth.items():
+        if true_count > bound:
+            assert item in sketch.counters
+
+
+def test_exact_below_capacity():
+    sketch = SpaceSaving(capacity=10)
+    for item in ["a", "b", "a", "c", "a", "b"]:
+        sketch.offer(item)
+    assert sketch.top(2) == [("a", 3, 0), ("b", 2, 0)]
+
+
+def test_error_bound_on_skewed_stream():
+    stream = zipf_stream(20_000, 2_000)
+    sketch = SpaceSaving(capacity=50)
+    for item in stream:
+        sketch.offer(item)
+    truth = Counter(stream)
+    assert_within_bounds(sketch, truth)
+    assert sketch.top(1)[0][0] == truth.most_common(1)[0][0]
+
+
+def test_merge_keeps_bound():
+    left, right = zipf_stream(10_000, 1_000, seed=1), zipf_stream(10_000, 1_000, seed=2)
+    a, b = SpaceSaving(capacity=40), SpaceSaving(capacity=40)
+    for item in left:
+        a.offer(item)
+    for item in right:
+        b.offer(item)
+    merged = a.merge(b)
+    assert merged.total == 20_000
+    assert len(merged.counters) <= 40
+    assert_within_bounds(merged, Counter(left + right))
+
+
+def test_round_trip_and_bucketing():
+    sketch = SpaceSaving(capacity=5)
+    sketch.offer("x", 4)
+    restored = SpaceSaving.from_dict(sketch.to_dict())
+    assert restored.top(1) == [("x", 4, 0)] and restored.total == 4
+    assert bucket_start(3600 * 5 + 59).timestamp() == 3600 * 5
+
+
+class BucketCursor:
+    """sketch_buckets as a dict: key → sketch document."""
+
+    def __init__(self, table, log):
+        self.table = table
+        self.log = log
+        self.row = None
+
+    def execute(self, sql, params):
+        statement = sql.split()[0]
+        if statement == 'INSERT':
+            kind, dimension, bucket, sketch = params
+            self.table.setdefault((kind, dimension, bucket), sketch.adapted)
+        elif statement == 'SELECT':
+            self.log.append(params[1])
+            self.row = (self.table[params],)
+        else:
+            sketch, *key = params
+            self.table[tuple(key)] = sketch.adapted
+
+    def fetchone(self):
+        return self.row
+
+
+class BucketConn:
+    def __init__(self, table, log):
+        self.table, self.log = table, log
+
+    def cursor(self):
+        return BucketCursor(self.table, self.log)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_flushes_of_a_new_bucket_from_two_workers_add_up():
+    table, log = {}, []
+    workers = [
+        SketchBuffer(lambda: BucketConn(table, log), SpaceSaving, 'top_k',
+                     clock=lambda: 7200.0, background=False)
+        for _ in range(2)
+    ]
+    workers[0].record({'page': '/a', 'city': 'Pune'})
+    workers[1].record({'page': '/a'}, n=2)
+    assert [worker.flush() for worker in workers] == [2, 1]
+
+    stored = SpaceSaving.from_dict(table[('top_k', 'page', bucket_start(7200))])
+    assert stored.top(1) == [('/a', 3, 0)] and stored.total == 3
+    # rows are locked in key order
+    assert log == ['city', 'page', 'page']
+
+
+class TopCursor:
+    def __init__(self, queries):
+        self.queries = queries
+
+    def execute(self, sql, params):
+        self.queries.append(params)
+
+    def fetchall(self):
+        sketch = SpaceSaving()
+        sketch.offer("/a", 3)
+        return [{"sketch": sketch.to_dict()}]
+
+
+class TopConn:
+    def __init__(self, queries):
+        self.queries = queries
+
+    def cursor(self, cursor_factory=None):
+        return TopCursor(self.queries)
+
+    def close(self):
+        pass
+
+
+def test_top_endpoint_parses_dates(monkeypatch):
+    queries = []
+    monkeypatch.setattr(app, "get_read_connection", lambda: TopConn(queries))
+    client = app.app.test_client()
+
+    body = client.get("/api/top", query_string={
+        "start_date_filter": "2024-01-01", "end_date_filter": "2024-01-31",
+    }).get_json()
+    assert body["items"] == [{"value": "/a", "count": 3, "error": 0}]
+    _, _, start, _, _, end, _ = queries[-1]
+    assert start == "2024-01-01T00:00:00+00:00"
+    assert end == "2024-01-31T23:59:59.999999+00:00"
+
+    resp = client.get("/api/top", query_string={"start_date_filter": "yesterday-ish"})
+    assert resp.status_code == 400
+    assert "start_date_filter" in resp.get_json()["error"]
+    assert len(queries) == 1
@@ -0,0 +1,195 @@
+# Sliding-window behaviour of the live visitor counters
+
+import json
+import re
+from collections import Counter
+
+from backend import app
+from backend.live_stats import LiveStats
+
+
+class FakeClock:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_windows_count_distinct_sessions():
+    clock = FakeClock()
+    stats = LiveStats(clock=clock)
+
+    stats.record("a", "/old", "India")
+    clock.now += 10 * 60
+    stats.record("b", "/mid", "India")
+    stats.record("b", "/mid", "India")
+    clock.now += 4 * 60
+    stats.record("c", "/new", "France")
+
+    snap = stats.snapshot()
+    assert snap["active_sessions"] == {"1m": 1, "5m": 2, "30m": 3}
+    assert snap["top_pages"][0] == {"page_visited": "/mid", "count": 2}
+    assert snap["top_countries"][0] == {"country": "India", "count": 3}
+
+
+def test_old_buckets_expire():
+    clock = FakeClock()
+    stats = LiveStats(clock=clock)
+    stats.record("a", "/", "India")
+
+    clock.now += 31 * 60
+    snap = stats.snapshot()
+    assert snap["active_sessions"] == {"1m": 0, "5m": 0, "30m": 0}
+    assert snap["top_pages"] == []
+
+
+def test_publish_reaches_every_subscriber():
+    stats = LiveStats(clock=FakeClock())
+    stats.record("a", "/", "India")
+    # every listener gets the same precomputed message
+    queues = [stats.subscribe() for _ in range(3)]
+    stats.publish()
+    for q in queues:
+        assert json.loads(q.get_nowait())["active_sessions"]["1m"] == 1
+        stats.unsubscribe(q)
+
+
+class LiveStore:
+    """public.live_sessions / public.live_hits in memory."""
+
+    def __init__(self):
+        self.sessions = set()
+        self.hits = Counter()
+        self.fail = False
+
+    def connect(self):
+        if self.fail:
+            raise ConnectionError("database down")
+        return LiveConn(self)
+
+
+class LiveConn:
+    def __init__(self, store):
+        self.store = store
+
+    def cursor(self):
+        return LiveCursor(self.store)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LiveCursor:
+    def __init__(self, store):
+        self.store = store
+        self.rows = []
+
+    def execute(self, sql, params):
+        store = self.store
+        if "INTO public.live_sessions" in sql:
+            store.sessions.update(zip(*params))
+        elif "INTO public.live_hits" in sql:
+            for minute, kind, value, n in zip(*params):
+                store.hits[(minute, kind, value)] += n
+        elif sql.startswith("DELETE"):
+            store.sessions = {row for row in store.sessions if row[0] >= params[0]}
+        elif "COUNT(DISTINCT" in sql:
+            windows = [int(w) for w in re.findall(r"%\(minute\)s - (\d+)\)", sql)]
+            self.rows = [tuple(
+                len({s for m, s in store.sessions if m > params["minute"] - w}) for w in windows
+            )]
+        else:
+            kind, minute, horizon, limit = params
+            totals = Counter()
+            for (m, k, value), n in store.hits.items():
+                if k == kind and m > minute - horizon:
+                    totals[value] += n
+            self.rows = sorted(totals.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_workers_share_their_counters():
+    clock, store = FakeClock(), LiveStore()
+    workers = [LiveStats(clock=clock, connect=store.connect) for _ in range(2)]
+    workers[0].record("a", "/home", "India")
+    workers[1].record("b", "/home", "France")
+    workers[1].record("a", "/about", "India")
+    clock.now += 4 * 60
+    workers[0].record("c", "/home", "India")
+    assert [worker.flush() for worker in workers] == [2, 1]
+
+    # both workers broadcast the same, merged numbers
+    snaps = [json.loads(worker.publish()) for worker in workers]
+    assert [worker.latest() for worker in workers] == snaps
+    assert snaps[0]["active_sessions"] == snaps[1]["active_sessions"] == {"1m": 1, "5m": 3, "30m": 3}
+    assert snaps[1]["top_pages"] == [
+        {"page_visited": "/home", "count": 3}, {"page_visited": "/about", "count": 1},
+    ]
+    assert snaps[0]["top_countries"][0] == {"country": "India", "count": 3}
+
+
+def test_failed_flush_keeps_the_deltas():
+    clock, store = FakeClock(), LiveStore()
+    stats = LiveStats(clock=clock, connect=store.connect)
+    stats.record("a", "/", "India")
+    store.fail = True
+    try:
+        stats.flush()
+    except ConnectionError:
+        pass
+    stats.record("b", "/", "India")
+    store.fail = False
+
+    assert stats.flush() == 1
+    assert stats.snapshot()["active_sessions"]["1m"] == 2
+    assert store.hits[(int(clock.now // 60), "page", "/")] == 2
+
+
+def test_polls_are_served_from_memory():
+    clock, store = FakeClock(), LiveStore()
+    workers = [LiveStats(clock=clock, connect=store.connect) for _ in range(2)]
+    workers[0].record("a", "/home", "India")
+    workers[1].record("b", "/home", "France")
+    store.fail = True
+    # nothing merged yet: this worker's own hits, without a query
+    assert workers[0].latest()["active_sessions"]["1m"] == 1
+
+    store.fail = False
+    workers[1].flush()
+    workers[0].flush()
+    store.fail = True
+    assert workers[0].latest()["active_sessions"]["1m"] == 2
+
+    # the merged snapshot goes stale; the worker's own counters take over
+    clock.now += 2 * workers[0].flush_seconds + 1
+    assert workers[0].latest()["active_sessions"]["1m"] == 1
+
+
+def test_streams_are_capped_per_worker(monkeypatch):
+    stats = LiveStats(clock=FakeClock(), max_streams=1)
+    monkeypatch.setattr(app, "live_stats", stats)
+    client = app.app.test_client()
+
+    held = stats.subscribe()
+    response = client.get("/api/live/stream")
+    assert response.status_code == 503 and response.headers["Retry-After"]
+
+    stats.unsubscribe(held)
+    response = client.get("/api/live/stream", buffered=False)
+    assert response.status_code == 200
+    assert next(response.response).startswith(b"event: snapshot")
+    response.close()
+    # closing the response frees the slot
+    assert stats.subscribe() is not None
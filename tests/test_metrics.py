@@ -0,0 +1,96 @@
+# /metrics: request instrumentation, ingest counters, multi-worker aggregation
+
+import os
+import subprocess
+import sys
+
+from prometheus_client import REGISTRY
+
+from backend import app
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class InsertCursor:
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return (None,) * 7
+
+
+class InsertConn:
+    def cursor(self, cursor_factory=None):
+        return InsertCursor()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_requests_are_counted_per_route():
+    client = app.app.test_client()
+    labels = {'method': 'GET', 'route': '/api/sites', 'status': '200'}
+    before = sample('http_requests_total', **labels)
+
+    client.get('/api/sites')
+    client.get('/no/such/api/route')
+    body = client.get('/metrics').get_data(as_text=True)
+
+    assert sample('http_requests_total', **labels) == before + 1
+    assert 'http_request_duration_seconds_bucket{le="0.005",method="GET",route="/api/sites"}' in body
+    assert 'worker_resident_memory_bytes' in body
+    # unknown paths share the catch-all rule rather than one series per URL
+    assert '/no/such/api/route' not in body
+
+
+def test_ingest_counts_appended_events(monkeypatch):
+    client = app.app.test_client()
+    rows = sample('ingest_rows_total', table='page_views', operation='insert')
+    timed = sample('db_statement_duration_seconds_count', statement='track_insert')
+    monkeypatch.setattr(app, 'get_db_connection', lambda: InsertConn())
+    monkeypatch.setattr(app.compactor, 'ensure_running', lambda: None)
+
+    for _ in range(3):
+        resp = client.post('/track', json={'sessionId': 's1', 'userAgent': 'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0'})
+        assert resp.status_code == 201
+    client.post('/log/time', json={'sessionId': 's1', 'timeSpentSeconds': 30})
+
+    assert sample('ingest_rows_total', table='page_views', operation='insert') == rows + 4
+    assert sample('db_statement_duration_seconds_count', statement='track_insert') == timed + 3
+
+
+def test_compaction_counts_upsert_conflicts():
+    rows = sample('ingest_rows_total', table='visitors', operation='compact')
+    conflicts = sample('ingest_upsert_conflicts_total', table='visitors')
+
+    app._record_compaction(inserted=4, updated=6, timed=1)
+
+    assert sample('ingest_rows_total', table='visitors', operation='compact') == rows + 11
+    assert sample('ingest_upsert_conflicts_total', table='visitors') == conflicts + 6
+
+
+def test_multiprocess_values_are_summed_across_workers(tmp_path):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    worker = (
+        "import metrics\n"
+        "metrics.INGEST_ROWS.labels('visitors', 'upsert').inc({n})\n"
+        "metrics.observe_upstream('fps', 0.3, 'ok')\n"
+    )
+    for n in (2, 5):
+        subprocess.run([sys.executable, '-c', worker.format(n=n)],
+                       cwd=BACKEND_DIR, env=env, check=True)
+
+    scrape = subprocess.run(
+        [sys.executable, '-c', "import metrics; print(metrics.render()[0].decode())"],
+        cwd=BACKEND_DIR, env=env, check=True, capture_output=True, text=True,
+    ).stdout
+
+    assert 'ingest_rows_total{operation="upsert",table="visitors"} 7.0' in scrape
+    assert 'upstream_request_duration_seconds_count{app="fps",outcome="ok"} 2.0' in scrape
@@ -0,0 +1,70 @@
+# Migration runner: checksum bookkeeping and advisory locking
+
+from backend.migrations import MIGRATION_LOCK_KEY, MIGRATIONS, apply_migrations, pending_migrations
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        self.db.statements.append((sql.strip(), params))
+        if sql.strip().startswith("SELECT name, checksum"):
+            self._rows = list(self.db.applied.items())
+        elif "INSERT INTO public.schema_migrations" in sql:
+            self.db.applied[params[0]] = params[1]
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConn:
+    def __init__(self, applied=None):
+        self.applied = dict(applied or {})
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def write_assets(tmp_path, **assets):
+    for name, sql in assets.items():
+        (tmp_path / name).write_text(sql)
+    return tuple(assets)
+
+
+def test_only_new_or_changed_assets_run(tmp_path):
+    names = write_assets(tmp_path, **{"a.sql": "SELECT 1;", "b.sql": "SELECT 2;"})
+    conn = FakeConn()
+    assert apply_migrations(conn, tmp_path, names, log=lambda m: None) == ["a.sql", "b.sql"]
+
+    # second run: nothing to do
+    assert apply_migrations(conn, tmp_path, names, log=lambda m: None) == []
+
+    (tmp_path / "b.sql").write_text("SELECT 3;")
+    assert [n for n, _ in pending_migrations(conn.applied, tmp_path, names)] == ["b.sql"]
+    assert apply_migrations(conn, tmp_path, names, log=lambda m: None) == ["b.sql"]
+
+
+def test_runs_under_advisory_lock(tmp_path):
+    names = write_assets(tmp_path, **{"a.sql": "SELECT 1;"})
+    conn = FakeConn()
+    apply_migrations(conn, tmp_path, names, log=lambda m: None)
+    sql = [s for s, _ in conn.statements]
+    assert sql[0].startswith("SELECT pg_advisory_lock")
+    assert sql[-1].startswith("SELECT pg_advisory_unlock")
+    assert conn.statements[0][1] == (MIGRATION_LOCK_KEY,)
+    assert "SELECT 1;" in sql
+
+
+def test_shipped_assets_exist():
+    # every registered asset must be present in backend/
+    assert pending_migrations({})  # raises if any file is missing
+    assert MIGRATIONS[0] == "table.sql"
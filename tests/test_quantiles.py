@@ -0,0 +1,154 @@
+# DDSketch time-on-page percentiles: accuracy, merging, removal and the API
+
+import random
+
+from backend import app
+from backend.quantiles import DDSketch, record_session_times, site_for_page, time_scopes
+
+SITES = {'tpl': {'name': 'TPL', 'url': 'https://example.org/tpl/'}}
+
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def sketch_of(values):
+    sketch = DDSketch()
+    for value in values:
+        sketch.offer(value)
+    return sketch
+
+
+def test_quantiles_within_relative_accuracy():
+    rng = random.Random(3)
+    # heavy-tailed like real time on page, with the 86400s clamp
+    values = [min(int(rng.lognormvariate(3, 1.5)) + 1, 86400) for _ in range(20_000)]
+    sketch = sketch_of(values)
+    assert sketch.count == len(values)
+    for q in (0.5, 0.9, 0.99):
+        exact = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+
+
+def test_merge_matches_single_sketch():
+    rng = random.Random(5)
+    left = [rng.randint(1, 600) for _ in range(3_000)]
+    right = [rng.randint(1, 6_000) for _ in range(3_000)]
+    merged = sketch_of(left).merge(sketch_of(right))
+    whole = sketch_of(left + right)
+    assert merged.bins == whole.bins
+    assert merged.summary() == whole.summary()
+
+
+def test_negative_counts_remove_values():
+    sketch = sketch_of([10, 20, 30])
+    sketch.offer(30, -1)
+    sketch.offer(300)
+    assert sketch.count == 3
+    assert sketch.quantile(1.0) == sketch_of([10, 20, 300]).quantile(1.0)
+    sketch.offer(0)
+    sketch.offer(0, -1)
+    assert sketch.zero_count == 0
+
+
+def test_empty_and_zero_values():
+    assert DDSketch().summary() == {'count': 0, 'p50': None, 'p90': None, 'p99': None}
+    sketch = sketch_of([0, 0, 0, 50])
+    assert sketch.quantile(0.5) == 0.0
+    assert abs(sketch.quantile(1.0) - 50) <= 0.5
+
+
+def test_round_trip_and_bin_limit():
+    sketch = DDSketch(max_bins=16)
+    for value in range(1, 2_000):
+        sketch.offer(value)
+    assert len(sketch.bins) <= 16
+    assert sketch.count == 1_999
+    restored = DDSketch.from_dict(sketch.to_dict())
+    assert restored.bins == sketch.bins and restored.max_bins == 16
+    # collapsing only costs accuracy at the low end
+    assert abs(restored.quantile(0.99) - 1_979) <= 0.01 * 1_979
+
+
+def test_scopes():
+    assert site_for_page('https://EXAMPLE.org/tpl/home', SITES) == 'tpl'
+    assert site_for_page('https://example.org/other', SITES) is None
+    assert time_scopes(None, SITES) == ['all']
+    assert time_scopes('https://example.org/tpl/a', SITES) == [
+        'all', 'page:https://example.org/tpl/a', 'site:tpl',
+    ]
+
+
+class RecordingBuffer:
+    def __init__(self):
+        self.calls = []
+
+    def record(self, values, n=1, at=None):
+        self.calls.append((values, n, at))
+
+
+def test_session_changes_swap_old_value_for_new():
+    buffer = RecordingBuffer()
+    record_session_times(buffer, [
+        # new session with no time yet, a session whose time grew, and one
+        # that moved to another page
+        [None, None, None, None, '/a', 100.0],
+        [5, '/a', 100.0, 42, '/a', 100.0],
+        [42, 'https://example.org/tpl/x', 200.0, 60, '/b', 200.0],
+    ], SITES)
+    assert buffer.calls == [
+        ({'all': 5, 'page:/a': 5}, -1, 100.0),
+        ({'all': 42, 'page:/a': 42}, 1, 100.0),
+        ({'all': 42, 'page:https://example.org/tpl/x': 42, 'site:tpl': 42}, -1, 200.0),
+        ({'all': 60, 'page:/b': 60}, 1, 200.0),
+    ]
+
+
+class SketchCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, sql, params=None):
+        self.queries.append(params)
+
+    def fetchall(self):
+        # kind, dimension, ... – answer exact and prefix lookups alike
+        match = self.queries[-1][1]
+        return [r for r in self.rows if r['dimension'].startswith(match)]
+
+
+class SketchConn:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, cursor_factory=None):
+        return SketchCursor(self.rows)
+
+    def close(self):
+        pass
+
+
+def test_time_on_page_endpoint(monkeypatch):
+    rows = [
+        {'dimension': 'all', 'sketch': sketch_of([10, 20, 30]).to_dict()},
+        {'dimension': 'all', 'sketch': sketch_of([40]).to_dict()},
+        {'dimension': 'page:/a', 'sketch': sketch_of([10, 20, 30]).to_dict()},
+        {'dimension': 'page:/b', 'sketch': sketch_of([40]).to_dict()},
+    ]
+    monkeypatch.setattr(app, 'get_read_connection', lambda: SketchConn(rows))
+    client = app.app.test_client()
+
+    body = client.get('/api/time-on-page', query_string={'by': 'page', 'limit': 1}).get_json()
+    assert body['scope'] == 'all' and body['count'] == 4
+    assert body['relative_accuracy'] == 0.01
+    assert [item['value'] for item in body['items']] == ['/a']
+    assert body['items'][0]['count'] == 3
+
+    body = client.get('/api/time-on-page', query_string={'page': '/b'}).get_json()
+    assert body['scope'] == 'page:/b' and body['count'] == 1 and 'items' not in body
+    assert abs(body['p50'] - 40) <= 0.4
+
+    assert client.get('/api/time-on-page', query_string={'by': 'city'}).status_code == 400
+    assert client.get('/api/time-on-page', query_string={'end_date_filter': '31/31/2024'}).status_code == 400
@@ -0,0 +1,92 @@
+# Token buckets, adaptive load shedding and the 429/503 responses
+
+from backend import app
+from backend.rate_limit import LoadShedder, TokenBuckets
+
+FIREFOX = "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0"
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_then_refills_at_rate():
+    clock = FakeClock()
+    buckets = TokenBuckets(rate=2, burst=3, clock=clock)
+
+    assert [buckets.take("a")[0] for _ in range(4)] == [True, True, True, False]
+    allowed, retry_after = buckets.take("a")
+    assert not allowed and retry_after == 0.5
+    # other keys have their own bucket
+    assert buckets.take("b")[0]
+
+    clock.now += 0.5
+    assert buckets.take("a")[0]
+    assert not buckets.take("a")[0]
+
+
+def test_buckets_are_bounded_and_idle_ones_expire():
+    clock = FakeClock()
+    buckets = TokenBuckets(rate=1, burst=5, max_entries=3, clock=clock)
+    for key in "abcd":
+        buckets.take(key)
+    assert len(buckets) == 3
+
+    clock.now += 10  # every bucket is full again
+    buckets.take("e")
+    assert len(buckets) == 1
+
+
+def test_shedder_backs_off_when_slow_and_recovers_when_fast():
+    clock = FakeClock()
+    shedder = LoadShedder(max_in_flight=10, min_in_flight=2, target_seconds=0.1,
+                          backoff_seconds=1.0, smoothing=1.0, clock=clock)
+
+    slots = [shedder.try_acquire() for _ in range(10)]
+    assert shedder.try_acquire() is None
+
+    for slot in slots:
+        clock.now += 0.5  # each completion is slow
+        shedder.release(slot)
+    assert shedder.limit < 10
+    assert shedder.retry_after() == 5  # last completion took 5s
+
+    for _ in range(200):
+        shedder.release(shedder.try_acquire())  # instant
+    assert shedder.limit == 10
+
+
+def test_track_returns_429_and_503_with_retry_after(monkeypatch):
+    client = app.app.test_client()
+    monkeypatch.setattr(app, "session_buckets", TokenBuckets(rate=0.1, burst=1))
+    monkeypatch.setattr(app, "db_shedder", LoadShedder(max_in_flight=0, min_in_flight=0))
+    body = {"sessionId": "s-1", "userAgent": FIREFOX}
+
+    resp = client.post("/track", json=body)
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+
+    resp = client.post("/track", json=body)
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "10"
+    assert resp.get_json()["retry_after"] == 10
+
+
+def test_spoofed_forwarded_for_does_not_get_a_new_bucket(monkeypatch):
+    client = app.app.test_client()
+    monkeypatch.setattr(app, "TRUSTED_PROXY_HOPS", 1)
+    monkeypatch.setattr(app, "ip_buckets", TokenBuckets(rate=0.1, burst=1))
+    monkeypatch.setattr(app, "db_shedder", LoadShedder(max_in_flight=0, min_in_flight=0))
+
+    def track(forwarded, session):
+        # the proxy appends the real client (198.51.100.7) to whatever it was sent
+        return client.post("/track", json={"sessionId": session, "userAgent": FIREFOX},
+                           headers={"X-Forwarded-For": f"{forwarded}, 198.51.100.7"})
+
+    assert track("10.0.0.1", "s-1").status_code == 503  # past the limiter
+    assert track("10.0.0.2", "s-2").status_code == 429
+    assert track("10.0.0.3", "s-3").status_code == 429
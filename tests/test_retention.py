@@ -0,0 +1,64 @@
+# Retention horizon, expired partitions and the batched roll-up loop
+
+from datetime import datetime, timezone
+
+from backend import retention
+
+
+def test_horizon_is_midnight_utc():
+    now = datetime(2024, 6, 15, 17, 30, tzinfo=timezone.utc)
+    assert retention.horizon_for(90, now) == datetime(2024, 3, 17, tzinfo=timezone.utc)
+
+
+def test_only_partitions_entirely_before_horizon_expire():
+    names = ["page_views_y2024m01", "page_views_y2023m12", "page_views_y2024m02",
+             "page_views_y2024m03", "page_views_default"]
+    horizon = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    assert retention.expired_partitions(names, horizon) == ["page_views_y2023m12", "page_views_y2024m01",
+                                                            "page_views_y2024m02"]
+    # December rolls over into the next year
+    assert retention.expired_partitions(["page_views_y2023m12"], datetime(2023, 12, 31, tzinfo=timezone.utc)) == []
+
+
+class BatchCursor:
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.calls = []
+        self.moved = 0
+
+    def execute(self, sql, params):
+        self.calls.append(params)
+        self.moved = min(self.remaining, params["batch"])
+        self.remaining -= self.moved
+
+    def fetchone(self):
+        return (self.moved,)
+
+
+class BatchConn:
+    def __init__(self, remaining):
+        self.cur = BatchCursor(remaining)
+        self.commits = 0
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_roll_up_commits_each_batch_until_short_batch():
+    conn = BatchConn(remaining=25)
+    horizon = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    moved = retention.roll_up_visitors(conn, horizon, batch_size=10, pause=0, log=lambda msg: None)
+
+    assert moved == 25
+    assert len(conn.cur.calls) == 3
+    assert conn.commits == 3
+    assert all(call == {"horizon": horizon, "batch": 10} for call in conn.cur.calls)
+
+
+def test_roll_up_with_nothing_to_move_is_one_statement():
+    conn = BatchConn(remaining=0)
+    assert retention.roll_up_visitors(conn, datetime.now(timezone.utc), batch_size=10, pause=0) == 0
+    assert conn.commits == 1
@@ -0,0 +1,228 @@
+# Per-site shards: routing, pooling, payload merging and the sharded API paths
+
+import json
+
+from backend import app
+from backend.dimensions import DimensionCache
+from backend.shards import (
+    DEFAULT_SHARD, ConnectionPool, ShardRouter, columnar, merge_payloads, shard_dsns,
+)
+
+FIREFOX = 'Mozilla/5.0 (X11; Linux x86_64; rv:126.0) Gecko/20100101 Firefox/126.0'
+
+SITES = {
+    'all': {'name': 'All', 'url': None},
+    'tpl': {'name': 'TPL', 'url': 'https://example.org/tpl', 'shard': 'tpl'},
+    'fps': {'name': 'FPS', 'url': 'https://example.org/fps', 'shard': 'fps'},
+}
+
+
+class FakeConn:
+    def __init__(self, name, payload=None, log=None, ip_visits=None):
+        self.name = name
+        self.payload = payload
+        self.ip_visits = ip_visits or {}
+        self.log = log if log is not None else []
+        self.closed = 0
+        self.rollbacks = 0
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        self.conn.log.append((self.conn.name, sql, params))
+
+    def fetchone(self):
+        if 'INSERT INTO public.page_views' in self.conn.log[-1][1]:
+            return (None,) * 7
+        return {'data': json.dumps(self.conn.payload)}
+
+    def fetchall(self):
+        # public.ip_visit_counts()
+        return list(self.conn.ip_visits.items())
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connection(self):
+        return self.conn
+
+    def status(self):
+        return {'idle': 0, 'in_use': 0}
+
+
+def test_dsns_come_from_the_site_shards():
+    environ = {'SHARD_DSN_TPL': 'dbname=tpl', 'SHARD_DSN_OTHER': 'dbname=x'}
+    assert shard_dsns(SITES, environ) == {'tpl': 'dbname=tpl'}
+
+
+def test_routing_falls_back_to_default():
+    router = ShardRouter(lambda: 'main', pools={'tpl': FakePool('tpl')}, sites=SITES)
+    assert router.sharded and router.names == [DEFAULT_SHARD, 'tpl']
+    assert router.for_site('tpl') == 'tpl'
+    # fps has no database of its own
+    assert router.for_site('fps') == DEFAULT_SHARD
+    assert router.for_page('https://EXAMPLE.org/tpl/home') == 'tpl'
+    assert router.for_page('https://elsewhere.org/') == DEFAULT_SHARD
+    assert router.connect(DEFAULT_SHARD) == 'main'
+
+    assert router.for_time_report('https://example.org/tpl/x') == 'tpl'
+    assert router.for_time_report(site_id='tpl') == 'tpl'
+    # a bare session id could belong to any shard
+    assert router.for_time_report() is None
+    assert ShardRouter(lambda: 'main', sites=SITES).for_time_report() == DEFAULT_SHARD
+
+
+def test_pool_reuses_and_discards_connections():
+    opened = []
+
+    def connect(dsn):
+        opened.append(FakeConn(dsn))
+        return opened[-1]
+
+    pool = ConnectionPool('dbname=tpl', max_idle=1, connect=connect)
+    a, b = pool.connection(), pool.connection()
+    assert pool.status() == {'idle': 0, 'in_use': 2}
+    a.close()
+    b.close()
+    # one kept (rolled back), one closed beyond max_idle
+    assert pool.status() == {'idle': 1, 'in_use': 0}
+    assert opened[0].rollbacks == 1 and opened[1].closed
+    c = pool.connection()
+    assert c._conn is opened[0] and len(opened) == 2
+    opened[0].closed = 2  # broken while in use
+    c.close()
+    assert pool.status() == {'idle': 0, 'in_use': 0}
+
+
+def payload(total, unique, time_total, time_count, visitors, pages, dates, ips):
+    return {
+        'stats': {
+            'total_visitors': total, 'unique_visitors': unique,
+            'repeated_visitors': total - unique, 'time_total': time_total, 'time_count': time_count,
+            'avg_time_on_page': round(time_total / time_count) if time_count else 0,
+        },
+        'watermark': 99,
+        'visitor_list': visitors,
+        'charts': {
+            'by_page': [{'page_visited': p, 'count': c} for p, c in pages],
+            'by_date': [{'date': d, 'count': c, 'unique_visitors': 1, 'returning_visitors': c - 1} for d, c in dates],
+        },
+        'meta': {'distinct_ips': ips},
+    }
+
+
+def test_merge_payloads():
+    main = payload(10, 4, 100, 5, [{'id': 1, 'first_seen': '2025-06-01T10:00:00+00:00'}],
+                   [('/a', 6), ('/b', 4)], [('2025-06-02', 4), ('2025-06-01', 6)], ['10.0.0.1'])
+    tpl = payload(5, 5, 50, 5, [{'id': 1, 'first_seen': '2025-06-01T11:00:00+00:00'},
+                                {'id': 2, 'first_seen': None}],
+                  [('/b', 3), ('/c', 1)], [('2025-06-01', 5)], ['10.0.0.1', '10.0.0.2'])
+
+    merged = merge_payloads({DEFAULT_SHARD: main, 'tpl': tpl, 'fps': None})
+    assert merged['stats'] == {
+        'total_visitors': 15, 'unique_visitors': 9, 'repeated_visitors': 6,
+        'time_total': 150, 'time_count': 10, 'avg_time_on_page': 15,
+    }
+    assert merged['watermark'] is None
+    assert [(v['shard'], v['id']) for v in merged['visitor_list']] == [
+        ('tpl', 2), ('tpl', 1), (DEFAULT_SHARD, 1),
+    ]
+    assert merged['charts']['by_page'] == [
+        {'page_visited': '/b', 'count': 7}, {'page_visited': '/a', 'count': 6},
+        {'page_visited': '/c', 'count': 1},
+    ]
+    assert merged['charts']['by_date'] == [
+        {'date': '2025-06-01', 'count': 11, 'unique_visitors': 2, 'returning_visitors': 9},
+        {'date': '2025-06-02', 'count': 4, 'unique_visitors': 1, 'returning_visitors': 3},
+    ]
+    assert merged['meta'] == {'distinct_ips': ['10.0.0.1', '10.0.0.2']}
+    assert merged['merged']['shards'] == [DEFAULT_SHARD, 'tpl']
+    assert 'charts.*.unique_visitors' in merged['merged']['approximate']
+    assert columnar(merged)['charts']['by_page'] == {'page_visited': ['/b', '/a', '/c'], 'count': [7, 6, 1]}
+
+
+def test_addresses_on_several_shards_count_once():
+    main = dict(payload(3, 2, 0, 0, [], [], [], []), shared_ips=['10.0.0.1'])
+    tpl = dict(payload(2, 2, 0, 0, [], [], [], []), shared_ips=['10.0.0.1'])
+    fps = dict(payload(1, 1, 0, 0, [], [], [], []), shared_ips=[])
+
+    stats = merge_payloads({DEFAULT_SHARD: main, 'tpl': tpl, 'fps': fps})['stats']
+    assert stats['unique_visitors'] == 4 and stats['repeated_visitors'] == 2
+
+
+def sharded_app(monkeypatch, log):
+    main = FakeConn(DEFAULT_SHARD, payload(2, 1, 10, 1, [], [('/a', 2)], [], []), log,
+                    ip_visits={'10.0.0.1': 2})
+    tpl = FakeConn('tpl', payload(3, 3, 20, 2, [], [('/a', 1)], [], []), log,
+                   ip_visits={'10.0.0.1': 1, '10.0.0.2': 2})
+    monkeypatch.setattr(app, 'get_db_connection', lambda: main)
+    monkeypatch.setattr(app, 'shard_router', ShardRouter(
+        lambda: app.get_db_connection(), pools={'tpl': FakePool(tpl)}, sites=SITES,
+    ))
+    return app.app.test_client()
+
+
+def test_all_view_merges_shards_and_site_view_reads_one(monkeypatch):
+    log = []
+    client = sharded_app(monkeypatch, log)
+
+    body = client.get('/api/analytics', query_string={'since': '5'}).get_json()
+    assert sorted(name for name, _, _ in log) == [DEFAULT_SHARD, DEFAULT_SHARD, 'tpl', 'tpl']
+    # each shard learns the visits its addresses have on the others
+    other_visits = {
+        name: json.loads(params[-1]) for name, sql, params in log if 'get_filtered' in sql
+    }
+    assert other_visits == {DEFAULT_SHARD: {'10.0.0.1': 1}, 'tpl': {'10.0.0.1': 2}}
+    assert body['stats']['total_visitors'] == 5 and body['watermark'] is None
+    assert body['charts']['by_page'] == [{'page_visited': '/a', 'count': 3}]
+
+    log.clear()
+    client.get('/api/analytics', query_string={'site_filter': 'tpl'})
+    assert [name for name, _, _ in log] == ['tpl']
+
+
+def test_track_writes_to_the_page_shard(monkeypatch):
+    log = []
+    client = sharded_app(monkeypatch, log)
+    started = []
+
+    class Compactor:
+        def ensure_running(self):
+            started.append('tpl')
+
+    monkeypatch.setattr(app, 'shard_compactors', {'tpl': Compactor()})
+    monkeypatch.setattr(app, 'shard_dimension_keys', {'tpl': DimensionCache()})
+
+    body = {'sessionId': 's-shard', 'pageVisited': 'https://example.org/tpl/home', 'userAgent': FIREFOX}
+    assert client.post('/track', json=body).status_code == 201
+    assert [name for name, _, _ in log] == ['tpl'] and started == ['tpl']
+
+    # time reports go by their page, even on a worker that never saw the
+    # session's views
+    sharded_app(monkeypatch, log)
+    report = {'sessionId': 's-shard', 'timeSpentSeconds': 30}
+    assert client.post('/log/time', json=dict(report, pageVisited=body['pageVisited'])).status_code == 200
+    assert [name for name, _, _ in log] == ['tpl', 'tpl'] and started == ['tpl', 'tpl']
+    assert client.post('/log/time', json=dict(report, siteId='tpl')).status_code == 200
+    assert [name for name, _, _ in log] == ['tpl'] * 3
+
+    # without either, the report is refused rather than written to the wrong shard
+    assert client.post('/log/time', json=report).status_code == 400
+    assert len(log) == 3
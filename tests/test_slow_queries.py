@@ -0,0 +1,130 @@
+# Slow-query recorder: thresholds, sampling, ring buffer and EXPLAIN capture
+
+import random
+import time
+
+import jwt as pyjwt
+
+from backend import app
+from backend.slow_queries import SlowQueryRecorder, query_shape
+
+PARAMS = {
+    'url_filter': 'https://rbg.iitm.ac.in/sanjaya/',
+    'visitor_type_filter': 'repeated',
+    'country_filter': None,
+    'granularity': 'day',
+}
+
+
+class ExplainCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=None):
+        self.conn.executed.append(sql)
+        if sql.startswith("LOAD") and not self.conn.auto_explain:
+            raise RuntimeError('access to library "auto_explain" is not allowed')
+        if sql.startswith("EXPLAIN") and self.conn.auto_explain:
+            self.conn.notices.append(
+                "NOTICE:  duration: 812.0 ms  plan:\nQuery Text: SELECT ... FROM visitors\n"
+                "Seq Scan on visitors\n"
+            )
+
+    def fetchall(self):
+        return [("Result  (actual time=812.4..812.4 rows=1 loops=1)",),
+                ("Buffers: shared hit=1200 read=300",)]
+
+
+class ExplainConn:
+    def __init__(self, auto_explain=True):
+        self.auto_explain = auto_explain
+        self.autocommit = False
+        self.notices = []
+        self.executed = []
+        self.rolled_back = False
+
+    def cursor(self):
+        return ExplainCursor(self)
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        pass
+
+
+def recorder(conn, **kwargs):
+    kwargs.setdefault('threshold_seconds', 0.5)
+    kwargs.setdefault('sample_rate', 1.0)
+    return SlowQueryRecorder(lambda: conn, rng=random.Random(1), **kwargs)
+
+
+def test_query_shape_keeps_only_enumerated_values():
+    assert query_shape('analytics', PARAMS) == \
+        'analytics(granularity=day, url_filter, visitor_type_filter=repeated)'
+
+
+def test_free_text_values_never_enter_the_shape():
+    params = dict(PARAMS, device_filter='Desktop', visitor_type_filter='<script>')
+    assert query_shape('analytics', params) == \
+        'analytics(device_filter, granularity=day, url_filter, visitor_type_filter)'
+
+
+def test_shapes_are_capped_by_evicting_the_rarest():
+    rec = recorder(ExplainConn(), sample_rate=0.0, max_shapes=2)
+    for _ in range(3):
+        rec.observe('analytics', 'SELECT f()', (), PARAMS, 1.0)
+    for statement in ('top', 'delta', 'columnar'):
+        rec.observe(statement, 'SELECT f()', (), {}, 1.0)
+
+    shapes = rec.snapshot()['shapes']
+    assert [s['shape'] for s in shapes] == [query_shape('analytics', PARAMS), 'columnar()']
+    assert shapes[0]['count'] == 3
+
+
+def test_slow_statement_is_explained_with_nested_plans():
+    conn = ExplainConn()
+    rec = recorder(conn)
+
+    assert rec.observe('analytics', 'SELECT f(%s)', ('x',), PARAMS, 0.1) is None
+    rec.observe('analytics', 'SELECT f(%s)', ('x',), PARAMS, 0.9).join()
+
+    entry = rec.snapshot()['entries'][0]
+    assert entry['duration_ms'] == 900.0
+    assert entry['params'] == {k: v for k, v in PARAMS.items() if v is not None}
+    assert entry['plan'].startswith('Result')
+    assert 'Seq Scan on visitors' in entry['nested_plans'][0]
+    assert 'EXPLAIN (ANALYZE, BUFFERS) SELECT f(%s)' in conn.executed
+    # EXPLAIN ANALYZE really runs the statement; its effects are never kept
+    assert conn.rolled_back
+
+
+def test_outer_plan_only_without_auto_explain():
+    rec = recorder(ExplainConn(auto_explain=False))
+    rec.observe('analytics', 'SELECT f()', (), PARAMS, 2.0).join()
+
+    entry = rec.snapshot()['entries'][0]
+    assert entry['plan'] and entry['nested_plans'] == []
+
+
+def test_buffer_is_bounded_and_unsampled_hits_still_counted():
+    rec = recorder(ExplainConn(), capacity=2, sample_rate=0.5)
+    for _ in range(20):
+        thread = rec.observe('analytics', 'SELECT f()', (), PARAMS, 1.0)
+        if thread:
+            thread.join()
+
+    snap = rec.snapshot()
+    assert len(snap['entries']) == 2
+    assert snap['shapes'][0]['count'] == 20
+
+
+def test_admin_endpoint_requires_token():
+    client = app.app.test_client()
+    assert client.get('/api/admin/slow-queries').status_code == 401
+
+    token = pyjwt.encode({'sub': 'admin', 'exp': time.time() + 60},
+                         app.JWT_SECRET_KEY, algorithm='HS256')
+    resp = client.get('/api/admin/slow-queries', headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == 200
+    assert {'threshold_ms', 'shapes', 'entries'} <= resp.get_json().keys()
@@ -0,0 +1,183 @@
+# Columnar snapshot engine: export layout, filter semantics and the API switch
+
+import os
+
+import pytest
+
+from backend import app
+from backend.snapshot import Snapshot, SnapshotBuilder, SnapshotStore, _iso, _micros
+
+DIMENSIONS = [
+    ('browser', 1, 'Chrome'), ('browser', 2, 'Firefox'),
+    ('city', 3, 'Chennai'),
+    ('country', 5, 'Germany'), ('country', 4, 'India'),
+    ('device_type', 6, 'Desktop'),
+    ('isp', 7, 'Jio'),
+    ('operating_system', 8, 'Linux'),
+    ('user_agent', 9, 'UA'),
+]
+IPS = ['10.0.0.1', '10.0.0.2', '2001:db8::1']
+IP_COUNTS = {'10.0.0.1': 2, '10.0.0.2': 1, '2001:db8::1': 1}
+T1 = _micros('2025-06-01T10:00:00+00:00')
+
+
+def at(iso):
+    return _micros(iso + '+00:00')
+
+
+def build(directory, watermark=4):
+    builder = SnapshotBuilder(DIMENSIONS, IPS, IP_COUNTS, watermark)
+    for row in [
+        (1, T1, T1, '10.0.0.1', 'IN', 'https://x.org/tpl/a', 30, 4, 3, 7, 6, 1, 8, 9, 's1', True),
+        (2, T1, at('2025-06-01T11:30:00'), '10.0.0.1', 'IN', 'https://x.org/tpl/b', None,
+         4, 3, 7, 6, 2, 8, 9, 's2', False),
+        (3, T1, at('2025-06-02T09:00:00'), '10.0.0.2', 'DE', 'https://x.org/fps_x', 10,
+         5, None, None, 6, 1, None, None, 's3', False),
+        (4, None, None, None, None, None, None, None, None, None, None, None, None, None, None, False),
+    ]:
+        builder.add_live(row)
+    builder.add_archived((at('2025-05-01T00:00:00'), '2001:db8::1', 'IN', 'https://x.org/tpl/a',
+                          5, 100, 4, 4, 3, 7, 6, 1))
+    for row in [(1, 'https://x.org/tpl/a', T1), (1, 'https://x.org/tpl/c', T1 + 60_000_000),
+                (99, 'https://x.org/gone', T1)]:
+        builder.add_view(row)
+    return builder.write(str(directory))
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    return Snapshot(os.path.join(tmp_path, build(tmp_path)))
+
+
+def test_unfiltered_payload(snapshot):
+    payload = snapshot.analytics()
+    assert payload['stats'] == {
+        'total_visitors': 9, 'unique_visitors': 3, 'repeated_visitors': 6,
+        'avg_time_on_page': 23, 'time_total': 140, 'time_count': 6,
+    }
+    assert payload['watermark'] == 4
+    charts = payload['charts']
+    assert charts['by_country'] == [
+        {'id': 'IN', 'value': 7, 'unique_visitors': 2, 'returning_visitors': 5},
+        {'id': 'DE', 'value': 1, 'unique_visitors': 1, 'returning_visitors': 0},
+    ]
+    assert charts['by_browser'] == [{'browser': 'Chrome', 'count': 7}, {'browser': 'Firefox', 'count': 1}]
+    assert charts['by_isp'] == [{'id': 'Jio', 'value': 7}]
+    # views for the session that has events, its last page otherwise
+    assert charts['by_page'] == [
+        {'page_visited': 'https://x.org/tpl/a', 'count': 6},
+        {'page_visited': 'https://x.org/tpl/b', 'count': 1},
+        {'page_visited': 'https://x.org/fps_x', 'count': 1},
+        {'page_visited': 'https://x.org/tpl/c', 'count': 1},
+    ]
+    assert [(r['date'], r['count'], r['unique_visitors']) for r in charts['by_date']] == [
+        ('2025-05-01T00:00:00+00:00', 5, 1), ('2025-06-01T00:00:00+00:00', 2, 1),
+        ('2025-06-02T00:00:00+00:00', 1, 1), (None, 1, 0),
+    ]
+    assert [(r['date'], r['count']) for r in charts['by_week']] == [
+        ('2025-04-28', 5), ('2025-05-26', 2), ('2025-06-02', 1), (None, 1),
+    ]
+    assert [(r['date'], r['count']) for r in charts['by_month']] == [
+        ('2025-05-01', 5), ('2025-06-01', 3), (None, 1),
+    ]
+
+
+def test_visitor_list_and_meta(snapshot):
+    payload = snapshot.analytics()
+    visitors = payload['visitor_list']
+    # newest first, NULL first_seen leading
+    assert [v['id'] for v in visitors] == [4, 3, 2, 1]
+    assert visitors[0] == {
+        'id': 4, 'created_at': None, 'public_ip': None, 'country': None, 'country_code': None,
+        'city': None, 'page_visited': None, 'user_agent': None, 'device_type': None,
+        'browser': None, 'operating_system': None, 'session_id': None,
+        'time_spent_seconds': None, 'isp': None, 'first_seen': None, 'visit_count': None,
+    }
+    assert visitors[3]['country'] == 'India' and visitors[3]['visit_count'] == 2
+    assert visitors[3]['first_seen'] == '2025-06-01T10:00:00+00:00'
+    assert visitors[2]['time_spent_seconds'] is None and visitors[3]['time_spent_seconds'] == 30
+    assert payload['meta'] == {
+        'distinct_countries': ['Germany', 'India'],
+        'distinct_isps': ['Jio'],
+        'distinct_devices': ['Desktop'],
+        'distinct_urls': ['https://x.org/fps_x', 'https://x.org/tpl/a', 'https://x.org/tpl/b'],
+        'distinct_browsers': ['Chrome', 'Firefox'],
+        'distinct_ips': IPS,
+    }
+
+
+@pytest.mark.parametrize('filters, total', [
+    ({'country_filter': 'Germany'}, 1),
+    ({'country_filter': 'Atlantis'}, 0),
+    ({'browser_filter': 'Chrome', 'device_filter': 'Desktop'}, 7),
+    ({'isp_filter': 'Jio'}, 7),
+    ({'visitor_type_filter': 'unique'}, 6),
+    ({'visitor_type_filter': 'repeated'}, 2),
+    ({'ip_filter': '10.0.0.0/24'}, 3),
+    ({'ip_filter': '10.0.0.2'}, 1),
+    ({'ip_filter': '2001:db8::/32'}, 5),
+    # ILIKE: case-insensitive, ``_`` matches any one character
+    ({'url_filter': 'HTTPS://X.ORG/TPL'}, 7),
+    ({'url_filter': 'https://x.org/fps_'}, 1),
+    ({'url_filter': 'https://x.org/fps\\_x'}, 1),
+    ({'start_date_filter': '2025-06-01T11:00:00+00:00', 'end_date_filter': '2025-06-02T00:00:00+00:00'}, 1),
+    ({'start_date_filter': '2025-05-01T00:00:00+00:00'}, 8),
+])
+def test_filters(snapshot, filters, total):
+    assert snapshot.analytics(**filters)['stats']['total_visitors'] == total
+
+
+def test_filters_apply_to_view_events_and_granularity(snapshot):
+    payload = snapshot.analytics(start_date_filter='2025-06-01T10:00:00+00:00',
+                                 end_date_filter='2025-06-01T10:00:30+00:00', granularity='hour')
+    assert payload['charts']['by_page'] == [{'page_visited': 'https://x.org/tpl/a', 'count': 1}]
+    assert payload['charts']['by_date'] == [
+        {'date': '2025-06-01T10:00:00+00:00', 'count': 1, 'unique_visitors': 1, 'returning_visitors': 0},
+    ]
+    empty = snapshot.analytics(country_filter='Atlantis')
+    assert empty['visitor_list'] == [] and empty['charts']['by_country'] == []
+    assert empty['stats']['avg_time_on_page'] == 0
+
+
+def test_timestamps_render_like_postgres():
+    assert _iso(_micros('2025-06-01T10:00:00.500000+00:00')) == '2025-06-01T10:00:00.5+00:00'
+    assert _iso(_micros('2025-06-01T10:00:00')) == '2025-06-01T10:00:00+00:00'
+
+
+def test_store_switches_generations(tmp_path):
+    clock = [0.0]
+    assert SnapshotStore(str(tmp_path)).current() is None
+    build(tmp_path, watermark=4)
+    store = SnapshotStore(str(tmp_path), check_seconds=10, clock=lambda: clock[0])
+    assert store.current().watermark == 4
+
+    build(tmp_path, watermark=5)
+    build(tmp_path, watermark=6)
+    # only the newest generations are kept
+    assert len([n for n in os.listdir(tmp_path) if n != 'CURRENT']) == 2
+    assert store.current().watermark == 4
+    clock[0] = 11
+    store.current()
+    store._reloader.join()
+    assert store.current().watermark == 6
+    assert store.current(max_age_seconds=-1) is None
+
+
+def test_api_serves_from_snapshot_on_request(tmp_path, monkeypatch):
+    build(tmp_path)
+    monkeypatch.setattr(app, 'snapshot_store', SnapshotStore(str(tmp_path)))
+
+    def no_database():
+        raise AssertionError("the snapshot engine must not query the database")
+
+    monkeypatch.setattr(app, 'get_db_connection', no_database)
+    client = app.app.test_client()
+
+    response = client.get('/api/analytics', query_string={
+        'engine': 'snapshot', 'start_date_filter': '2025-01-01', 'end_date_filter': '2025-12-31',
+        'format': 'columnar',
+    })
+    assert response.status_code == 200 and 'X-Analytics-Snapshot' in response.headers
+    body = response.get_json()
+    assert body['stats']['total_visitors'] == 8
+    assert body['charts']['by_browser'] == {'browser': ['Chrome', 'Firefox'], 'count': [7, 1]}
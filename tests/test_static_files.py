@@ -0,0 +1,63 @@
+# Manifest-based static serving: precompressed variants, cache headers, 304s
+
+import pytest
+from flask import Flask, request
+
+from backend.precompress import precompress
+from backend.static_files import build_manifest, serve_entry
+
+
+@pytest.fixture
+def site(tmp_path):
+    (tmp_path / "index.html").write_text("<html>" + "x" * 1000 + "</html>")
+    chunk_dir = tmp_path / "_next" / "static" / "chunks"
+    chunk_dir.mkdir(parents=True)
+    (chunk_dir / "main-abc123.js").write_text("console.log('hi');" * 100)
+    precompress(str(tmp_path))
+    return tmp_path
+
+
+def fetch(manifest, path, **headers):
+    app = Flask(__name__)
+    with app.test_request_context("/" + path, headers=headers):
+        resp = serve_entry(manifest[path], request)
+        resp.direct_passthrough = False
+        return resp
+
+
+def test_manifest_indexes_variants(site):
+    manifest = build_manifest(str(site))
+    assert set(manifest) == {"index.html", "_next/static/chunks/main-abc123.js"}
+    assert set(manifest["index.html"].variants) == {"br", "gzip"}
+    assert manifest["_next/static/chunks/main-abc123.js"].immutable
+    assert not manifest["index.html"].immutable
+
+
+def test_hashed_assets_are_immutable_and_precompressed(site):
+    manifest = build_manifest(str(site))
+    resp = fetch(manifest, "_next/static/chunks/main-abc123.js", **{"Accept-Encoding": "gzip, br"})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "br"
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert resp.headers["Vary"] == "Accept-Encoding"
+
+    resp = fetch(manifest, "_next/static/chunks/main-abc123.js", **{"Accept-Encoding": "gzip, br;q=0"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+
+    resp = fetch(manifest, "_next/static/chunks/main-abc123.js")
+    assert "Content-Encoding" not in resp.headers
+    assert resp.get_data().startswith(b"console.log")
+
+
+def test_index_revalidates_with_etag(site):
+    manifest = build_manifest(str(site))
+    first = fetch(manifest, "index.html")
+    assert first.headers["Cache-Control"] == "no-cache"
+    etag = first.headers["ETag"]
+
+    again = fetch(manifest, "index.html", **{"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+
+    # a different coding is a different representation
+    assert fetch(manifest, "index.html", **{"If-None-Match": etag, "Accept-Encoding": "br"}).status_code == 200
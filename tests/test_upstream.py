@@ -0,0 +1,269 @@
+# UpstreamPool against a local stub HTTP server
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backend.upstream import UpstreamPool, normalize_date, normalize_users, select_users, stream_users
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.calls += 1
+            server.client_ports.add(self.client_address[1])
+        time.sleep(server.delay)
+        payload = json.dumps({"details": [
+            {"userid": server.calls, "rep_name": "Asha", "district_name": "Chennai",
+             "start": body["start_date"]},
+        ]}).encode()
+        self.send_response(server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_stub(status=200, delay=0):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.client_ports = set()
+    server.delay = delay
+    server.status = status
+    # clients that gave up (deadline tests) close the socket mid-response
+    server.handle_error = lambda request, client_address: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def stub():
+    server = make_stub()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_pool(stub, **kwargs):
+    url = f"http://127.0.0.1:{stub.server_address[1]}/export_all_data"
+    return UpstreamPool({"stub": url}, **kwargs)
+
+
+def test_cache_hit_and_connection_reuse(stub):
+    pool = make_pool(stub)
+    payload, status = pool.fetch("stub", "2024-01-01", "")
+    assert status == "MISS"
+    assert payload["users"][0]["user_name"] == "Asha"
+    assert payload["users"][0]["district"] == "Chennai"
+
+    assert pool.fetch("stub", "2024-01-01", "") == (payload, "HIT")
+    pool.fetch("stub", "2024-02-01", "")
+    assert stub.calls == 2
+    # both misses went over the same keep-alive connection
+    assert len(stub.client_ports) == 1
+    pool.close()
+
+
+def test_single_flight(stub):
+    stub.delay = 0.2
+    pool = make_pool(stub)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(pool.fetch("stub")))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert stub.calls == 1
+    assert len(results) == 5
+    pool.close()
+
+
+def test_stale_while_revalidate(stub):
+    clock = FakeClock()
+    pool = make_pool(stub, fresh_seconds=10, stale_seconds=100, clock=clock)
+    first, _ = pool.fetch("stub")
+
+    clock.now = 50
+    stale, status = pool.fetch("stub")
+    assert status == "STALE" and stale == first
+
+    deadline = time.time() + 2
+    while stub.calls < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    refreshed, status = pool.fetch("stub")
+    assert status == "HIT"
+    assert refreshed["users"][0]["userid"] == 2
+
+    clock.now = 500
+    assert pool.fetch("stub")[1] == "MISS"
+    pool.close()
+
+
+def test_cache_is_bounded_by_bytes(stub):
+    pool = make_pool(stub)
+    pool.fetch("stub", "2024-01-01")
+    size = pool._cache_bytes
+    assert size > 0
+    pool.max_bytes = 2 * size
+    for day in ("2024-01-02", "2024-01-03"):
+        pool.fetch("stub", day)
+    # the oldest body made room for the newest
+    assert len(pool._cache) == 2 and pool._cache_bytes == 2 * size
+    assert pool.fetch("stub", "2024-01-01")[1] == "MISS"
+
+    pool.max_bytes = size - 1
+    pool.fetch("stub", "2024-01-04")
+    assert ("stub", "2024-01-04", "") not in pool._cache
+    pool.close()
+
+
+def test_dates_are_normalised_into_the_key(stub):
+    assert normalize_date(" 20240105 ") == "2024-01-05" and normalize_date(None) == ""
+    with pytest.raises(ValueError):
+        normalize_date("next tuesday")
+
+    pool = make_pool(stub)
+    pool.fetch("stub", "2024-01-05")
+    assert pool.fetch("stub", "20240105")[1] == "HIT"
+    assert stub.calls == 1
+    pool.close()
+
+
+def test_errors_are_not_cached(stub):
+    stub.status = 502
+    pool = make_pool(stub)
+    with pytest.raises(Exception):
+        pool.fetch("stub")
+    stub.status = 200
+    assert pool.fetch("stub")[1] == "MISS"
+    pool.close()
+
+
+def test_fan_out_returns_partial_results():
+    ok, broken, slow = make_stub(), make_stub(status=500), make_stub(delay=1.0)
+    pool = UpstreamPool({
+        name: f"http://127.0.0.1:{server.server_address[1]}/"
+        for name, server in (("ok", ok), ("broken", broken), ("slow", slow))
+    })
+    try:
+        started = time.perf_counter()
+        result = pool.fetch_many(["ok", "broken", "slow"], deadline=0.3)
+        assert time.perf_counter() - started < 0.9
+
+        assert [u["app"] for u in result["users"]] == ["ok"]
+        assert result["upstreams"]["ok"]["status"] == "ok"
+        assert result["upstreams"]["ok"]["count"] == 1
+        assert result["upstreams"]["broken"] == {
+            "status": "error", "error": "Upstream returned 500", "count": 0,
+            "elapsed_ms": result["upstreams"]["broken"]["elapsed_ms"],
+        }
+        assert result["upstreams"]["slow"]["status"] == "timeout"
+        for info in result["upstreams"].values():
+            assert info["elapsed_ms"] >= 0
+    finally:
+        pool.close()
+        for server in (ok, broken, slow):
+            server.shutdown()
+            server.server_close()
+
+
+def test_fan_out_deadline_releases_the_worker_thread():
+    ok, slow = make_stub(), make_stub(delay=1.0)
+    pool = UpstreamPool({
+        name: f"http://127.0.0.1:{server.server_address[1]}/"
+        for name, server in (("ok", ok), ("slow", slow))
+    }, fanout_workers=1)
+    try:
+        first = pool.fetch_many(["slow"], deadline=0.2)
+        assert first["upstreams"]["slow"]["status"] == "timeout"
+        # the only pool thread must not still be waiting on the slow upstream
+        second = pool.fetch_many(["ok"], deadline=0.5)
+        assert second["upstreams"]["ok"]["status"] == "ok"
+    finally:
+        pool.close()
+        for server in (ok, slow):
+            server.shutdown()
+            server.server_close()
+
+
+def chunked(doc, size=7):
+    raw = json.dumps(doc).encode()
+    return (raw[i:i + size] for i in range(0, len(raw), size))
+
+
+@pytest.mark.parametrize("doc", [
+    {"status": "ok", "details": [
+        {"userid": 1, "rep_name": "Asha", "district_name": "Chennai", "role": "SHO",
+         "extra": {"nested": [1, 2]}},
+        {"userid": 2, "name": "Ravi", "district": "Madurai", "phone_no": "99"},
+    ]},
+    {"details": []},
+    {"data": [{"id": 1}, {"id": 2}]},
+    [{"id": 1}, "plain"],
+    {"message": "no data", "count": 0.5},
+    {"status": "ok", "details": {
+        "users": [{"userid": 1, "name": "Asha", "district_name": "Chennai", "designation": "SI"}],
+        "admins": [{"userid": 2, "name": "Ravi", "district_name": "Madurai"}],
+        "surveys": [],
+        "counts": {"users": 1},
+    }},
+])
+def test_streaming_matches_buffered_normalisation(doc):
+    payload, size = stream_users(chunked(doc))
+    assert payload == normalize_users(doc)
+    assert size == len(json.dumps(doc).encode())
+
+
+def test_select_users_filters_projects_and_pages():
+    payload = {"users": [
+        {"userid": i, "district": "Chennai" if i % 2 else "Madurai",
+         "user_role": "SHO", "phone": "x"}
+        for i in range(1, 11)
+    ]}
+    result = select_users(payload, district="chennai", role="sho",
+                          fields=["userid"], page=2, page_size=2)
+    assert result == {"total": 5, "page": 2, "page_size": 2,
+                      "users": [{"userid": 5}, {"userid": 7}]}
+    assert select_users(payload)["total"] == 10
+
+
+def test_nested_details_are_streamed_per_role():
+    doc = {"status": "ok", "details": {
+        "users": [{"userid": i, "name": f"u{i}", "district_name": "Chennai" if i % 2 else "Salem"}
+                  for i in range(50)],
+        "admins": [{"userid": 100, "name": "admin", "district_name": "Chennai"}],
+        "surveys": [{"userid": 200, "name": "survey", "district": "Salem"}],
+    }}
+    payload, _ = stream_users(chunked(doc, size=64))
+    assert "raw" not in payload
+    assert len(payload["users"]) == 52
+    admin = payload["users"][50]
+    assert admin["_role"] == "Admin" and admin["user_role"] == "Admin" and admin["name"] == "admin"
+    assert payload["users"][51]["district"] == "Salem"
+
+    page = select_users(payload, district="chennai", role="user", page=1, page_size=10)
+    assert page["total"] == 25 and len(page["users"]) == 10
+    assert {u["district_name"] for u in page["users"]} == {"Chennai"}